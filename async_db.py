@@ -0,0 +1,108 @@
+import asyncio
+import contextvars
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple, TypeVar
+
+import database
+import leaderboard_cache
+import messages
+import metrics
+import ranks
+import run_import
+import write_queue
+
+T = TypeVar('T')
+
+# Максимальное число потоков, одновременно работающих с базой данных
+DB_MAX_WORKERS = 4
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_MAX_WORKERS, thread_name_prefix='db')
+    return _executor
+
+def configure(max_workers: int) -> None:
+    """
+    Меняет размер пула потоков базы данных (действует после shutdown или до первого запроса)
+    """
+    global DB_MAX_WORKERS
+    DB_MAX_WORKERS = max_workers
+
+async def run_db(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Выполняет синхронную функцию работы с БД в пуле потоков, не блокируя цикл событий
+    """
+    loop = asyncio.get_running_loop()
+    call = functools.partial(func, *args, **kwargs)
+    if not metrics.ENABLED:
+        return await loop.run_in_executor(_get_executor(), call)
+    # Контекст переносится в поток БД, чтобы запросы приписывались вызвавшему их обработчику
+    context = contextvars.copy_context()
+    start = time.perf_counter()
+    try:
+        return await loop.run_in_executor(_get_executor(), context.run, call)
+    finally:
+        metrics.observe_db_call(func, time.perf_counter() - start)
+
+def shutdown() -> None:
+    """
+    Дожидается завершения запросов и останавливает пул потоков
+    """
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True)
+        _executor = None
+
+# Асинхронные версии функций работы с данными
+
+async def init_user(user_id: int, username: str = None) -> None:
+    await run_db(database.init_user, user_id, username)
+
+async def add_run(user_id: int, distance: float) -> float:
+    # Если запущен групповой писатель, пробежка фиксируется вместе с попутными
+    writer = write_queue.get_writer()
+    if writer is not None:
+        return await asyncio.wrap_future(writer.submit(user_id, distance))
+    return await run_db(database.add_run, user_id, distance)
+
+async def get_user_stats(user_id: int) -> Dict[str, Any]:
+    return await run_db(database.get_user_stats, user_id)
+
+async def get_dashboard(user_id: int) -> Dict[str, Any]:
+    return await run_db(database.get_dashboard, user_id)
+
+async def has_runs_this_week(user_id: int) -> bool:
+    return await run_db(database.has_runs_this_week, user_id)
+
+async def import_runs(user_id: int, path: str, fmt: Optional[str] = None) -> run_import.ImportResult:
+    return await run_db(run_import.import_file, user_id, path, fmt)
+
+async def get_weekly_leaderboard(limit: int = 10) -> List[Dict[str, Any]]:
+    return await run_db(database.get_weekly_leaderboard, limit)
+
+async def get_monthly_leaderboard(limit: int = 10) -> List[Dict[str, Any]]:
+    return await run_db(database.get_monthly_leaderboard, limit)
+
+async def get_leaderboard_text() -> str:
+    # Попадание в кэш обслуживается без перехода в пул потоков БД
+    entry = leaderboard_cache.cache.peek()
+    if entry is None:
+        entry = await run_db(leaderboard_cache.get_leaderboard)
+    return entry.text
+
+async def determine_rank(km: float) -> str:
+    return await run_db(ranks.determine_rank, km)
+
+async def calculate_progress(km: float) -> Tuple[str, Optional[str], Optional[float]]:
+    return await run_db(ranks.calculate_progress, km)
+
+async def get_random_challenge(rank: str, user_id: Optional[int] = None) -> str:
+    return await run_db(ranks.get_random_challenge, rank, user_id)
+
+async def get_random_motivation(user_id: Optional[int] = None) -> str:
+    return await run_db(messages.get_random_motivation, user_id)
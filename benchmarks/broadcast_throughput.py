@@ -0,0 +1,107 @@
+"""
+Пропускная способность рассылки еженедельных отчетов.
+
+Создает синтетическую базу с пробежками за текущую неделю, поднимает локальный
+сервер Bot API (benchmarks.fake_bot_api) с ограничением скорости и заблокированными
+чатами и рассылает отчеты через настоящий aiogram.Bot. Первая рассылка прерывается
+на середине, вторая продолжает ее по журналу report_deliveries; в конце проверяется,
+что ни один чат не получил отчет дважды.
+
+Запуск: python -m benchmarks.broadcast_throughput [--users 1000] [--rate 25]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from datetime import date
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import async_db
+import broadcast
+import rollups
+from db_connection import get_connection
+from benchmarks import datagen
+from benchmarks.fake_bot_api import FakeBotAPI
+
+async def run_until(job: broadcast.WeeklyReportBroadcast, stop_after: int) -> None:
+    """Запускает рассылку и прерывает ее после stop_after отправленных отчетов"""
+    task = asyncio.create_task(job.run())
+    while not task.done() and job.stats.sent < stop_after:
+        await asyncio.sleep(0.01)
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+
+async def benchmark(args: argparse.Namespace) -> None:
+    week = rollups.week_key(date.today())
+    expected = get_connection().execute(
+        "SELECT COUNT(*) FROM weekly_totals WHERE week_key = ? AND runs_count > 0", (week,)
+    ).fetchone()[0]
+    blocked = set(range(1, args.users + 1, args.block_every)) if args.block_every else set()
+
+    api = FakeBotAPI(latency=args.latency, global_limit=args.global_limit, blocked=blocked)
+    url = await api.start()
+    bot = Bot(token="123:ABC", session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+
+    async def send(user_id: int, text: str) -> None:
+        await bot.send_message(user_id, text)
+
+    options = dict(workers=args.workers, rate=args.rate, per_chat_rate=1.0)
+    print(f"Отчетов к отправке: {expected}, ограничение рассылки {args.rate}/с, "
+          f"сервера {args.global_limit}/с, задержка ответа {args.latency * 1000:.0f} мс")
+    try:
+        first = broadcast.WeeklyReportBroadcast(send, week, **options)
+        await run_until(first, expected // 2)
+        print(f"Первая рассылка прервана: отправлено {first.stats.sent}")
+
+        start = time.perf_counter()
+        second = broadcast.WeeklyReportBroadcast(send, week, **options)
+        stats = await second.run()
+        total = time.perf_counter() - start
+    finally:
+        await bot.session.close()
+        await api.stop()
+        async_db.shutdown()
+
+    print(f"Вторая рассылка: отправлено {stats.sent}, заблокировали бота {stats.blocked}, "
+          f"ошибок {stats.failed}, за {total:.1f} с ({stats.rate:.1f} сообщений/с)")
+    print(f"Ответов 429 от сервера: {api.flood_errors}")
+
+    statuses = dict(get_connection().execute(
+        "SELECT status, COUNT(*) FROM report_deliveries WHERE week_key = ? GROUP BY status", (week,)
+    ).fetchall())
+    print(f"Журнал доставки: {statuses}")
+    duplicates = [chat_id for chat_id, count in api.delivered.items() if count > 1]
+    assert not duplicates, f"Повторные отчеты в чаты {duplicates[:10]}"
+    assert sum(statuses.values()) == expected
+    print(f"Получили отчет {len(api.delivered)} чатов, повторов нет")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарк рассылки еженедельных отчетов')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--runs', type=int, default=3000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=25.0)
+    parser.add_argument('--global-limit', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--block-every', type=int, default=50, help='каждый N-й пользователь заблокировал бота')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        # Пробежки только за дни текущей недели
+        datagen.generate(os.path.join(tmp_dir, 'broadcast.db'), args.users, args.runs,
+                         days=date.today().weekday() + 1)
+        asyncio.run(benchmark(args))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
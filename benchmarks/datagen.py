@@ -0,0 +1,144 @@
+import os
+import sqlite3
+from datetime import date, timedelta
+from typing import Optional
+
+import db_connection
+import database
+import rollups
+
+# База, из которой копируются ранги, задания и мотивационные сообщения
+TEMPLATE_DB_PATH = 'running_bot.db'
+
+# Ранги по умолчанию, если шаблонной базы нет
+DEFAULT_RANKS = [
+    ("Падаван", 0, 10.0),
+    ("Рыцарь-джедай", 11, 30.0),
+    ("Мастер-джедай", 31, 50.0),
+    ("Ситх", 51, 70.0),
+    ("Лорд Ситхов", 71, float('inf')),
+]
+
+def seed_catalog(conn: sqlite3.Connection, template_path: Optional[str] = TEMPLATE_DB_PATH) -> None:
+    """
+    Заполняет таблицы рангов, заданий и мотивационных сообщений
+    """
+    cursor = conn.cursor()
+    if template_path and os.path.exists(template_path):
+        cursor.execute("ATTACH DATABASE ? AS template", (template_path,))
+        for table in ("ranks", "challenges", "motivational_messages"):
+            # Шаблон может быть в старой схеме (без колонок, добавленных миграциями): копируются
+            # его колонки, остальные получают значения по умолчанию
+            cursor.execute(f"PRAGMA template.table_info({table})")
+            columns = ", ".join(column[1] for column in cursor.fetchall())
+            cursor.execute(f"INSERT INTO {table} ({columns}) SELECT {columns} FROM template.{table}")
+        conn.commit()
+        cursor.execute("DETACH DATABASE template")
+    else:
+        cursor.executemany(
+            "INSERT INTO ranks (name, min_km, max_km) VALUES (?, ?, ?)", DEFAULT_RANKS
+        )
+        cursor.executemany(
+            "INSERT INTO challenges (rank_id, challenge_text) VALUES (?, ?)",
+            [(rank_id, f"Задание для ранга {rank_id}") for rank_id in range(1, len(DEFAULT_RANKS) + 1)]
+        )
+        cursor.execute(
+            "INSERT INTO motivational_messages (message) VALUES (?)",
+            ("Продолжай двигаться вперед!",)
+        )
+        conn.commit()
+    cursor.close()
+
+# Пробежки генерируются одним запросом в SQLite: номер пробежки i через мультипликативные хеши
+# по модулю простых чисел дает пользователя, день и дистанцию. Это воспроизводимо при том же seed
+# и на порядок быстрее генерации в Python, что важно для баз в десятки миллионов пробежек.
+# Каждая пятая пробежка приходится на 5% самых активных пользователей.
+_RUNS_SQL = """
+    WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < :runs)
+    INSERT INTO runs (user_id, run_date, run_day, distance)
+    SELECT CASE WHEN (i * 2654435761 + :seed) % 4294967311 % 5 = 0
+                THEN (i * 2246822519 + :seed) % 4294967291 % :active + 1
+                ELSE (i * 3266489917 + :seed) % 4294967279 % :users + 1
+           END,
+           d.run_date, d.run_day,
+           (i * 668265263 + :seed) % 2147483647 % 241 / 10.0 + 1
+    FROM n JOIN temp.datagen_days d ON d.run_day = :first_day + (i * 374761393 + :seed) % 4294967231 % :days
+"""
+
+def generate(db_path: str, users: int, runs: int, days: int = 365,
+             seed: int = 42, template_path: Optional[str] = TEMPLATE_DB_PATH) -> None:
+    """
+    Создает синтетическую базу данных с заданным числом пользователей и пробежек.
+    Пробежки распределены по последним `days` дням, включая текущую неделю.
+    """
+    if os.path.exists(db_path):
+        os.remove(db_path)
+    db_connection.configure(db_path)
+    database.init_db()
+
+    conn = db_connection.get_connection()
+    seed_catalog(conn, template_path)
+
+    cursor = conn.cursor()
+    today = date.today()
+    first_day = today - timedelta(days=days - 1)
+    week = today.isocalendar()[1]
+
+    cursor.executemany(
+        "INSERT INTO users (user_id, username, current_week, total_distance, joined_date) VALUES (?, ?, ?, 0, ?)",
+        ((user_id, f"runner{user_id}", week, first_day.isoformat()) for user_id in range(1, users + 1))
+    )
+
+    # Дни диапазона с ключами недели и месяца: из них берутся даты пробежек и строятся агрегаты
+    cursor.execute("""
+        CREATE TEMP TABLE datagen_days (
+            run_day INTEGER PRIMARY KEY, run_date TEXT, week_key INTEGER, month_key INTEGER
+        )
+    """)
+    cursor.executemany(
+        "INSERT INTO temp.datagen_days VALUES (?, ?, ?, ?)",
+        ((rollups.day_key(day), day.isoformat(), rollups.week_key(day), rollups.month_key(day))
+         for day in (first_day + timedelta(days=offset) for offset in range(days)))
+    )
+
+    # Индексы пробежек и агрегатов строятся после загрузки: так быстрее, чем обновлять их на каждой вставке
+    cursor.execute("""
+        SELECT name, sql FROM sqlite_master
+        WHERE type = 'index' AND tbl_name IN ('runs', 'weekly_totals', 'monthly_totals') AND sql IS NOT NULL
+    """)
+    indexes = cursor.fetchall()
+    for name, _ in indexes:
+        cursor.execute(f"DROP INDEX {name}")
+    cursor.execute(_RUNS_SQL, {
+        "runs": runs, "seed": seed % 2 ** 31, "users": users, "active": max(1, users // 20),
+        "first_day": rollups.day_key(first_day), "days": days,
+    })
+
+    # То же, что rollups.rebuild, но ключи недели и месяца берутся из таблицы дней, а не вычисляются
+    # функциями дат для каждой пробежки
+    cursor.execute("""
+        INSERT INTO weekly_totals (user_id, week_key, distance, runs_count)
+        SELECT r.user_id, d.week_key, SUM(r.distance), COUNT(*)
+        FROM runs r JOIN temp.datagen_days d ON d.run_day = r.run_day
+        GROUP BY 1, 2
+    """)
+    cursor.execute("""
+        INSERT INTO monthly_totals (user_id, month_key, distance, runs_count)
+        SELECT r.user_id, d.month_key, SUM(r.distance), COUNT(*)
+        FROM runs r JOIN temp.datagen_days d ON d.run_day = r.run_day
+        GROUP BY 1, 2
+    """)
+    # Общий километраж складывается из месячных агрегатов: их ключ начинается с user_id
+    cursor.execute("""
+        UPDATE users SET total_distance = COALESCE(
+            (SELECT SUM(distance) FROM monthly_totals m WHERE m.user_id = users.user_id), 0
+        )
+    """)
+    for _, sql in indexes:
+        cursor.execute(sql)
+    conn.commit()
+    cursor.execute("DROP TABLE temp.datagen_days")
+    cursor.close()
+
+    # Закрываем соединения, чтобы WAL-журнал был перенесен в основной файл базы
+    db_connection.close_all()
@@ -0,0 +1,156 @@
+"""
+Сравнение хранения даты пробежки ISO-строкой (run_date TEXT) и номером дня (run_day INTEGER).
+
+Строит синтетическую базу, делает из нее копию со старой схемой (только run_date и индексы
+по тексту) и сравнивает размер файлов и время выборок по диапазону дат. Затем мигрирует
+копию со старой схемой и заполняет run_day пачками, одновременно записывая пробежки из
+другого потока, и показывает, сколько ждала самая медленная запись.
+
+Запуск: python -m benchmarks.day_keys [--users 20000] [--runs 1000000]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+from typing import Callable, List, Tuple
+
+import migrate_db
+from benchmarks import datagen
+
+def make_legacy_copy(source: str, target: str) -> None:
+    """Копия базы в схеме до миграции 4: без run_day и с индексами по текстовой дате"""
+    shutil.copyfile(source, target)
+    conn = sqlite3.connect(target)
+    conn.executescript("""
+        DROP TRIGGER IF EXISTS runs_fill_run_day;
+        DROP INDEX IF EXISTS idx_runs_user_day;
+        DROP INDEX IF EXISTS idx_runs_day_user;
+        ALTER TABLE runs DROP COLUMN run_day;
+        CREATE INDEX idx_runs_user_date ON runs (user_id, run_date, distance);
+        CREATE INDEX idx_runs_date_user ON runs (run_date, user_id, distance);
+        PRAGMA user_version = 3;
+    """)
+    conn.execute("VACUUM")
+    conn.close()
+
+def vacuum(path: str) -> None:
+    conn = sqlite3.connect(path)
+    conn.execute("VACUUM")
+    conn.close()
+
+def measure(conn: sqlite3.Connection, sql: str, params_list: List[Tuple], repeat: int = 3) -> float:
+    """Лучшее из repeat суммарное время выполнения запроса со всеми наборами параметров, мс"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for params in params_list:
+            conn.execute(sql, params).fetchall()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+def range_scans(path: str, column: str, to_param: Callable[[date], object], users: int) -> List[Tuple[str, float]]:
+    conn = sqlite3.connect(path)
+    today = date.today()
+    week_start = today - timedelta(days=today.weekday())
+    week = (to_param(week_start), to_param(week_start + timedelta(days=6)))
+    month = (to_param(today.replace(day=1)), to_param(today))
+    year = (to_param(today - timedelta(days=364)), to_param(today))
+    rng = random.Random(1)
+    sample = [rng.randint(1, users) for _ in range(2000)]
+
+    results = [
+        ("неделя пользователя x2000", measure(
+            conn,
+            f"SELECT {column}, SUM(distance) FROM runs WHERE user_id = ? AND {column} BETWEEN ? AND ? GROUP BY {column}",
+            [(user_id, *week) for user_id in sample]
+        )),
+        ("топ месяца", measure(
+            conn,
+            f"SELECT user_id, SUM(distance) AS total FROM runs WHERE {column} BETWEEN ? AND ? "
+            "GROUP BY user_id ORDER BY total DESC LIMIT 10",
+            [month]
+        )),
+        ("сумма за год", measure(
+            conn, f"SELECT SUM(distance) FROM runs WHERE {column} BETWEEN ? AND ?", [year]
+        )),
+    ]
+    conn.close()
+    return results
+
+def online_backfill(path: str, batch_size: int) -> Tuple[float, float, int]:
+    """
+    Мигрирует базу и заполняет run_day, параллельно добавляя пробежки из другого соединения.
+    Возвращает (время заполнения, максимальное ожидание записи в мс, число записей).
+    """
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    migrate_db.apply_migrations(conn)
+
+    stop = threading.Event()
+    waits: List[float] = []
+
+    def writer() -> None:
+        writer_conn = sqlite3.connect(path, timeout=30)
+        today = date.today().isoformat()
+        while not stop.is_set():
+            start = time.perf_counter()
+            writer_conn.execute("INSERT INTO runs (user_id, run_date, distance) VALUES (1, ?, 5.0)", (today,))
+            writer_conn.commit()
+            waits.append(time.perf_counter() - start)
+            time.sleep(0.002)
+        writer_conn.close()
+
+    thread = threading.Thread(target=writer)
+    thread.start()
+    start = time.perf_counter()
+    migrate_db.backfill_run_days(conn, batch_size=batch_size, pause=0.001)
+    elapsed = time.perf_counter() - start
+    stop.set()
+    thread.join()
+
+    missing = conn.execute("SELECT COUNT(*) FROM runs WHERE run_day IS NULL").fetchone()[0]
+    assert missing == 0, f"{missing} пробежек остались без run_day"
+    conn.close()
+    return elapsed, max(waits, default=0) * 1000, len(waits)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарк целочисленных ключей дня в таблице runs')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--runs', type=int, default=1000000)
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    int_path = os.path.join(tmp_dir, 'day_keys_int.db')
+    text_path = os.path.join(tmp_dir, 'day_keys_text.db')
+
+    print(f"Генерация базы: {args.users} пользователей, {args.runs} пробежек...")
+    datagen.generate(int_path, args.users, args.runs)
+    make_legacy_copy(int_path, text_path)
+    migrated_path = os.path.join(tmp_dir, 'day_keys_migrated.db')
+    shutil.copyfile(text_path, migrated_path)
+    vacuum(int_path)
+
+    text_size, int_size = os.path.getsize(text_path), os.path.getsize(int_path)
+    print(f"\nРазмер файла: run_date TEXT {text_size / 2**20:.1f} МБ, "
+          f"run_day INTEGER {int_size / 2**20:.1f} МБ ({int_size / text_size - 1:+.1%})")
+
+    text_results = range_scans(text_path, "run_date", date.isoformat, args.users)
+    int_results = range_scans(int_path, "run_day", date.toordinal, args.users)
+    print(f"\n{'Запрос':<28} | {'TEXT, мс':>10} | {'INTEGER, мс':>12} | {'Ускорение':>9}")
+    for (name, text_ms), (_, int_ms) in zip(text_results, int_results):
+        print(f"{name:<28} | {text_ms:>10.1f} | {int_ms:>12.1f} | {text_ms / int_ms:>8.2f}x")
+
+    elapsed, max_wait, writes = online_backfill(migrated_path, args.batch_size)
+    print(f"\nЗаполнение run_day пачками по {args.batch_size}: {elapsed:.1f} с; "
+          f"параллельно записано {writes} пробежек, максимальное ожидание записи {max_wait:.1f} мс")
+
+    shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
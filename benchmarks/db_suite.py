@@ -0,0 +1,299 @@
+"""
+Микробенчмарки функций слоя данных на синтетических базах разного размера.
+
+Для каждого набора данных из --sizes (готовые 1k, 10k, 100k, 1m или ПОЛЬЗОВАТЕЛЕЙ:ПРОБЕЖЕК)
+benchmarks.datagen строит базу с пробежками за --days дней (по умолчанию три года).
+Базы кэшируются в --data-dir и строятся заново на следующий день или с --regenerate:
+база на 1M пользователей и 50M пробежек занимает несколько гигабайт и строится минуты.
+Замеры идут на копии базы в отдельном процессе, чтобы кэши модулей и пиковый RSS
+относились к одному набору данных.
+
+Каждая функция из FUNCTIONS вызывается после прогрева сериями: в серии столько вызовов, чтобы
+она длилась не меньше --sample-time, серий --repeat (но не больше --max-time на функцию и не
+меньше трех). Замеры повторяются в --rounds процессах на свежих копиях базы: от запуска к запуску
+процесса время быстрых функций меняется сильнее, чем между сериями одного процесса.
+Пользователи выбираются детерминированно по --seed. Выводится медиана медиан процессов
+и минимум времени одного вызова; с --output результаты сохраняются в JSON. С --baseline
+сравнивает с сохраненным прогоном и завершается с кодом 1, если функция замедлилась больше чем
+на --threshold (и больше чем на --min-delta-ms) и по медиане, и по минимуму.
+
+Запуск: python -m benchmarks.db_suite [--sizes 1k 10k 100k] [--rounds 3] [--output db.json]
+        [--baseline previous.json --threshold 0.25]
+"""
+import argparse
+import contextlib
+import io
+import itertools
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import date
+from typing import Any, Callable, Dict, List, Tuple
+
+from benchmarks import results
+
+# Готовые наборы данных: (пользователей, пробежек)
+SIZES = {
+    "1k": (1000, 50000),
+    "10k": (10000, 500000),
+    "100k": (100000, 5000000),
+    "1m": (1000000, 50000000),
+}
+
+# Замеряемые функции в порядке запуска; запись (add_run) идет последней
+FUNCTIONS = [
+    "leaderboard.warm",
+    "database.get_weekly_leaderboard",
+    "database.get_monthly_leaderboard",
+    "database.compute_leaderboard",
+    "database.get_user_stats",
+    "database.get_dashboard",
+    "db_utils.determine_rank_db",
+    "database.get_users_db",
+    "db_admin.list_users",
+    "db_admin.backup_database",
+    "database.add_run",
+]
+
+MIN_SAMPLES = 3
+# Сколько пользователей перебирают функции, принимающие user_id
+SAMPLE_USERS = 1000
+
+def parse_size(value: str) -> Tuple[str, int, int]:
+    if value in SIZES:
+        return (value, *SIZES[value])
+    users, _, runs = value.partition(":")
+    if not users.isdigit() or not runs.isdigit():
+        raise argparse.ArgumentTypeError(f"нужно {', '.join(SIZES)} или ПОЛЬЗОВАТЕЛЕЙ:ПРОБЕЖЕК, а не {value!r}")
+    return value, int(users), int(runs)
+
+def dataset_path(data_dir: str, users: int, runs: int, days: int, seed: int) -> str:
+    # База строится от текущей даты, поэтому вчерашняя копия уже не подходит
+    return os.path.join(data_dir, f"db_suite_{users}u_{runs}r_{days}d_s{seed}_{date.today():%Y%m%d}.db")
+
+def prepare_dataset(args: argparse.Namespace, users: int, runs: int) -> Tuple[str, float]:
+    """Путь к базе набора и время ее построения (0, если взята из кэша)"""
+    from benchmarks import datagen
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    path = dataset_path(args.data_dir, users, runs, args.days, args.seed)
+    prefix = os.path.basename(path).rsplit("_", 1)[0] + "_"
+    for name in os.listdir(args.data_dir):
+        # Устаревшие копии того же набора за прошлые дни
+        if name.startswith(prefix) and os.path.join(args.data_dir, name) != path:
+            os.remove(os.path.join(args.data_dir, name))
+    if os.path.exists(path) and not args.regenerate:
+        return path, 0.0
+    start = time.perf_counter()
+    datagen.generate(path + ".tmp", users, runs, days=args.days, seed=args.seed)
+    os.replace(path + ".tmp", path)
+    return path, time.perf_counter() - start
+
+def measure(call: Callable[[], Any], repeat: int, sample_time: float, max_time: float) -> Dict[str, float]:
+    """Время одного вызова по сериям; первый вызов — прогрев"""
+    start = time.perf_counter()
+    call()
+    first = time.perf_counter() - start
+    number = max(1, min(100000, int(sample_time / max(first, 1e-7))))
+    samples: List[float] = []
+    deadline = time.perf_counter() + max_time
+    while len(samples) < MIN_SAMPLES or (len(samples) < repeat and time.perf_counter() < deadline):
+        start = time.perf_counter()
+        for _ in range(number):
+            call()
+        samples.append((time.perf_counter() - start) / number)
+    return {
+        "median_ms": statistics.median(samples) * 1000,
+        "min_ms": min(samples) * 1000,
+        "calls": number * len(samples),
+        "samples": len(samples),
+    }
+
+def build_calls(users: int, seed: int, work_dir: str) -> Dict[str, Callable[[], Any]]:
+    import database
+    import db_admin
+    import db_utils
+    import leaderboard
+
+    rng = random.Random(seed)
+    user_ids = itertools.cycle([rng.randint(1, users) for _ in range(min(users, SAMPLE_USERS))])
+    distances = itertools.cycle([round(rng.uniform(0.5, 50), 1) for _ in range(SAMPLE_USERS)])
+
+    def quiet(func: Callable[[], Any]) -> Callable[[], Any]:
+        # Вывод db_admin не должен попадать в терминал и влиять на время
+        def call() -> Any:
+            with contextlib.redirect_stdout(io.StringIO()):
+                return func()
+        return call
+
+    def backup() -> None:
+        db_admin.backup_database()
+        for name in os.listdir(work_dir):
+            if name.startswith("backup_"):
+                os.remove(os.path.join(work_dir, name))
+
+    return {
+        "leaderboard.warm": leaderboard.warm,
+        "database.get_weekly_leaderboard": lambda: database.get_weekly_leaderboard(10),
+        "database.get_monthly_leaderboard": lambda: database.get_monthly_leaderboard(10),
+        "database.compute_leaderboard": lambda: database.compute_leaderboard(("week", "month", "year", "all"), "month", 10),
+        "database.get_user_stats": lambda: database.get_user_stats(next(user_ids)),
+        "database.get_dashboard": lambda: database.get_dashboard(next(user_ids)),
+        "db_utils.determine_rank_db": lambda: db_utils.determine_rank_db(next(distances)),
+        "database.get_users_db": database.get_users_db,
+        "db_admin.list_users": quiet(db_admin.list_users),
+        "db_admin.backup_database": quiet(backup),
+        "database.add_run": lambda: database.add_run(next(user_ids), next(distances)),
+    }
+
+def _measure_child(template: str, users: int, options: Dict[str, Any], queue: multiprocessing.Queue) -> None:
+    work_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(work_dir, "running_bot.db")
+        shutil.copyfile(template, path)
+        os.chdir(work_dir)
+
+        import db_admin
+        import db_connection
+        db_connection.configure(path)
+        db_admin.DB_PATH = path
+
+        calls = build_calls(users, options["seed"], work_dir)
+        measured = {}
+        for name in options["functions"]:
+            measured[name] = measure(calls[name], options["repeat"], options["sample_time"], options["max_time"])
+        db_connection.close_all()
+        queue.put((measured, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+    finally:
+        shutil.rmtree(work_dir)
+
+def _measure_round(template: str, users: int, options: Dict[str, Any]) -> Tuple[Dict[str, Dict[str, float]], float]:
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_measure_child, args=(template, users, options, queue))
+    process.start()
+    try:
+        return queue.get()
+    finally:
+        process.join()
+
+def measure_dataset(template: str, users: int, args: argparse.Namespace) -> Tuple[Dict[str, Dict[str, float]], float]:
+    """
+    Замеры на копиях базы в --rounds отдельных процессах: медиана медиан процессов, общий
+    минимум и наибольший пиковый RSS в МБ
+    """
+    options = {
+        "seed": args.seed, "functions": args.functions, "repeat": args.repeat,
+        "sample_time": args.sample_time, "max_time": args.max_time,
+    }
+    rounds = [_measure_round(template, users, options) for _ in range(args.rounds)]
+    measured = {}
+    for name in args.functions:
+        rows = [round_measured[name] for round_measured, _ in rounds]
+        measured[name] = {
+            "median_ms": statistics.median(row["median_ms"] for row in rows),
+            "min_ms": min(row["min_ms"] for row in rows),
+            "calls": sum(row["calls"] for row in rows),
+            "samples": sum(row["samples"] for row in rows),
+        }
+    return measured, max(rss for _, rss in rounds)
+
+def format_ms(value: float) -> str:
+    return f"{value * 1000:.1f} мкс" if value < 1 else f"{value:.2f} мс"
+
+def compare(report: Dict[str, Any], baseline: Dict[str, Any], threshold: float, min_delta_ms: float) -> List[str]:
+    """
+    Печатает сравнение медиан с базовым прогоном и возвращает замедлившиеся функции. Замедлением
+    считается рост и медианы, и минимума: случайная задержка поднимает медиану, но редко минимум.
+    """
+    print(f"\nСравнение с прогоном {results.describe(baseline)} (порог {threshold:.0%}, "
+          f"не меньше {min_delta_ms} мс):")
+    regressions = []
+    print(f"{'Набор':<8} | {'Функция':<34} | {'было':>12} | {'стало':>12} | {'изм.':>6} |")
+    for label, functions in report["results"].items():
+        before_functions = baseline["results"].get(label, {})
+        if label in baseline["datasets"] and baseline["datasets"][label]["runs"] != report["datasets"][label]["runs"]:
+            print(f"ВНИМАНИЕ: набор {label} в базовом прогоне другого размера")
+        for name, now in functions.items():
+            before = before_functions.get(name)
+            if before is None:
+                print(f"{label:<8} | {name:<34} | {'—':>12} | {format_ms(now['median_ms']):>12} | {'':>6} |")
+                continue
+            slower = all(
+                now[key] > before[key] * (1 + threshold) and now[key] - before[key] > min_delta_ms
+                for key in ("median_ms", "min_ms")
+            )
+            if slower:
+                regressions.append(f"{label} {name}")
+            print(f"{label:<8} | {name:<34} | {format_ms(before['median_ms']):>12} | "
+                  f"{format_ms(now['median_ms']):>12} | {results.change(now['median_ms'], before['median_ms']):>6} | "
+                  f"{'ЗАМЕДЛЕНИЕ' if slower else ''}")
+    return regressions
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Микробенчмарки функций слоя данных')
+    parser.add_argument('--sizes', type=parse_size, nargs='+', default=[parse_size("1k"), parse_size("10k")],
+                        help=f"наборы данных: {', '.join(SIZES)} или ПОЛЬЗОВАТЕЛЕЙ:ПРОБЕЖЕК")
+    parser.add_argument('--days', type=int, default=3 * 365, help='за сколько дней пробежки')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--functions', nargs='+', choices=FUNCTIONS, default=FUNCTIONS)
+    parser.add_argument('--repeat', type=int, default=7, help='серий замеров на функцию')
+    parser.add_argument('--rounds', type=int, default=3, help='процессов замеров на набор данных')
+    parser.add_argument('--sample-time', type=float, default=0.05, help='минимальная длительность серии, с')
+    parser.add_argument('--max-time', type=float, default=10.0, help='предел времени замеров функции, с')
+    parser.add_argument('--data-dir', default=os.path.join(tempfile.gettempdir(), 'bench_db_suite'))
+    parser.add_argument('--regenerate', action='store_true', help='построить базы заново')
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    parser.add_argument('--baseline', help='JSON прошлого прогона для проверки на замедление')
+    parser.add_argument('--threshold', type=float, default=0.25, help='допустимое замедление медианы')
+    parser.add_argument('--min-delta-ms', type=float, default=0.05,
+                        help='замедление меньше этого не считается (шум быстрых функций)')
+    args = parser.parse_args()
+    # Порядок из FUNCTIONS: запись идет после чтений
+    args.functions = [name for name in FUNCTIONS if name in args.functions]
+    baseline = results.load(args.baseline) if args.baseline else None
+
+    report: Dict[str, Any] = {
+        "config": {
+            "days": args.days, "seed": args.seed, "repeat": args.repeat, "rounds": args.rounds,
+            "sample_time": args.sample_time, "max_time": args.max_time,
+        },
+        "environment": results.environment(),
+        "datasets": {},
+        "results": {},
+    }
+    for label, users, runs in args.sizes:
+        path, generated = prepare_dataset(args, users, runs)
+        size = os.path.getsize(path) / 2 ** 20
+        note = f"построена за {generated:.1f} с" if generated else "из кэша"
+        print(f"\nНабор {label}: {users} пользователей, {runs} пробежек за {args.days} дней, "
+              f"{size:.0f} МБ ({note})")
+        measured, rss = measure_dataset(path, users, args)
+        report["datasets"][label] = {
+            "users": users, "runs": runs, "days": args.days, "size_mb": size,
+            "generate_seconds": generated or None, "peak_rss_mb": rss,
+        }
+        report["results"][label] = measured
+        print(f"{'Функция':<34} | {'медиана':>12} | {'минимум':>12} | {'вызовов':>8}")
+        for name, row in measured.items():
+            print(f"{name:<34} | {format_ms(row['median_ms']):>12} | {format_ms(row['min_ms']):>12} | {row['calls']:>8}")
+        print(f"Пиковый RSS процесса замеров: {rss:.0f} МБ")
+
+    if args.output:
+        results.save(args.output, report)
+        print(f"\nРезультаты сохранены в {args.output}")
+    if baseline is not None:
+        regressions = compare(report, baseline, args.threshold, args.min_delta_ms)
+        if regressions:
+            print(f"\nЗамедлились: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\nЗамедлений нет")
+
+if __name__ == "__main__":
+    main()
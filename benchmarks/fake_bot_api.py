@@ -0,0 +1,151 @@
+"""
+Локальный сервер, изображающий Telegram Bot API, для бенчмарков отправки сообщений.
+
+Отвечает на getMe, sendMessage, getUpdates (длинный опрос по очереди обновлений,
+добавленных через push_update) и setWebhook/deleteWebhook (по адресу /bot<токен>/<метод>,
+как ожидает aiogram с TelegramAPIServer.from_base), добавляет задержку ответа и воспроизводит
+ограничения Telegram: при превышении общей скорости или скорости в один чат
+возвращает 429 с parameters.retry_after, для чатов из blocked — 403.
+Считает принятые сообщения по чатам, чтобы проверять отсутствие дублей.
+
+Запуск отдельно: python -m benchmarks.fake_bot_api [--port 8081]
+"""
+import argparse
+import asyncio
+import time
+from collections import Counter, deque
+from typing import Any, Callable, Collection, Deque, Dict, List, Optional
+
+from aiohttp import web
+
+class FakeBotAPI:
+    def __init__(self, latency: float = 0.02, global_limit: int = 30, per_chat_limit: int = 1,
+                 retry_after: int = 1, blocked: Collection[int] = ()) -> None:
+        self.latency = latency
+        self.global_limit = global_limit
+        self.per_chat_limit = per_chat_limit
+        self.retry_after = retry_after
+        self.blocked = set(blocked)
+        # Принятые сообщения по чатам и число ответов 429
+        self.delivered: Counter = Counter()
+        self.flood_errors = 0
+        self._recent: Deque[float] = deque()
+        self._chat_recent: Dict[int, Deque[float]] = {}
+        self._message_id = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+        # Вызывается для каждого принятого сообщения: on_send(chat_id, text)
+        self.on_send: Optional[Callable[[int, str], None]] = None
+        self._updates: List[Dict[str, Any]] = []
+        self._updates_ready = asyncio.Event()
+
+    def push_update(self, update: Dict[str, Any]) -> None:
+        """Добавляет обновление, которое получит бот через getUpdates"""
+        self._updates.append(update)
+        self._updates_ready.set()
+
+    async def _get_updates(self, data: Any) -> web.Response:
+        offset = int(data.get("offset") or 0)
+        limit = int(data.get("limit") or 100)
+        timeout = float(data.get("timeout") or 0)
+        self._updates = [update for update in self._updates if update["update_id"] >= offset]
+        if not self._updates and timeout:
+            self._updates_ready.clear()
+            try:
+                await asyncio.wait_for(self._updates_ready.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return web.json_response({"ok": True, "result": self._updates[:limit]})
+
+    def _error(self, code: int, description: str, **parameters: Any) -> web.Response:
+        body: Dict[str, Any] = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    def _over_limit(self, window: Deque[float], limit: int, now: float) -> bool:
+        # Скользящее окно в одну секунду
+        while window and now - window[0] >= 1.0:
+            window.popleft()
+        if len(window) >= limit:
+            return True
+        window.append(now)
+        return False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if method == "getUpdates":
+            return await self._get_updates(data)
+        if method in ("setWebhook", "deleteWebhook"):
+            return web.json_response({"ok": True, "result": True})
+        if method == "getMe":
+            return web.json_response({"ok": True, "result": {
+                "id": 123, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot",
+            }})
+        if method != "sendMessage":
+            return self._error(404, "Not Found: method not found")
+
+        chat_id = int(data["chat_id"])
+        if chat_id in self.blocked:
+            return self._error(403, "Forbidden: bot was blocked by the user")
+
+        now = time.monotonic()
+        chat_window = self._chat_recent.setdefault(chat_id, deque())
+        if (self._over_limit(chat_window, self.per_chat_limit, now)
+                or self._over_limit(self._recent, self.global_limit, now)):
+            self.flood_errors += 1
+            return self._error(
+                429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after
+            )
+
+        self.delivered[chat_id] += 1
+        if self.on_send is not None:
+            self.on_send(chat_id, data.get("text", ""))
+        self._message_id += 1
+        return web.json_response({"ok": True, "result": {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "text": data.get("text", ""),
+        }})
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер и возвращает его базовый адрес"""
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_port = self._runner.addresses[0][1]
+        self.url = f"http://{host}:{bound_port}"
+        return self.url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+async def serve(port: int, **options: Any) -> None:
+    api = FakeBotAPI(**options)
+    url = await api.start(port=port)
+    print(f"Fake Bot API: {url}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Локальный сервер Bot API для бенчмарков')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--global-limit', type=int, default=30)
+    args = parser.parse_args()
+    asyncio.run(serve(args.port, latency=args.latency, global_limit=args.global_limit))
+
+if __name__ == "__main__":
+    main()
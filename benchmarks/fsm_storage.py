@@ -0,0 +1,117 @@
+"""
+Хранилище состояний диалогов: MemoryStorage против fsm_storage.SQLiteStorage.
+
+Каждый из --users пользователей нажимает «Записать пробежку»; доля --abandon из них уходит,
+не введя дистанцию, остальные вводят ее и состояние очищается. Перед каждым действием
+состояние читается, как это делает FSMContextMiddleware на любом обновлении.
+Для обоих хранилищ выводятся скорость и память, занятая состояниями (tracemalloc).
+Затем SQLiteStorage закрывается и открывается заново, как при перезапуске бота, и проверяется,
+что все брошенные состояния сохранились; в конце проверяется удаление истекших состояний.
+
+Запуск: python -m benchmarks.fsm_storage [--users 100000] [--abandon 0.3]
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from typing import List, Tuple
+
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+import async_db
+import fsm_storage
+from benchmarks import datagen
+from db_connection import get_connection
+
+WAITING = "RunStates:waiting_for_distance"
+
+def make_key(user_id: int) -> StorageKey:
+    return StorageKey(bot_id=1, chat_id=user_id, user_id=user_id)
+
+async def simulate(storage: BaseStorage, users: int, abandoned: List[int]) -> float:
+    abandoned_set = set(abandoned)
+    start = time.perf_counter()
+    for user_id in range(1, users + 1):
+        key = make_key(user_id)
+        await storage.get_state(key)
+        await storage.set_state(key, WAITING)
+        if user_id not in abandoned_set:
+            await storage.get_state(key)
+            # state.clear()
+            await storage.set_state(key, None)
+            await storage.set_data(key, {})
+    return time.perf_counter() - start
+
+async def measure(storage: BaseStorage, users: int, abandoned: List[int]) -> Tuple[float, int]:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    elapsed = await simulate(storage, users, abandoned)
+    if isinstance(storage, fsm_storage.SQLiteStorage):
+        await storage.flush()
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return elapsed, used
+
+async def run(args: argparse.Namespace) -> None:
+    rng = random.Random(1)
+    abandoned = sorted(rng.sample(range(1, args.users + 1), int(args.users * args.abandon)))
+    operations = args.users * 2 + (args.users - len(abandoned)) * 3
+
+    print(f"{args.users} пользователей, брошенных вводов {len(abandoned)}, кэш {args.cache_size}")
+    print(f"{'Хранилище':<14} | {'операций/с':>11} | {'память, МБ':>10}")
+    memory = MemoryStorage()
+    elapsed, used = await measure(memory, args.users, abandoned)
+    print(f"{'MemoryStorage':<14} | {operations / elapsed:>11.0f} | {used / 2 ** 20:>10.1f}")
+
+    storage = fsm_storage.SQLiteStorage(cache_size=args.cache_size)
+    elapsed, used = await measure(storage, args.users, abandoned)
+    stats = storage.stats()
+    print(f"{'SQLiteStorage':<14} | {operations / elapsed:>11.0f} | {used / 2 ** 20:>10.1f}")
+    print(f"  в кэше {stats['cached']}, попаданий {stats['hit_ratio']:.1%}, "
+          f"записано строк {stats['rows_written']} за {stats['batches']} транзакций")
+    await storage.close()
+
+    # Перезапуск: новое хранилище видит только то, что записано в базу
+    storage = fsm_storage.SQLiteStorage(cache_size=args.cache_size)
+    restored = 0
+    for user_id in range(1, args.users + 1):
+        if await storage.get_state(make_key(user_id)) == WAITING:
+            restored += 1
+    assert restored == len(abandoned), f"после перезапуска найдено {restored} из {len(abandoned)} состояний"
+    rows = await async_db.run_db(lambda: get_connection().execute("SELECT COUNT(*) FROM fsm_states").fetchone()[0])
+    print(f"После перезапуска найдены все {restored} брошенных вводов, строк в fsm_states: {rows}")
+    await storage.close()
+
+    # Истечение: состояния, не менявшиеся ttl секунд, удаляет фоновая очистка
+    storage = fsm_storage.SQLiteStorage(ttl=0.2, cache_size=args.cache_size)
+    for user_id in abandoned[:1000]:
+        await storage.set_state(make_key(user_id), WAITING)
+    await storage.flush()
+    await asyncio.sleep(0.3)
+    assert await storage.get_state(make_key(abandoned[0])) is None, "истекшее состояние вернулось"
+    removed = await storage.sweep()
+    print(f"Очистка удалила {removed} истекших состояний")
+    await storage.close()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарк хранилища состояний диалогов')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--abandon', type=float, default=0.3, help='доля пользователей, не введших дистанцию')
+    parser.add_argument('--cache-size', type=int, default=fsm_storage.DEFAULT_CACHE_SIZE)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    datagen.generate(os.path.join(tmp_dir, 'fsm_storage.db'), 10, 10)
+    try:
+        asyncio.run(run(args))
+    finally:
+        async_db.shutdown()
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Бенчмарк задержки обработчиков при параллельных обновлениях.
+
+Сравнивает прямой вызов синхронных функций БД из корутин (как было раньше)
+с вызовами через async_db, пока в фоне выполняется тяжелый запрос таблицы лидеров.
+
+Запуск: python -m benchmarks.handler_latency --users 20000 --runs 400000
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+from typing import List
+
+import async_db
+import database
+import ranks
+from benchmarks import datagen
+
+def percentile(values: List[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+async def stats_handler_sync(user_id: int) -> None:
+    # Так обработчик /stats работал до перехода на async_db
+    if database.has_runs_this_week(user_id):
+        stats = database.get_user_stats(user_id)
+        ranks.determine_rank(stats["weekly_distance"])
+        ranks.calculate_progress(stats["weekly_distance"])
+
+async def stats_handler_async(user_id: int) -> None:
+    if await async_db.has_runs_this_week(user_id):
+        stats = await async_db.get_user_stats(user_id)
+        await async_db.determine_rank(stats["weekly_distance"])
+        await async_db.calculate_progress(stats["weekly_distance"])
+
+async def heavy_sync(stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        database.get_weekly_leaderboard(10 ** 6)
+        await asyncio.sleep(0)
+
+async def heavy_async(stop: asyncio.Event) -> None:
+    while not stop.is_set():
+        await async_db.get_weekly_leaderboard(10 ** 6)
+
+async def run_mode(mode: str, users: int, updates: int, interval: float, heavy: bool) -> List[float]:
+    handler = stats_handler_async if mode == 'async' else stats_handler_sync
+    rng = random.Random(1)
+    stop = asyncio.Event()
+    heavy_task = None
+    if heavy:
+        heavy_task = asyncio.create_task(heavy_async(stop) if mode == 'async' else heavy_sync(stop))
+        await asyncio.sleep(0.05)
+
+    latencies: List[float] = []
+
+    async def one_update(user_id: int, arrived: float) -> None:
+        await handler(user_id)
+        latencies.append(time.perf_counter() - arrived)
+
+    tasks = []
+    # Обновления поступают с фиксированным интервалом, как при опросе Telegram
+    next_arrival = time.perf_counter()
+    for _ in range(updates):
+        next_arrival += interval
+        delay = next_arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(one_update(rng.randint(1, users), next_arrival)))
+    await asyncio.gather(*tasks)
+
+    stop.set()
+    if heavy_task:
+        await heavy_task
+    return latencies
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Задержка обработчиков при тяжелом запросе в фоне')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--runs', type=int, default=400000)
+    parser.add_argument('--updates', type=int, default=500)
+    parser.add_argument('--interval', type=float, default=0.002, help='Интервал между обновлениями, с')
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'bench_handlers.db'))
+    args = parser.parse_args()
+
+    datagen.generate(args.db, args.users, args.runs, days=60)
+
+    print(f"{'Режим':<8} | {'Фон':<8} | {'p50, мс':>9} | {'p99, мс':>9} | {'max, мс':>9}")
+    for mode in ('sync', 'async'):
+        for heavy in (False, True):
+            latencies = asyncio.run(run_mode(mode, args.users, args.updates, args.interval, heavy))
+            async_db.shutdown()
+            print(
+                f"{mode:<8} | {'тяжелый' if heavy else 'нет':<8} | "
+                f"{statistics.median(latencies) * 1000:>9.2f} | "
+                f"{percentile(latencies, 99) * 1000:>9.2f} | {max(latencies) * 1000:>9.2f}"
+            )
+
+if __name__ == "__main__":
+    main()
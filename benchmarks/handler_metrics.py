@@ -0,0 +1,92 @@
+"""
+Метрики обработчиков: накладные расходы и вывод db_admin.py profile.
+
+Настоящий диспетчер из bot.py обрабатывает смесь команд (--updates обновлений, последовательно),
+отвечая через локальный сервер Bot API (benchmarks.fake_bot_api) с задержкой --latency.
+Сначала сбор метрик выключен, затем включен (metrics.enable()), и сравнивается среднее время
+обработки обновления. Затем поднимается сервер метрик, проверяется, что ответ разбирается
+как текст Prometheus, и печатается отчет db_admin.py profile по этим метрикам.
+
+Запуск: python -m benchmarks.handler_metrics [--updates 2000] [--users 1000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import Update
+
+from benchmarks import datagen
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.webhook_load import make_update
+
+COMMANDS = ["/stats", "/leaderboard", "/challenge", "/help", "/run 5.2", "/start"]
+
+async def feed(dp, bot: Bot, args: argparse.Namespace, seed: int) -> float:
+    rng = random.Random(seed)
+    start = time.perf_counter()
+    for i in range(args.updates):
+        update = make_update(i + 1, rng.randint(1, args.users), rng.choice(COMMANDS))
+        await dp.feed_update(bot, Update.model_validate(update, context={"bot": bot}))
+    return (time.perf_counter() - start) / args.updates
+
+async def run(args: argparse.Namespace) -> None:
+    import bot as bot_module
+    import db_admin
+    import metrics
+    import outbox
+
+    api = FakeBotAPI(latency=args.latency, global_limit=10 ** 9, per_chat_limit=10 ** 9)
+    url = await api.start()
+    bot = Bot(token="123:ABC", session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    outbox.install(bot, rate=10 ** 6, per_chat_rate=10 ** 6, per_chat_burst=10 ** 6)
+    bot.session.middleware(metrics.ApiMetricsMiddleware())
+    runner = None
+    try:
+        # Прогрев: соединения, кэши, таблица лидеров
+        await feed(bot_module.dp, bot, argparse.Namespace(updates=200, users=args.users), seed=0)
+        disabled = await feed(bot_module.dp, bot, args, seed=1)
+        metrics.enable()
+        enabled = await feed(bot_module.dp, bot, args, seed=1)
+        print(f"Среднее время обновления: без метрик {disabled * 1000:.2f} мс, "
+              f"с метриками {enabled * 1000:.2f} мс ({(enabled - disabled) * 1e6:+.0f} мкс на обновление)")
+
+        runner = await metrics.serve("127.0.0.1", 0)
+        metrics_url = f"http://127.0.0.1:{runner.addresses[0][1]}/metrics"
+        text = await asyncio.to_thread(lambda: db_admin.urllib.request.urlopen(metrics_url).read().decode())
+        samples = db_admin.parse_metrics(text)
+        handled = sum(value for name, labels, value in samples if name == "bot_handler_seconds_count")
+        assert handled == args.updates, f"учтено {handled} вызовов обработчиков из {args.updates}"
+        print(f"/metrics: {len(text.splitlines())} строк, {len(samples)} значений, "
+              f"учтены все {handled:.0f} вызовов обработчиков")
+        await asyncio.to_thread(db_admin.show_profile, metrics_url, args.top)
+    finally:
+        if runner is not None:
+            await runner.cleanup()
+        await bot.session.close()
+        await api.stop()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарк метрик обработчиков')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа Bot API, с')
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args()
+
+    os.environ.setdefault("BOT_TOKEN", "123:ABC")
+    tmp_dir = tempfile.mkdtemp()
+    datagen.generate(os.path.join(tmp_dir, 'handler_metrics.db'), args.users, args.users * 20, days=60)
+    try:
+        asyncio.run(run(args))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Время импорта точек входа (python -X importtime) и запуска базы через bootstrap.
+
+Каждая точка входа импортируется в отдельном процессе из пустого временного каталога без
+BOT_TOKEN: импорт не должен требовать токена и не должен создавать файл базы. Для каждой
+точки входа выводится медиана суммарного времени импорта по -X importtime, время процесса
+целиком и пакеты, на которые ушло больше всего времени. Модули слоя данных (DATA_LAYER)
+не должны импортировать aiogram и aiohttp, иначе бенчмарк завершается с ошибкой.
+
+Затем на синтетической базе сравнивается загрузка кэшей bootstrap.warm_caches по очереди
+и параллельно.
+
+Запуск: python -m benchmarks.import_time [--repeat 5] [--users 20000] [--runs 1000000]
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, NamedTuple, Tuple
+
+from benchmarks import results
+
+# Точки входа и модули, которые импортируют скрипты администрирования и тесты
+ENTRY_POINTS = [
+    "bot", "supervisor", "db_admin", "view_db", "migrate_db",
+    "bootstrap", "database", "async_db", "metrics", "config",
+]
+# Слой данных: импортируется без aiogram и aiohttp
+DATA_LAYER = {"db_admin", "view_db", "migrate_db", "bootstrap", "database", "async_db", "metrics", "config"}
+FORBIDDEN_PACKAGES = ("aiogram", "aiohttp")
+
+class ImportProfile(NamedTuple):
+    total_us: int
+    wall_seconds: float
+    # Собственное время импорта по пакетам верхнего уровня, мкс
+    packages: Dict[str, int]
+
+def parse_importtime(stderr: str, module: str) -> Tuple[int, Dict[str, int]]:
+    """
+    Разбирает вывод -X importtime: суммарное время импорта module и собственное время по пакетам
+    """
+    total = 0
+    packages: Dict[str, int] = defaultdict(int)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        packages[name.strip().split(".")[0]] += int(self_us)
+        if name.strip() == module and not name.startswith("  "):
+            total = int(cumulative_us)
+    return total, dict(packages)
+
+def profile_import(module: str, cwd: str) -> ImportProfile:
+    env = {key: value for key, value in os.environ.items() if key != "BOT_TOKEN"}
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [results.ROOT, env.get("PYTHONPATH")]))
+    # Без кэша байт-кода в каталоге проекта замер показывал бы компиляцию, а не импорт
+    env.pop("PYTHONDONTWRITEBYTECODE", None)
+    start = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=cwd, env=env, capture_output=True, text=True
+    )
+    wall = time.perf_counter() - start
+    if completed.returncode != 0:
+        error = completed.stderr.strip().splitlines()[-1] if completed.stderr.strip() else "нет вывода"
+        raise RuntimeError(f"import {module} завершился с кодом {completed.returncode}: {error}")
+    total, packages = parse_importtime(completed.stderr, module)
+    return ImportProfile(total, wall, packages)
+
+def measure_imports(modules: List[str], repeat: int, top: int) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """Медианы времени импорта; второй элемент — найденные нарушения"""
+    rows = []
+    problems = []
+    for module in modules:
+        cwd = tempfile.mkdtemp()
+        try:
+            # Первый запуск не учитывается: он может компилировать .pyc
+            profile_import(module, cwd)
+            profiles = [profile_import(module, cwd) for _ in range(repeat)]
+            created = os.listdir(cwd)
+        finally:
+            shutil.rmtree(cwd)
+        packages = profiles[-1].packages
+        heaviest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+        row = {
+            "module": module,
+            "import_ms": statistics.median(p.total_us for p in profiles) / 1000,
+            "process_ms": statistics.median(p.wall_seconds for p in profiles) * 1000,
+            "heaviest": [(name, us / 1000) for name, us in heaviest],
+            "aiogram": "aiogram" in packages,
+        }
+        rows.append(row)
+        if created:
+            problems.append(f"import {module} создал файлы: {', '.join(created)}")
+        loaded = [name for name in FORBIDDEN_PACKAGES if name in packages]
+        if module in DATA_LAYER and loaded:
+            problems.append(f"import {module} импортирует {', '.join(loaded)}")
+    return rows, problems
+
+def measure_warm(path: str, repeat: int) -> Dict[str, Dict[str, float]]:
+    """Медианы времени загрузки кэшей по очереди и параллельно"""
+    import bootstrap
+    import catalogs
+    import db_connection
+    import ranks
+
+    db_connection.configure(path)
+    start = time.perf_counter()
+    bootstrap.init_db()
+    first_init = time.perf_counter() - start
+    start = time.perf_counter()
+    bootstrap.init_db()
+    second_init = time.perf_counter() - start
+    print(f"\nbootstrap.init_db: первый вызов {first_init * 1000:.1f} мс, повторный {second_init * 1e6:.0f} мкс")
+
+    samples: Dict[str, List[float]] = defaultdict(list)
+    for _ in range(repeat):
+        for mode, parallel in (("serial", False), ("parallel", True)):
+            ranks.invalidate()
+            catalogs.invalidate()
+            start = time.perf_counter()
+            timings = bootstrap.warm_caches(parallel)
+            samples[f"{mode}.total"].append(time.perf_counter() - start)
+            for name, seconds in timings.items():
+                samples[f"{mode}.{name}"].append(seconds)
+    db_connection.close_all()
+
+    medians = {key: statistics.median(values) * 1000 for key, values in samples.items()}
+    report: Dict[str, Dict[str, float]] = defaultdict(dict)
+    for key, ms in medians.items():
+        mode, name = key.split(".", 1)
+        report[mode][name] = ms
+    print(f"{'Кэш':<12} | {'по очереди, мс':>15} | {'параллельно, мс':>16}")
+    for name in report["serial"]:
+        print(f"{name:<12} | {report['serial'][name]:>15.1f} | {report['parallel'][name]:>16.1f}")
+    return dict(report)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Время импорта точек входа и запуска базы')
+    parser.add_argument('--modules', nargs='+', default=ENTRY_POINTS, help='модули для замера импорта')
+    parser.add_argument('--repeat', type=int, default=5, help='запусков на модуль (берется медиана)')
+    parser.add_argument('--top', type=int, default=3, help='сколько самых тяжелых пакетов показать')
+    parser.add_argument('--users', type=int, default=20000)
+    parser.add_argument('--runs', type=int, default=1000000)
+    parser.add_argument('--skip-warm', action='store_true', help='не замерять загрузку кэшей')
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    args = parser.parse_args()
+
+    rows, problems = measure_imports(args.modules, args.repeat, args.top)
+    print(f"{'Модуль':<12} | {'импорт, мс':>10} | {'процесс, мс':>11} | {'aiogram':>7} | Самые тяжелые пакеты")
+    for row in rows:
+        heaviest = ", ".join(f"{name} {ms:.0f}" for name, ms in row["heaviest"])
+        print(f"{row['module']:<12} | {row['import_ms']:>10.1f} | {row['process_ms']:>11.1f} | "
+              f"{'да' if row['aiogram'] else 'нет':>7} | {heaviest}")
+
+    warm = None
+    if not args.skip_warm:
+        from benchmarks import datagen
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'import_time.db')
+            print(f"\nГенерация базы: {args.users} пользователей, {args.runs} пробежек...")
+            datagen.generate(path, args.users, args.runs)
+            warm = measure_warm(path, args.repeat)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    if args.output:
+        results.save(args.output, {
+            "environment": results.environment(),
+            "imports": rows,
+            "warm_caches": warm,
+        })
+    for problem in problems:
+        print(f"ОШИБКА: {problem}")
+    if problems:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Кэш готовой таблицы лидеров.
+
+На синтетической базе сравнивает сборку текста таблицы на каждый запрос (как раньше делал
+cmd_leaderboard) с кэшем leaderboard_cache, затем чередует запросы таблицы с записью пробежек
+случайных пользователей и проверяет, что кэш каждый раз отдает тот же текст, что и сборка
+заново. В конце удаляет лидера недели отдельным соединением (как db_admin.py) и проверяет,
+что после ttl таблица перестает его показывать.
+
+Запуск: python -m benchmarks.leaderboard_cache [--users 10000] [--runs 200000]
+"""
+import argparse
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import time
+
+import database
+import leaderboard
+import leaderboard_cache
+import rollups
+import table_versions
+from benchmarks import datagen
+from messages import format_leaderboard
+
+def render_uncached() -> str:
+    return format_leaderboard(database.get_weekly_leaderboard(10), database.get_monthly_leaderboard(10))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарк кэша таблицы лидеров')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=200000)
+    parser.add_argument('--requests', type=int, default=20000)
+    parser.add_argument('--writes-per-request', type=float, default=1.0,
+                        help='сколько пробежек в среднем записывается между запросами таблицы')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(tmp_dir, 'leaderboard_cache.db')
+    datagen.generate(db_path, args.users, args.runs, days=60)
+    leaderboard.warm()
+    cache = leaderboard_cache.LeaderboardCache(ttl=3600)
+
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        render_uncached()
+    uncached = (time.perf_counter() - start) / args.requests
+
+    cache.get()
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        cache.get()
+    cached = (time.perf_counter() - start) / args.requests
+    print(f"Сборка на каждый запрос: {uncached * 1e6:.1f} мкс, из кэша: {cached * 1e6:.2f} мкс "
+          f"({uncached / cached:.0f}x)")
+
+    # Смешанная нагрузка: запись пробежек между запросами, сверка с пересборкой
+    rng = random.Random(7)
+    cache = leaderboard_cache.LeaderboardCache(ttl=3600)
+    writes = 0
+    for _ in range(args.requests // 10):
+        while rng.random() < args.writes_per_request / (1 + args.writes_per_request):
+            database.add_run(rng.randint(1, args.users), round(rng.uniform(1, 25), 1))
+            writes += 1
+        assert cache.get().text == render_uncached(), "кэш отдал устаревшую таблицу"
+    stats = cache.stats()
+    print(f"Чередование с записью ({writes} пробежек): попаданий {stats['hit_ratio']:.1%}, "
+          f"сбросов по изменению топа {stats['invalidations']}; текст всегда совпадал с пересборкой")
+
+    # Удаление лидера вне процесса бота
+    cache = leaderboard_cache.LeaderboardCache(ttl=0.2)
+    leader = cache.get().weekly[0]
+    conn = sqlite3.connect(db_path)
+    conn.execute("DELETE FROM runs WHERE user_id = ?", (leader["user_id"],))
+    rollups.delete_user(conn.cursor(), leader["user_id"])
+    table_versions.bump(conn.cursor(), table_versions.LEADERBOARD)
+    conn.commit()
+    conn.close()
+    time.sleep(0.25)
+    assert cache.get().weekly[0]["user_id"] != leader["user_id"], "удаленный лидер остался в таблице"
+    print(f"Лидер {leader['username']} удален отдельным соединением: исчез из таблицы после ttl "
+          f"(сбросов по времени {cache.stats()['expirations']})")
+
+    shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
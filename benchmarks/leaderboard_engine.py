@@ -0,0 +1,95 @@
+"""
+Бенчмарк многооконной таблицы лидеров.
+
+Сравнивает прежнюю реализацию get_monthly_leaderboard (отдельный запрос недельной суммы
+и определение ранга для каждого лидера) с compute_leaderboard, который считает все окна
+одним запросом с условными суммами и определяет ранги пакетно.
+
+Запуск: python -m benchmarks.leaderboard_engine --users 10000 --runs 1000000
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+from typing import Any, Callable, Dict, List
+
+import database
+from db_connection import get_connection
+from db_utils import determine_rank_db
+from benchmarks import datagen
+
+def legacy_monthly_leaderboard(limit: int = 10) -> List[Dict[str, Any]]:
+    # Реализация до перехода на compute_leaderboard: N+1 запросов недельной суммы и ранга
+    cursor = get_connection().cursor()
+    start_of_month, end_of_month = database.get_month_range()
+    cursor.execute("""
+        SELECT u.user_id, u.username, SUM(r.distance) as monthly_distance
+        FROM users u
+        JOIN runs r ON u.user_id = r.user_id
+        WHERE r.run_day BETWEEN ? AND ?
+        GROUP BY u.user_id, u.username
+        ORDER BY monthly_distance DESC
+        LIMIT ?
+    """, (start_of_month.toordinal(), end_of_month.toordinal(), limit))
+
+    leaderboard = []
+    for user_id, username, monthly_distance in cursor.fetchall():
+        start_of_week, end_of_week = database.get_week_range()
+        cursor.execute("""
+            SELECT SUM(distance)
+            FROM runs
+            WHERE user_id = ? AND run_day BETWEEN ? AND ?
+        """, (user_id, start_of_week.toordinal(), end_of_week.toordinal()))
+        weekly_distance = cursor.fetchone()[0] or 0
+        leaderboard.append({
+            "user_id": user_id,
+            "username": username if username else f"Бегун #{user_id}",
+            "weekly_distance": weekly_distance,
+            "monthly_distance": monthly_distance,
+            "rank": determine_rank_db(weekly_distance)
+        })
+    cursor.close()
+    return leaderboard
+
+def measure(func: Callable[[], Any], repeat: int) -> List[float]:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return timings
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Сравнение реализаций месячной таблицы лидеров')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--runs', type=int, default=1000000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--db', default=os.path.join(tempfile.gettempdir(), 'bench_leaderboard.db'))
+    args = parser.parse_args()
+
+    print(f"Генерация данных: {args.users} пользователей, {args.runs} пробежек...")
+    datagen.generate(args.db, args.users, args.runs, days=args.days)
+
+    # Результаты обеих реализаций должны совпадать по дистанциям
+    legacy = legacy_monthly_leaderboard(100)
+    engine = database.compute_leaderboard(("week", "month"), "month", 100)
+    assert [round(row["monthly_distance"], 6) for row in legacy] == \
+        [round(row["monthly_distance"], 6) for row in engine]
+
+    cases = []
+    for limit in (10, 100, 1000):
+        cases.append((f"legacy, limit={limit}", lambda limit=limit: legacy_monthly_leaderboard(limit)))
+        cases.append((f"engine week+month, limit={limit}",
+                      lambda limit=limit: database.compute_leaderboard(("week", "month"), "month", limit)))
+    cases.append(("engine week+month+year+all, limit=10",
+                  lambda: database.compute_leaderboard(("week", "month", "year", "all"), "year", 10)))
+
+    print(f"{'Вариант':<40} | {'медиана, мс':>12} | {'мин, мс':>10}")
+    for title, func in cases:
+        timings = measure(func, args.repeat)
+        print(f"{title:<40} | {statistics.median(timings) * 1000:>12.2f} | {min(timings) * 1000:>10.2f}")
+
+if __name__ == "__main__":
+    main()
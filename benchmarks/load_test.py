@@ -0,0 +1,388 @@
+"""
+Нагрузочный тест бота на синтетической смеси обновлений.
+
+Настоящие диспетчер и обработчики из bot.py (фильтры команд и кнопок, FSM, кэши, очередь
+записи пробежек) работают с синтетической базой (--users пользователей, --runs пробежек)
+и получают обновления через getUpdates локального сервера Bot API (benchmarks.fake_bot_api),
+которому и отправляют ответы. Запуск повторяет bot.main: прогрев таблицы лидеров, кэши,
+фоновая запись пробежек.
+
+Сценарий из --updates обновлений строится детерминированно по --seed: смесь команд
+(/start, /run 7.4, /stats, /leaderboard, /challenge, /help), кнопок клавиатуры, ввода
+дистанции после кнопки «Записать пробежку» и непонятных сообщений с долями из MIX (их можно
+переопределить: --mix cmd_stats=40 button_run=0). Обновления поступают с частотой --rate
+в секунду; у пользователя не больше одного обновления в обработке — следующее он отправляет,
+получив ответ на предыдущее, поэтому каждый ответ относится к известному обработчику.
+
+Выводятся пропускная способность, по обработчикам — задержка p50/p95/p99 (от getUpdates
+до ответа бота) и SQL-запросов на вызов, а также ожидание блокировки записи SQLite
+(db_connection.lock_wait_stats). По метрикам обработчиков сверяется, что сработали именно
+те обработчики, которые предполагает сценарий.
+С --output результаты и параметры сохраняются в JSON; с --compare печатается сравнение
+с сохраненным ранее прогоном (например, предыдущего релиза). Отпечаток сценария показывает,
+что сравниваются одинаковые нагрузки; синтетическая база строится от текущей даты, поэтому
+сравнивать стоит прогоны одного дня на одной машине. Медиана между прогонами одной версии
+отличается на единицы процентов, хвосты (p95, p99) на загруженной машине — до десятков.
+
+Запуск: python -m benchmarks.load_test [--updates 5000] [--rate 150] [--output run.json]
+        [--compare previous.json]
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, List, NamedTuple, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import db_connection
+from benchmarks import datagen, results
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.webhook_load import make_update
+
+# Доли обработчиков в сценарии; за button_run всегда следует process_distance
+MIX = {
+    "cmd_stats": 16,
+    "cmd_run": 12,
+    "cmd_leaderboard": 10,
+    "cmd_challenge": 6,
+    "cmd_help": 3,
+    "cmd_start": 3,
+    "button_stats": 14,
+    "button_leaderboard": 10,
+    "button_challenge": 5,
+    "button_help": 2,
+    "button_run": 8,
+    "unknown_message": 3,
+}
+
+BUTTONS = {
+    "button_stats": "📊 Статистика",
+    "button_leaderboard": "🏆 Таблица лидеров",
+    "button_challenge": "🎯 Задания",
+    "button_help": "❓ Помощь",
+    "button_run": "🏃‍♂️ Записать пробежку",
+}
+COMMANDS = {
+    "cmd_start": "/start",
+    "cmd_stats": "/stats",
+    "cmd_leaderboard": "/leaderboard",
+    "cmd_challenge": "/challenge",
+    "cmd_help": "/help",
+}
+UNKNOWN_TEXTS = ["привет", "сколько я пробежал?", "/unknown", "5 км"]
+
+class Step(NamedTuple):
+    user_id: int
+    handler: str
+    text: str
+
+def build_workload(seed: int, updates: int, users: int, mix: Dict[str, int]) -> List[Step]:
+    """Сценарий из updates обновлений; одинаков при одинаковых параметрах"""
+    rng = random.Random(seed)
+    handlers = [name for name, weight in mix.items() if weight > 0]
+    weights = [mix[name] for name in handlers]
+    steps: List[Step] = []
+    while len(steps) < updates:
+        user_id = rng.randint(1, users)
+        handler = rng.choices(handlers, weights)[0]
+        distance = round(rng.uniform(1, 25), 1)
+        if handler == "cmd_run":
+            steps.append(Step(user_id, handler, f"/run {distance}"))
+        elif handler == "button_run":
+            # Двухшаговый диалог: кнопка переводит в состояние ожидания дистанции
+            steps.append(Step(user_id, handler, BUTTONS[handler]))
+            steps.append(Step(user_id, "process_distance", str(distance).replace(".", rng.choice(".,"))))
+        elif handler in BUTTONS:
+            steps.append(Step(user_id, handler, BUTTONS[handler]))
+        elif handler in COMMANDS:
+            steps.append(Step(user_id, handler, COMMANDS[handler]))
+        else:
+            steps.append(Step(user_id, handler, rng.choice(UNKNOWN_TEXTS)))
+    return steps[:updates]
+
+def fingerprint(steps: List[Step]) -> str:
+    digest = hashlib.sha256()
+    for step in steps:
+        digest.update(f"{step.user_id}\t{step.handler}\t{step.text}\n".encode())
+    return digest.hexdigest()[:16]
+
+def percentile(ordered: List[float], share: float) -> float:
+    return ordered[min(len(ordered) - 1, int(len(ordered) * share))]
+
+def summarize(latencies: List[float]) -> Dict[str, float]:
+    ordered = sorted(latencies)
+    return {
+        "count": len(ordered),
+        "mean_ms": sum(ordered) / len(ordered) * 1000,
+        "p50_ms": percentile(ordered, 0.50) * 1000,
+        "p95_ms": percentile(ordered, 0.95) * 1000,
+        "p99_ms": percentile(ordered, 0.99) * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+class Driver:
+    """
+    Отправляет шаги сценария через getUpdates и сопоставляет ответы бота с обработчиками.
+    Шаг пользователя, у которого есть неотвеченное обновление, ждет ответа на него.
+    """
+
+    def __init__(self, api: FakeBotAPI, steps: List[Step], first_update_id: int) -> None:
+        self.api = api
+        self.steps = steps
+        self.next_update_id = first_update_id
+        self.in_flight: Dict[int, Tuple[str, float]] = {}
+        self.waiting: Dict[int, Deque[Step]] = defaultdict(deque)
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.replied = 0
+        self.unexpected = 0
+        self.last_reply = 0.0
+        self.done = asyncio.Event()
+        api.on_send = self.on_send
+
+    def send(self, step: Step) -> None:
+        self.in_flight[step.user_id] = (step.handler, time.perf_counter())
+        self.api.push_update(make_update(self.next_update_id, step.user_id, step.text))
+        self.next_update_id += 1
+
+    def on_send(self, chat_id: int, text: str) -> None:
+        current = self.in_flight.pop(chat_id, None)
+        if current is None:
+            self.unexpected += 1
+            return
+        handler, sent = current
+        self.last_reply = time.perf_counter()
+        self.latencies[handler].append(self.last_reply - sent)
+        self.replied += 1
+        if self.waiting[chat_id]:
+            self.send(self.waiting[chat_id].popleft())
+        if self.replied >= len(self.steps):
+            self.done.set()
+
+    async def run(self, rate: float, timeout: float) -> float:
+        """Отправляет сценарий с частотой rate и возвращает время до последнего ответа"""
+        start = time.perf_counter()
+        for index, step in enumerate(self.steps):
+            delay = start + index / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if step.user_id in self.in_flight or self.waiting[step.user_id]:
+                self.waiting[step.user_id].append(step)
+            else:
+                self.send(step)
+        await asyncio.wait_for(self.done.wait(), timeout=timeout)
+        return self.last_reply - start
+
+async def run_load(args: argparse.Namespace, mix: Dict[str, int]) -> Dict[str, Any]:
+    import async_db
+    import bootstrap
+    import bot as bot_module
+    import catalogs
+    import database
+    import leaderboard_cache
+    import metrics
+    import outbox
+    import write_queue
+    from config import (
+        LEADERBOARD_CACHE_TTL, USER_CACHE_SIZE, CATALOG_NO_REPEAT_WINDOW, WRITE_FLUSH_INTERVAL_MS, WRITE_BATCH_SIZE,
+        METRICS_ENABLED
+    )
+
+    logging.getLogger().setLevel(args.log_level)
+    random.seed(args.seed)
+    api = FakeBotAPI(latency=args.latency, global_limit=10 ** 9, per_chat_limit=10 ** 9)
+    url = await api.start()
+    bot = Bot(token="123:ABC", session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    # Ограничения Telegram в тесте не нужны, но путь отправки тот же, что у бота
+    outbox.install(bot, rate=10 ** 6, per_chat_rate=10 ** 6, per_chat_burst=10 ** 6)
+    dp = bot_module.dp
+
+    # Та же подготовка, что в bot.main (кроме сервера метрик)
+    if METRICS_ENABLED:
+        metrics.enable()
+    database.configure_user_cache(USER_CACHE_SIZE)
+    catalogs.configure(CATALOG_NO_REPEAT_WINDOW, USER_CACHE_SIZE)
+    bootstrap.start()
+    leaderboard_cache.configure(LEADERBOARD_CACHE_TTL)
+    write_queue.start(WRITE_FLUSH_INTERVAL_MS / 1000, WRITE_BATCH_SIZE)
+    polling_task = asyncio.create_task(dp.start_polling(
+        bot, handle_signals=False, close_bot_session=False, tasks_concurrency_limit=args.concurrency
+    ))
+    try:
+        await asyncio.sleep(0.2)
+        # Прогрев соединений и кэшей другим сценарием, в результаты не входит
+        warmup = build_workload(args.seed + 1, args.warmup, args.users, mix)
+        await Driver(api, warmup, 1).run(args.rate, args.timeout)
+
+        steps = build_workload(args.seed, args.updates, args.users, mix)
+        db_connection.reset_lock_wait_stats()
+        before = handler_calls(metrics.registry)
+        driver = Driver(api, steps, args.warmup + 1)
+        elapsed = await driver.run(args.rate, args.timeout)
+        lock_waits = db_connection.lock_wait_stats()
+        after = handler_calls(metrics.registry)
+    finally:
+        await dp.stop_polling()
+        await polling_task
+        write_queue.stop()
+        await bot_module.storage.close()
+        async_db.shutdown()
+        await bot.session.close()
+        await api.stop()
+
+    handlers = {name: summarize(latencies) for name, latencies in sorted(driver.latencies.items())}
+    for name, row in handlers.items():
+        calls, queries, errors = (now - then for now, then in zip(after.get(name, (0, 0, 0)), before.get(name, (0, 0, 0))))
+        if METRICS_ENABLED:
+            # Ответ засчитан обработчику по сценарию; метрики показывают, какой обработчик сработал
+            row["handled"] = calls
+            row["queries"] = queries / calls if calls else 0.0
+            row["errors"] = errors
+    everything = [latency for latencies in driver.latencies.values() for latency in latencies]
+    return {
+        "workload": {
+            "fingerprint": fingerprint(steps),
+            "updates": len(steps),
+            "handlers": {name: sum(1 for step in steps if step.handler == name) for name in sorted(driver.latencies)},
+        },
+        "results": {
+            "elapsed_seconds": elapsed,
+            "throughput": len(steps) / elapsed,
+            "unexpected_replies": driver.unexpected,
+            "overall": summarize(everything),
+            "handlers": handlers,
+            "lock_waits": lock_waits,
+        },
+    }
+
+def handler_calls(registry: Any) -> Dict[str, Tuple[int, float, int]]:
+    """Вызовы, SQL-запросы и ошибки по обработчикам из метрик"""
+    with registry._lock:
+        return {
+            name: (histogram.count, registry.handler_queries[name].sum, registry.handler_errors.get(name, 0))
+            for name, histogram in registry.handler_seconds.items()
+        }
+
+def parse_mix(overrides: List[str]) -> Dict[str, int]:
+    mix = dict(MIX)
+    for item in overrides:
+        name, _, weight = item.partition("=")
+        if name not in MIX or not weight.isdigit():
+            raise SystemExit(f"Неверная доля {item!r}: нужно ИМЯ=ЧИСЛО, имена: {', '.join(MIX)}")
+        mix[name] = int(weight)
+    if not any(mix.values()):
+        raise SystemExit("Все доли смеси нулевые")
+    return mix
+
+def print_report(report: Dict[str, Any]) -> None:
+    summary = report["results"]
+    print(f"{'Обработчик':<18} | {'обновлений':>10} | {'среднее, мс':>11} | {'p50, мс':>8} | "
+          f"{'p95, мс':>8} | {'p99, мс':>8} | {'макс, мс':>8} | {'SQL':>5}")
+    rows = list(summary["handlers"].items()) + [("всего", summary["overall"])]
+    for name, row in rows:
+        queries = f"{row['queries']:>5.1f}" if "queries" in row else f"{'':>5}"
+        print(f"{name:<18} | {row['count']:>10} | {row['mean_ms']:>11.1f} | {row['p50_ms']:>8.1f} | "
+              f"{row['p95_ms']:>8.1f} | {row['p99_ms']:>8.1f} | {row['max_ms']:>8.1f} | {queries}")
+    mismatched = [name for name, row in summary["handlers"].items()
+                  if "handled" in row and (row["handled"] != row["count"] or row["errors"])]
+    if mismatched:
+        print(f"Сработали не те обработчики или с ошибками: {', '.join(mismatched)}")
+    waits = summary["lock_waits"]
+    print(f"Пропускная способность: {summary['throughput']:.0f} обновлений/с за {summary['elapsed_seconds']:.1f} с")
+    print(f"Блокировка записи SQLite: транзакций {waits['transactions']}, с ожиданием {waits['waits']} "
+          f"({waits['wait_ratio']:.1%}), всего {waits['wait_seconds'] * 1000:.0f} мс, "
+          f"максимум {waits['max_wait_seconds'] * 1000:.1f} мс")
+    if summary["unexpected_replies"]:
+        print(f"Ответов без ожидавшего их обновления: {summary['unexpected_replies']}")
+
+def print_comparison(report: Dict[str, Any], previous: Dict[str, Any]) -> None:
+    """Сравнение с сохраненным прогоном: изменение p50 и p95 по обработчикам"""
+    print(f"\nСравнение с прогоном {results.describe(previous)}:")
+    if previous["workload"]["fingerprint"] != report["workload"]["fingerprint"]:
+        print("ВНИМАНИЕ: сценарии различаются (другие --seed, --updates, --users или --mix)")
+    if previous["config"] != report["config"]:
+        changed = sorted(key for key in report["config"] if report["config"][key] != previous["config"].get(key))
+        print(f"ВНИМАНИЕ: отличаются параметры: {', '.join(changed)}")
+    change = results.change
+
+    print(f"{'Обработчик':<18} | {'p50, мс':>15} | {'изм.':>5} | {'p95, мс':>15} | {'изм.':>5}")
+    now_rows = dict(report["results"]["handlers"], всего=report["results"]["overall"])
+    before_rows = dict(previous["results"]["handlers"], всего=previous["results"]["overall"])
+    for name, now in now_rows.items():
+        before = before_rows.get(name)
+        if before is None:
+            print(f"{name:<18} | {'нет в прошлом прогоне':>41}")
+            continue
+        print(f"{name:<18} | {before['p50_ms']:>6.1f} → {now['p50_ms']:>6.1f} | {change(now['p50_ms'], before['p50_ms']):>5} | "
+              f"{before['p95_ms']:>6.1f} → {now['p95_ms']:>6.1f} | {change(now['p95_ms'], before['p95_ms']):>5}")
+    throughput, before_throughput = report["results"]["throughput"], previous["results"]["throughput"]
+    print(f"Пропускная способность: {before_throughput:.0f} → {throughput:.0f} обновлений/с "
+          f"({change(throughput, before_throughput)})")
+    waits, before_waits = report["results"]["lock_waits"], previous["results"]["lock_waits"]
+    print(f"Ожидание блокировки записи: {before_waits['wait_seconds'] * 1000:.0f} → "
+          f"{waits['wait_seconds'] * 1000:.0f} мс")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Нагрузочный тест бота на смеси обновлений')
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--warmup', type=int, default=500, help='обновлений прогрева, не входят в результаты')
+    parser.add_argument('--rate', type=float, default=150.0, help='обновлений в секунду')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--runs', type=int, default=40000, help='пробежек в синтетической базе')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mix', nargs='*', default=[], metavar='ИМЯ=ДОЛЯ', help='доли обработчиков в смеси')
+    parser.add_argument('--concurrency', type=int, default=64, help='обновлений в обработке одновременно')
+    parser.add_argument('--latency', type=float, default=0.02, help='задержка ответа Bot API, с')
+    parser.add_argument('--timeout', type=float, default=300.0, help='сколько ждать ответов, с')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--output', help='сохранить результаты в JSON')
+    parser.add_argument('--compare', help='JSON прошлого прогона для сравнения')
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+    previous = None
+    if args.compare:
+        previous = results.load(args.compare)
+
+    os.environ.setdefault("BOT_TOKEN", "123:ABC")
+    tmp_dir = tempfile.mkdtemp()
+    datagen.generate(os.path.join(tmp_dir, 'load_test.db'), args.users, args.runs, seed=args.seed)
+    print(f"{args.updates} обновлений от {args.users} пользователей с частотой {args.rate:.0f}/с, "
+          f"задержка Bot API {args.latency * 1000:.0f} мс, одновременно {args.concurrency}")
+    try:
+        report = asyncio.run(run_load(args, mix))
+    finally:
+        db_connection.close_all()
+        shutil.rmtree(tmp_dir)
+
+    report = {
+        "config": {
+            "updates": args.updates, "warmup": args.warmup, "rate": args.rate, "users": args.users,
+            "runs": args.runs, "seed": args.seed, "mix": mix, "concurrency": args.concurrency,
+            "latency": args.latency,
+        },
+        "environment": results.environment(),
+        **report,
+    }
+    print(f"Сценарий {report['workload']['fingerprint']}")
+    print_report(report)
+    if previous is not None:
+        print_comparison(report, previous)
+    if args.output:
+        results.save(args.output, report)
+        print(f"Результаты сохранены в {args.output}")
+    if report["results"]["unexpected_replies"] or any(
+            "handled" in row and (row["handled"] != row["count"] or row["errors"])
+            for row in report["results"]["handlers"].values()):
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Всплеск ответов пользователям на фоне рассылки: прямые отправки против очереди outbox.
+
+Локальный сервер Bot API (benchmarks.fake_bot_api) отвечает 429, если превышена общая
+скорость или скорость в один чат. Сначала запускается рассылка (--bulk сообщений разным
+чатам), через секунду приходит всплеск ответов (--interactive сообщений по --per-chat
+в чат). Без очереди все сообщения отправляются сразу и часть получает TelegramRetryAfter;
+с очередью ответы обгоняют рассылку, а retry_after обрабатывается одной общей паузой.
+Для каждого режима выводятся задержки ответов, число 429 и неотправленных сообщений.
+
+Запуск: python -m benchmarks.outbox_spike [--bulk 600] [--interactive 200]
+"""
+import argparse
+import asyncio
+import time
+from typing import List, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+
+import outbox
+from benchmarks.fake_bot_api import FakeBotAPI
+
+async def timed_send(bot: Bot, chat_id: int, level: int, latencies: List[float]) -> bool:
+    start = time.perf_counter()
+    try:
+        with outbox.priority(level):
+            await bot.send_message(chat_id, "Тест")
+    except Exception:
+        return False
+    latencies.append(time.perf_counter() - start)
+    return True
+
+async def run_mode(args: argparse.Namespace, use_outbox: bool) -> Tuple[List[float], int, int, int]:
+    api = FakeBotAPI(latency=args.latency, global_limit=args.global_limit, per_chat_limit=args.per_chat)
+    url = await api.start()
+    bot = Bot(token="123:ABC", session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    if use_outbox:
+        outbox.install(bot, rate=args.global_limit * 0.9, per_chat_burst=args.per_chat)
+
+    bulk_latencies: List[float] = []
+    interactive_latencies: List[float] = []
+    try:
+        bulk = [
+            asyncio.create_task(timed_send(bot, 100000 + i, outbox.BULK, bulk_latencies))
+            for i in range(args.bulk)
+        ]
+        await asyncio.sleep(1.0)
+        chats = args.interactive // args.per_chat
+        interactive = [
+            asyncio.create_task(timed_send(bot, i % chats + 1, outbox.INTERACTIVE, interactive_latencies))
+            for i in range(args.interactive)
+        ]
+        results = await asyncio.gather(*bulk, *interactive)
+    finally:
+        await bot.session.close()
+        await api.stop()
+    return sorted(interactive_latencies), api.flood_errors, results.count(False), len(bulk_latencies)
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарк очереди исходящих сообщений')
+    parser.add_argument('--bulk', type=int, default=600)
+    parser.add_argument('--interactive', type=int, default=200)
+    parser.add_argument('--per-chat', type=int, default=2, help='сообщений подряд в один чат (и допустимый всплеск)')
+    parser.add_argument('--global-limit', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0.02)
+    args = parser.parse_args()
+
+    print(f"Рассылка {args.bulk} сообщений, всплеск {args.interactive} ответов, "
+          f"лимит сервера {args.global_limit}/с")
+    print(f"{'Режим':<16} | {'ответы p50, с':>13} | {'p95, с':>7} | {'429':>5} | {'не отправлено':>13} | {'рассылка':>8}")
+    for title, use_outbox in (("напрямую", False), ("через outbox", True)):
+        latencies, flood_errors, lost, bulk_sent = asyncio.run(run_mode(args, use_outbox))
+        p50 = latencies[len(latencies) // 2] if latencies else float('nan')
+        p95 = latencies[int(len(latencies) * 0.95)] if latencies else float('nan')
+        print(f"{title:<16} | {p50:>13.2f} | {p95:>7.2f} | {flood_errors:>5} | {lost:>13} | {bulk_sent:>8}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,42 @@
+"""
+Проверка бюджета SQL-запросов для горячих функций.
+
+Выполняет функции на временной базе, считает запросы через трассировку соединения
+и завершается с ошибкой, если какая-либо функция превысила свой бюджет.
+Бюджет get_dashboard проверяет и tests/test_query_budget.py при каждом запуске тестов.
+
+Запуск: python -m benchmarks.query_budget
+"""
+import os
+import sys
+import tempfile
+from typing import Any, Callable, List, Tuple
+
+import database
+from db_connection import count_queries
+from benchmarks import datagen
+
+# (название, вызов, максимальное число запросов, включая BEGIN и COMMIT)
+BUDGETS: List[Tuple[str, Callable[[], Any], int]] = [
+    ("get_dashboard", lambda: database.get_dashboard(1), 6),
+]
+
+def main() -> None:
+    db_path = os.path.join(tempfile.gettempdir(), 'bench_query_budget.db')
+    datagen.generate(db_path, users=100, runs=2000, days=14)
+
+    failed = False
+    for name, call, budget in BUDGETS:
+        call()  # прогрев: регистрация пользователя и прочие однократные действия
+        with count_queries() as statements:
+            call()
+        status = "OK" if len(statements) <= budget else "ПРЕВЫШЕН"
+        failed = failed or len(statements) > budget
+        print(f"[{status}] {name}: {len(statements)} запросов (бюджет {budget})")
+        for sql in statements:
+            print(f"    {' '.join(sql.split())}")
+
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Пакетное определение рангов против поштучного.
+
+Сравнивает на N случайных недельных километражах (по умолчанию 1M):
+- поштучный вызов RankTable.determine / progress для каждого значения;
+- RankTable.rank_indices и resolve_many на чистом Python (bisect);
+- то же через numpy.searchsorted, если NumPy установлен.
+Результаты всех способов сверяются между собой.
+
+Запуск: python -m benchmarks.rank_batch [--count 1000000]
+"""
+import argparse
+import random
+import time
+from typing import Any, Callable, Tuple
+
+import ranks
+from ranks import RankTable
+from benchmarks.datagen import DEFAULT_RANKS
+
+def timed(func: Callable[[], Any]) -> Tuple[Any, float]:
+    start = time.perf_counter()
+    result = func()
+    return result, time.perf_counter() - start
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарк пакетного определения рангов')
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # Часть значений попадает в промежутки между рангами (например, 10.5 км)
+    distances = [round(rng.uniform(0, 120), 1) for _ in range(args.count)]
+    table = RankTable(DEFAULT_RANKS)
+
+    print(f"{args.count} километражей, {len(table)} рангов")
+    print(f"{'Способ':<34} | {'Время, с':>9} | {'нс на значение':>14}")
+
+    def report(title: str, seconds: float) -> None:
+        print(f"{title:<34} | {seconds:>9.3f} | {seconds / args.count * 1e9:>14.0f}")
+
+    scalar_names, seconds = timed(lambda: [table.determine(km) for km in distances])
+    report("determine() по одному", seconds)
+    scalar_progress, seconds = timed(lambda: [table.progress(km) for km in distances])
+    report("progress() по одному", seconds)
+
+    indices, seconds = timed(lambda: table.rank_indices(distances, use_numpy=False))
+    report("rank_indices, bisect", seconds)
+    batch, seconds = timed(lambda: table.resolve_many(distances, use_numpy=False))
+    report("resolve_many, bisect", seconds)
+    assert [table.names[index] for index in indices] == scalar_names
+    assert list(zip(batch.names, batch.next_names, batch.km_needed)) == scalar_progress
+
+    if ranks.np is None:
+        print("NumPy не установлен, векторизованный вариант пропущен")
+        return
+
+    array = ranks.np.asarray(distances)
+    np_indices, seconds = timed(lambda: table.rank_indices(array))
+    report("rank_indices, numpy.searchsorted", seconds)
+    np_batch, seconds = timed(lambda: table.resolve_many(array))
+    report("resolve_many, numpy.searchsorted", seconds)
+    assert np_indices.tolist() == list(indices)
+    assert np_batch.names == batch.names and np_batch.next_names == batch.next_names
+    assert all(
+        (a is None and b is None) or abs(a - b) < 1e-9
+        for a, b in zip(np_batch.km_needed, batch.km_needed)
+    )
+
+if __name__ == "__main__":
+    main()
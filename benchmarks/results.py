@@ -0,0 +1,46 @@
+import json
+import os
+import platform
+import subprocess
+from datetime import date
+from typing import Any, Dict, Optional
+
+# Результаты бенчмарков в JSON: сохраняются вместе с окружением прогона (версия кода, машина),
+# чтобы их можно было сравнивать между релизами
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def git_revision() -> Optional[str]:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    return result.stdout.strip() or None
+
+def environment() -> Dict[str, Any]:
+    return {
+        "revision": git_revision(),
+        "date": date.today().isoformat(),
+        "python": platform.python_version(),
+        "sqlite": __import__("sqlite3").sqlite_version,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+def save(path: str, report: Dict[str, Any]) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+def load(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+def describe(report: Dict[str, Any]) -> str:
+    """Подпись прогона для сравнения: версия кода и дата"""
+    env = report["environment"]
+    return f"{env.get('revision') or 'без версии'} от {env['date']}"
+
+def change(now: float, before: float) -> str:
+    """Относительное изменение, например +12%"""
+    return f"{(now - before) / before:+.0%}" if before else "—"
@@ -0,0 +1,216 @@
+"""
+Импорт истории пробежек: поштучная запись против run_import, память на больших файлах.
+
+Генерируются выгрузки CSV (в духе Garmin Connect, с долей не беговых тренировок), GPX (треки
+по --points точек) и FIT (сообщения record и session) размером --megabytes каждая, а также
+их уменьшенные в 10 раз копии. Каждый импорт выполняется в отдельном процессе, и выводится
+его пиковый RSS: если разбор потоковый, он почти не зависит от размера файла.
+Повторный импорт того же файла не должен добавить ни одной пробежки.
+
+Для сравнения первые --baseline тренировок из CSV записываются так, как это делает add_run:
+одна транзакция на пробежку с обновлением агрегатов. В конце агрегаты и общий километраж
+пользователей сверяются с пересчетом по таблице runs.
+
+Запуск: python -m benchmarks.run_import [--megabytes 100] [--baseline 20000]
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import resource
+import shutil
+import struct
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Tuple
+
+import db_connection
+import rollups
+import run_import
+from benchmarks import datagen
+from db_connection import get_connection, transaction
+
+FIRST_DAY = date(2015, 1, 1)
+FIT_EPOCH = datetime(1989, 12, 31, tzinfo=timezone.utc)
+
+def write_csv(path: str, megabytes: float, rng: random.Random) -> Tuple[int, float]:
+    """Возвращает число беговых тренировок и их дистанцию"""
+    runs, total = 0, 0.0
+    limit = megabytes * 2 ** 20
+    span = (date.today() - FIRST_DAY).days
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        f.write("Activity Type,Date,Favorite,Title,Distance,Calories,Time\n")
+        while f.tell() < limit:
+            started = datetime.combine(FIRST_DAY + timedelta(days=rng.randrange(span)), datetime.min.time())
+            started += timedelta(seconds=rng.randrange(5 * 3600, 22 * 3600))
+            distance = round(rng.uniform(2, 25), 2)
+            if rng.random() < 0.1:
+                f.write(f"Cycling,{started:%Y-%m-%d %H:%M:%S},false,Велосипед,{distance * 3:.2f},600,01:10:00\n")
+                continue
+            f.write(f"Running,{started:%Y-%m-%d %H:%M:%S},false,Пробежка,{distance:.2f},{int(distance * 60)},00:45:00\n")
+            runs += 1
+            total += distance
+    return runs, total
+
+def write_gpx(path: str, megabytes: float, points: int, rng: random.Random) -> int:
+    limit = megabytes * 2 ** 20
+    tracks = 0
+    with open(path, "w", encoding="utf-8") as f:
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<gpx version="1.1" creator="benchmark" xmlns="http://www.topografix.com/GPX/1/1">\n')
+        moment = datetime(2016, 1, 1, 6, tzinfo=timezone.utc)
+        while f.tell() < limit:
+            tracks += 1
+            moment += timedelta(days=1)
+            lat, lon = 55.75 + rng.uniform(-0.1, 0.1), 37.61 + rng.uniform(-0.1, 0.1)
+            f.write(f"<trk><name>Пробежка {tracks}</name><type>running</type><trkseg>\n")
+            for i in range(points):
+                lat += rng.uniform(-0.0001, 0.0001)
+                lon += rng.uniform(-0.0001, 0.0001)
+                f.write(f'<trkpt lat="{lat:.7f}" lon="{lon:.7f}"><ele>150.0</ele>'
+                        f'<time>{moment + timedelta(seconds=i):%Y-%m-%dT%H:%M:%SZ}</time></trkpt>\n')
+            f.write("</trkseg></trk>\n")
+        f.write("</gpx>\n")
+    return tracks
+
+def write_fit(path: str, megabytes: float, points: int) -> int:
+    """
+    FIT-файл с тренировками по points сообщений record (время, координаты, дистанция, пульс)
+    и одному session на каждую; контрольные суммы не заполняются
+    """
+    limit = int(megabytes * 2 ** 20)
+    record_definition = struct.pack("<BBBHB", 0x40, 0, 0, 20, 5) + bytes([
+        253, 4, 0x86, 0, 4, 0x85, 1, 4, 0x85, 5, 4, 0x86, 3, 1, 0x02,
+    ])
+    session_definition = struct.pack("<BBBHB", 0x41, 0, 0, 18, 4) + bytes([
+        253, 4, 0x86, 2, 4, 0x86, 9, 4, 0x86, 5, 1, 0x00,
+    ])
+    body = bytearray(record_definition + session_definition)
+    activities = 0
+    start = int((datetime(2016, 1, 1, 6, tzinfo=timezone.utc) - FIT_EPOCH).total_seconds())
+    with open(path, "wb") as f:
+        f.write(b"\0" * 14)
+        written = 0
+        while written + len(body) < limit:
+            activities += 1
+            start += 86400
+            for i in range(points):
+                body += struct.pack("<BIiiIB", 0x00, start + i, 664000000 + i, 448000000, i * 300, 150)
+            body += struct.pack("<BIIIB", 0x01, start + points, start, (points - 1) * 300, 1)
+            f.write(body)
+            written += len(body)
+            body = bytearray()
+        f.write(b"\0\0")
+        f.seek(0)
+        f.write(struct.pack("<BBHI4sH", 14, 0x20, 2132, written, b".FIT", 0))
+    return activities
+
+def _import_child(db_path: str, user_id: int, path: str, queue: multiprocessing.Queue) -> None:
+    db_connection.configure(db_path)
+    start = time.perf_counter()
+    result = run_import.import_file(user_id, path)
+    elapsed = time.perf_counter() - start
+    queue.put((result, elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+def import_in_process(db_path: str, user_id: int, path: str) -> Tuple[run_import.ImportResult, float, float]:
+    """Импорт в отдельном процессе: результат, время и пиковый RSS процесса в МБ"""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_import_child, args=(db_path, user_id, path, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def baseline(user_id: int, path: str, limit: int) -> float:
+    """Поштучная запись первых limit тренировок, как в add_run; возвращает пробежек в секунду"""
+    with open(path, "rb") as stream:
+        activities = [activity for _, activity in zip(range(limit), run_import.parse_csv(stream))
+                      if activity is not None]
+    start = time.perf_counter()
+    for activity in activities:
+        with transaction() as cursor:
+            cursor.execute(
+                "INSERT INTO runs (user_id, run_date, run_day, distance) VALUES (?, ?, ?, ?)",
+                (user_id, activity.day.isoformat(), rollups.day_key(activity.day), activity.distance)
+            )
+            cursor.execute("UPDATE users SET total_distance = total_distance + ? WHERE user_id = ?",
+                           (activity.distance, user_id))
+            rollups.add_run(cursor, user_id, activity.day, activity.distance)
+    return len(activities) / (time.perf_counter() - start)
+
+def check_rollups() -> int:
+    """Число расхождений агрегатов и общего километража с пересчетом по runs"""
+    def snapshot() -> Dict[Tuple[str, int, int], Tuple[float, int]]:
+        rows = {}
+        for table, key in (("weekly_totals", "week_key"), ("monthly_totals", "month_key")):
+            for user_id, period, distance, count in conn.execute(
+                    f"SELECT user_id, {key}, distance, runs_count FROM {table}"):
+                rows[(table, user_id, period)] = (round(distance, 2), count)
+        return rows
+
+    conn = get_connection()
+    stored = snapshot()
+    mismatches = conn.execute("""
+        SELECT COUNT(*) FROM users u
+        WHERE ABS(u.total_distance - (SELECT COALESCE(SUM(distance), 0) FROM runs r WHERE r.user_id = u.user_id)) > 0.01
+    """).fetchone()[0]
+    conn.execute("BEGIN")
+    try:
+        rollups.rebuild(conn.cursor())
+        rebuilt = snapshot()
+    finally:
+        conn.rollback()
+    return mismatches + sum(1 for key in stored.keys() | rebuilt.keys() if stored.get(key) != rebuilt.get(key))
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Бенчмарк импорта истории пробежек')
+    parser.add_argument('--megabytes', type=float, default=100, help='размер каждого файла выгрузки')
+    parser.add_argument('--points', type=int, default=3000, help='точек в одной тренировке GPX и FIT')
+    parser.add_argument('--baseline', type=int, default=20000, help='тренировок для поштучной записи')
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    tmp_dir = tempfile.mkdtemp()
+    db_path = os.path.join(tmp_dir, 'run_import.db')
+    datagen.generate(db_path, 1000, 20000, days=365)
+    try:
+        files = {}
+        for megabytes in (args.megabytes / 10, args.megabytes):
+            csv_path = os.path.join(tmp_dir, f"activities_{megabytes:g}.csv")
+            gpx_path = os.path.join(tmp_dir, f"tracks_{megabytes:g}.gpx")
+            fit_path = os.path.join(tmp_dir, f"activities_{megabytes:g}.fit")
+            csv_runs, _ = write_csv(csv_path, megabytes, rng)
+            files[("csv", megabytes)] = (csv_path, csv_runs)
+            files[("gpx", megabytes)] = (gpx_path, write_gpx(gpx_path, megabytes, args.points, rng))
+            files[("fit", megabytes)] = (fit_path, write_fit(fit_path, megabytes, args.points))
+
+        rate = baseline(10 ** 9, files[("csv", args.megabytes)][0], args.baseline)
+        print(f"Поштучная запись (как add_run): {rate:.0f} пробежек/с")
+
+        print(f"{'Файл':<26} | {'МБ':>5} | {'тренировок':>10} | {'добавлено':>9} | {'повторов':>8} | "
+              f"{'пробежек/с':>10} | {'МБ/с':>5} | {'пиковый RSS, МБ':>15}")
+        for user_id, ((fmt, megabytes), (path, expected)) in enumerate(sorted(files.items()), start=1):
+            size = os.path.getsize(path) / 2 ** 20
+            for attempt in ("", " (повторно)"):
+                result, elapsed, rss = import_in_process(db_path, 2 * 10 ** 9 + user_id, path)
+                print(f"{os.path.basename(path) + attempt:<26} | {size:>5.0f} | {result.parsed:>10} | "
+                      f"{result.imported:>9} | {result.duplicates:>8} | {result.parsed / elapsed:>10.0f} | "
+                      f"{size / elapsed:>5.1f} | {rss:>15.0f}")
+                if attempt:
+                    assert result.imported == 0, f"повторный импорт добавил {result.imported} пробежек"
+                else:
+                    assert result.imported + result.duplicates == expected, \
+                        f"{path}: учтено {result.imported + result.duplicates} пробежек из {expected}"
+
+        db_connection.configure(db_path)
+        mismatches = check_rollups()
+        assert mismatches == 0, f"агрегаты расходятся с пересчетом в {mismatches} местах"
+        print("Агрегаты и общий километраж совпадают с пересчетом по таблице runs")
+    finally:
+        db_connection.close_all()
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
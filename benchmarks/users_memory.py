@@ -0,0 +1,74 @@
+"""
+Бенчмарк пикового потребления памяти при обходе всех пользователей.
+
+Для каждого размера базы запускает отдельный процесс, который обходит пользователей
+либо через get_users_db (полный словарь), либо через iter_users (постранично),
+и сообщает пиковый RSS процесса.
+
+Запуск: python -m benchmarks.users_memory --sizes 1000 10000 100000
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import datagen
+
+def peak_rss_kb() -> int:
+    # ru_maxrss сохраняется при exec и включает память родителя на момент fork,
+    # поэтому в Linux берем VmHWM текущего процесса
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def child(mode: str, db_path: str) -> None:
+    import db_connection
+    db_connection.configure(db_path)
+    import database
+
+    started = time.perf_counter()
+    count = 0
+    if mode == 'eager':
+        for user_id, data in database.get_users_db().items():
+            count += 1
+    else:
+        for user_id, data in database.iter_users():
+            count += 1
+    elapsed = time.perf_counter() - started
+
+    print(f"{count} {peak_rss_kb()} {elapsed:.3f}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Пиковая память при обходе пользователей')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--runs-per-user', type=int, default=20)
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'DB'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(*args.child)
+        return
+
+    print(f"{'Пользователей':>14} | {'Режим':<8} | {'Пик RSS, МБ':>12} | {'Время, с':>9}")
+    for size in args.sizes:
+        db_path = os.path.join(tempfile.gettempdir(), f'bench_users_{size}.db')
+        datagen.generate(db_path, size, size * args.runs_per_user, days=28)
+        for mode in ('eager', 'stream'):
+            output = subprocess.run(
+                [sys.executable, '-m', 'benchmarks.users_memory', '--child', mode, db_path],
+                check=True, capture_output=True, text=True
+            ).stdout.split()
+            count, peak_kb, elapsed = int(output[0]), int(output[1]), float(output[2])
+            assert count == size
+            print(f"{size:>14} | {mode:<8} | {peak_kb / 1024:>12.1f} | {elapsed:>9.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Нагрузочный тест приема обновлений: long polling против вебхука.
+
+Настоящие диспетчер и обработчики из bot.py отвечают через локальный сервер Bot API
+(benchmarks.fake_bot_api) с задержкой ответа --latency, имитирующей путь до Telegram.
+Обновления с командой --command поступают с частотой --rate в секунду:
+- в режиме polling они попадают в очередь сервера и забираются ботом через getUpdates;
+- в режиме webhook они отправляются POST-запросами (не больше --concurrency одновременно,
+  как max_connections у Telegram) во встроенный сервер webhook.py с секретным токеном.
+Задержка считается от поступления обновления до получения сервером ответа бота.
+
+Запуск: python -m benchmarks.webhook_load [--updates 2000] [--rate 1000]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+from collections import defaultdict, deque
+from typing import Any, Deque, Dict, List, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import ClientSession, web
+
+from benchmarks import datagen
+from benchmarks.fake_bot_api import FakeBotAPI
+
+SECRET = "benchmark-secret"
+
+def make_update(update_id: int, chat_id: int, text: str) -> Dict[str, Any]:
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": {"id": chat_id, "is_bot": False, "first_name": f"Runner{chat_id}"},
+        "text": text,
+    }
+    # Текст кнопки или ввод дистанции приходят обычным сообщением, без сущности команды
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id, "message": message}
+
+class ReplyTracker:
+    """Время поступления обновлений по чатам; ответ в чат закрывает самое раннее из них"""
+
+    def __init__(self, expected: int) -> None:
+        self.pending: Dict[int, Deque[float]] = defaultdict(deque)
+        self.latencies: List[float] = []
+        self.expected = expected
+        self.done = asyncio.Event()
+
+    def arrived(self, chat_id: int) -> None:
+        self.pending[chat_id].append(time.perf_counter())
+
+    def replied(self, chat_id: int, text: str) -> None:
+        if self.pending[chat_id]:
+            self.latencies.append(time.perf_counter() - self.pending[chat_id].popleft())
+        if len(self.latencies) >= self.expected:
+            self.done.set()
+
+async def run_mode(mode: str, args: argparse.Namespace) -> Tuple[float, List[float], int]:
+    import bot as bot_module
+    import outbox
+    import webhook
+
+    api = FakeBotAPI(latency=args.latency, global_limit=10 ** 9, per_chat_limit=10 ** 9)
+    url = await api.start()
+    bot = Bot(token="123:ABC", session=AiohttpSession(api=TelegramAPIServer.from_base(url)))
+    # Ограничения Telegram в тесте не нужны, но путь отправки тот же, что у бота
+    outbox.install(bot, rate=10 ** 6, per_chat_rate=10 ** 6, per_chat_burst=10 ** 6)
+    tracker = ReplyTracker(args.updates)
+    api.on_send = tracker.replied
+    dp = bot_module.dp
+    rejected = 0
+
+    polling_task = None
+    runner = None
+    client = None
+    try:
+        if mode == "polling":
+            polling_task = asyncio.create_task(dp.start_polling(
+                bot, handle_signals=False, close_bot_session=False,
+                tasks_concurrency_limit=args.concurrency
+            ))
+        else:
+            pool = webhook.UpdatePool(dp, bot, args.concurrency)
+            pool.start()
+            runner = web.AppRunner(webhook.create_app(pool, SECRET))
+            await runner.setup()
+            site = web.TCPSite(runner, "127.0.0.1", 0)
+            await site.start()
+            endpoint = f"http://127.0.0.1:{runner.addresses[0][1]}{webhook.DEFAULT_PATH}"
+            client = ClientSession()
+            connections = asyncio.Semaphore(args.concurrency)
+        await asyncio.sleep(0.2)
+
+        async def post(update: Dict[str, Any]) -> None:
+            nonlocal rejected
+            async with connections:
+                async with client.post(endpoint, json=update,
+                                       headers={webhook.SECRET_HEADER: SECRET}) as response:
+                    if response.status != 200:
+                        rejected += 1
+
+        posts = []
+        start = time.perf_counter()
+        for i in range(args.updates):
+            # Обновления поступают равномерно с частотой args.rate
+            delay = start + i / args.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            chat_id = i % args.users + 1
+            update = make_update(i + 1, chat_id, args.command)
+            tracker.arrived(chat_id)
+            if mode == "polling":
+                api.push_update(update)
+            else:
+                posts.append(asyncio.create_task(post(update)))
+        await asyncio.gather(*posts)
+        await asyncio.wait_for(tracker.done.wait(), timeout=120)
+        elapsed = time.perf_counter() - start
+    finally:
+        if polling_task is not None:
+            await dp.stop_polling()
+            await polling_task
+        if runner is not None:
+            await client.close()
+            await runner.cleanup()
+            await pool.stop()
+        await bot.session.close()
+        await api.stop()
+    return elapsed, sorted(tracker.latencies), rejected
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Нагрузочный тест polling и webhook')
+    parser.add_argument('--updates', type=int, default=2000)
+    parser.add_argument('--rate', type=float, default=1000.0, help='обновлений в секунду')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.05, help='задержка ответа Bot API, с')
+    parser.add_argument('--command', default='/help')
+    args = parser.parse_args()
+
+    os.environ.setdefault("BOT_TOKEN", "123:ABC")
+    tmp_dir = tempfile.mkdtemp()
+    datagen.generate(os.path.join(tmp_dir, 'webhook_load.db'), args.users, args.users * 10)
+
+    print(f"{args.updates} обновлений {args.command} с частотой {args.rate:.0f}/с, "
+          f"задержка Bot API {args.latency * 1000:.0f} мс, одновременно {args.concurrency}")
+    print(f"{'Режим':<8} | {'обновлений/с':>12} | {'p50, мс':>8} | {'p95, мс':>8} | {'p99, мс':>8} | {'отклонено':>9}")
+    try:
+        for mode in ("polling", "webhook"):
+            elapsed, latencies, rejected = asyncio.run(run_mode(mode, args))
+            p50, p95, p99 = (latencies[min(len(latencies) - 1, int(len(latencies) * share))] * 1000
+                             for share in (0.5, 0.95, 0.99))
+            print(f"{mode:<8} | {args.updates / elapsed:>12.0f} | {p50:>8.1f} | {p95:>8.1f} | {p99:>8.1f} | {rejected:>9}")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+"""
+Масштабирование по процессам: supervisor.py с 1, 2, 4 воркерами на одной базе.
+
+Для каждого числа воркеров запускается supervisor.py (отдельный процесс с настоящими bot.py
+в режиме worker) на копии синтетической базы; ответы бота принимает локальный сервер Bot API
+(benchmarks.fake_bot_api). На вебхук супервизора отправляется --updates обновлений
+(смесь /stats, /run, /leaderboard, /challenge, /help от --users пользователей, не больше
+--concurrency запросов одновременно; не принятые из-за полной очереди воркера обновления
+повторяются, как это делает Telegram), и считается, сколько обновлений в секунду обработано —
+от первого запроса до последнего ответа бота. Затем каждому воркеру приходит /leaderboard,
+и проверяется, что все воркеры показывают одну и ту же таблицу, совпадающую с таблицей,
+собранной по базе: пробежки, записанные другими воркерами, учтены.
+
+Прирост близок к линейному, только если у машины не меньше ядер, чем воркеров
+(плюс процесс бенчмарка и супервизор); число ядер выводится в начале.
+
+Запуск: python -m benchmarks.worker_scaling [--workers 1 2 4] [--updates 4000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+from aiohttp import ClientError, ClientSession
+
+import db_connection
+import leaderboard
+import leaderboard_cache
+from benchmarks import datagen
+from benchmarks.fake_bot_api import FakeBotAPI
+from benchmarks.webhook_load import make_update
+
+SECRET = "benchmark-secret"
+COMMANDS = ["/stats", "/run 5.2", "/leaderboard", "/challenge", "/help"]
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+async def wait_healthy(session: ClientSession, url: str, timeout: float = 120.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return
+        except ClientError:
+            pass
+        await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} не ответил за {timeout:.0f} с")
+
+async def run_workers(workers: int, db_template: str, args: argparse.Namespace) -> Tuple[float, List[int], int, bool]:
+    import supervisor
+
+    tmp_dir = tempfile.mkdtemp()
+    shutil.copy(db_template, os.path.join(tmp_dir, 'running_bot.db'))
+    replies: Dict[int, str] = {}
+    received = 0
+    done = asyncio.Event()
+    target = args.updates
+
+    def on_send(chat_id: int, text: str) -> None:
+        nonlocal received
+        received += 1
+        replies[chat_id] = text
+        if received >= target:
+            done.set()
+
+    api = FakeBotAPI(latency=0, global_limit=10 ** 9, per_chat_limit=10 ** 9)
+    api.on_send = on_send
+    api_url = await api.start()
+    front_port = free_port()
+    front = f"http://127.0.0.1:{front_port}"
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([ROOT] + [p for p in os.environ.get("PYTHONPATH", "").split(os.pathsep) if p]),
+        BOT_TOKEN="123:ABC", BOT_API_URL=api_url, BOT_MODE="webhook", WEBHOOK_URL=front,
+        WEBHOOK_HOST="127.0.0.1", WEBHOOK_PORT=str(front_port), WEBHOOK_SECRET=SECRET,
+        WORKER_BASE_PORT=str(free_port()), METRICS_ENABLED="0", REPORTS_ENABLED="0",
+        OUTBOX_RATE="1000000", OUTBOX_PER_CHAT_RATE="1000000", OUTBOX_PER_CHAT_BURST="1000000",
+    )
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "supervisor.py"), "--workers", str(workers)],
+        cwd=tmp_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    session = ClientSession()
+    try:
+        await wait_healthy(session, front + "/health")
+        endpoint = front + "/webhook"
+        connections = asyncio.Semaphore(args.concurrency)
+        retried = 0
+
+        async def post(update: dict) -> None:
+            # Как и Telegram, повторяет обновление, которое воркер не принял из-за полной очереди
+            nonlocal retried
+            async with connections:
+                while True:
+                    async with session.post(endpoint, json=update,
+                                            headers={supervisor.webhook.SECRET_HEADER: SECRET}) as response:
+                        if response.status == 200:
+                            return
+                        assert response.status == 503, f"супервизор ответил {response.status}"
+                    retried += 1
+                    await asyncio.sleep(0.05)
+
+        rng = random.Random(workers)
+        updates = [make_update(i + 1, rng.randint(1, args.users), rng.choice(COMMANDS))
+                   for i in range(args.updates)]
+        start = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in updates))
+        await asyncio.wait_for(done.wait(), timeout=300)
+        elapsed = time.perf_counter() - start
+
+        async with session.get(front + "/health") as response:
+            health = await response.json()
+        processed = [worker["processed"] for worker in health["workers"]]
+
+        # По одному пользователю на каждого воркера запрашивает таблицу лидеров
+        await asyncio.sleep(0.5)
+        probes: Dict[int, int] = {}
+        for user_id in range(1, args.users + 1):
+            probes.setdefault(supervisor.shard_for(user_id, workers), user_id)
+        replies.clear()
+        target = received + len(probes)
+        done.clear()
+        for index, user_id in enumerate(probes.values()):
+            await post(make_update(args.updates + index + 1, user_id, "/leaderboard"))
+        await asyncio.wait_for(done.wait(), timeout=60)
+
+        db_connection.configure(os.path.join(tmp_dir, 'running_bot.db'))
+        leaderboard.warm()
+        expected = leaderboard_cache.LeaderboardCache(ttl=0).get().text
+        consistent = all(replies[user_id] == expected for user_id in probes.values())
+    finally:
+        await session.close()
+        process.send_signal(signal.SIGTERM)
+        process.wait(timeout=60)
+        await api.stop()
+        db_connection.close_all()
+        shutil.rmtree(tmp_dir)
+    return elapsed, processed, retried, consistent
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Масштабирование бота по процессам')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--updates', type=int, default=4000)
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=64)
+    args = parser.parse_args()
+
+    os.environ.setdefault("BOT_TOKEN", "123:ABC")
+    tmp_dir = tempfile.mkdtemp()
+    db_template = os.path.join(tmp_dir, 'template.db')
+    datagen.generate(db_template, args.users, args.users * 20, days=60)
+
+    print(f"Ядер процессора: {os.cpu_count()}; {args.updates} обновлений от {args.users} пользователей")
+    print(f"{'Воркеров':>8} | {'обновлений/с':>12} | {'ускорение':>9} | {'повторов':>8} | {'таблица лидеров':>15} | по воркерам")
+    baseline = None
+    try:
+        for workers in args.workers:
+            elapsed, processed, retried, consistent = asyncio.run(run_workers(workers, db_template, args))
+            rate = args.updates / elapsed
+            baseline = baseline or rate
+            print(f"{workers:>8} | {rate:>12.0f} | {rate / baseline:>8.2f}x | "
+                  f"{retried:>8} | {'совпадает' if consistent else 'РАСХОДИТСЯ':>15} | {processed}")
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+import catalogs
+import database
+import db_connection
+import leaderboard
+import ranks
+
+# Явный запуск приложения. Импорт модулей слоя данных ничего не делает с базой: таблицы и миграции
+# применяет init_db(), а кэши, нужные обработчикам с первого обновления, загружает warm_caches().
+# Так db_admin.py, бенчмарки и тесты импортируют слой данных без обращений к базе, а бот и
+# супервизор инициализируют ее один раз при запуске.
+
+_lock = threading.Lock()
+# Путь базы, для которой в этом процессе уже выполнена инициализация
+_initialized_path = None
+
+def init_db() -> bool:
+    """
+    Создает таблицы и применяет миграции, если для текущей базы (db_connection.DB_PATH)
+    это еще не сделано в этом процессе. Возвращает True, если инициализация выполнялась.
+    """
+    global _initialized_path
+    with _lock:
+        if _initialized_path == db_connection.DB_PATH:
+            return False
+        database.init_db()
+        _initialized_path = db_connection.DB_PATH
+        return True
+
+def _warm_ranks() -> None:
+    ranks.get_rank_table()
+
+def _warm_catalogs() -> None:
+    catalogs.catalog.snapshot()
+
+# Кэши, которые загружаются при запуске: таблица рангов, каталоги заданий и мотивационных
+# сообщений, таблица лидеров текущей недели и месяца
+WARMERS: List[Tuple[str, Callable[[], None]]] = [
+    ("leaderboard", leaderboard.warm),
+    ("ranks", _warm_ranks),
+    ("catalogs", _warm_catalogs),
+]
+
+def _timed(warm: Callable[[], None]) -> float:
+    start = time.perf_counter()
+    try:
+        warm()
+    finally:
+        # Соединение потока прогрева больше не понадобится
+        db_connection.release()
+    return time.perf_counter() - start
+
+def warm_caches(parallel: bool = True) -> Dict[str, float]:
+    """
+    Загружает кэши из базы, каждый в своем потоке и своем соединении (SQLite отпускает GIL
+    на время выполнения запроса, поэтому чтения идут одновременно). Возвращает время загрузки
+    каждого кэша в секундах.
+    """
+    if not parallel:
+        return {name: _timed(warm) for name, warm in WARMERS}
+    with ThreadPoolExecutor(max_workers=len(WARMERS), thread_name_prefix='warm') as executor:
+        futures = [(name, executor.submit(_timed, warm)) for name, warm in WARMERS]
+        return {name: future.result() for name, future in futures}
+
+def start() -> Dict[str, float]:
+    """
+    Инициализирует базу и прогревает кэши; вызывается ботом перед приемом обновлений
+    """
+    start_time = time.perf_counter()
+    init_db()
+    timings = warm_caches()
+    logging.info(
+        f"База готова за {time.perf_counter() - start_time:.2f} с; загрузка кэшей: "
+        + ", ".join(f"{name} {seconds:.2f} с" for name, seconds in timings.items())
+    )
+    return timings
@@ -1,39 +1,90 @@
 import asyncio
 import logging
 import datetime
+import os
+import tempfile
 from datetime import date, timedelta
 import random
+from typing import Optional
 
 from aiogram import Bot, Dispatcher, types, Router
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command, CommandStart, StateFilter
 from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 
-from config import BOT_TOKEN
-from database import (
-    init_user, add_run, get_user_stats, has_runs_this_week,
-    get_week_range, users_db, get_weekly_leaderboard, get_monthly_leaderboard
+from config import (
+    BOT_TOKEN, WRITE_FLUSH_INTERVAL_MS, WRITE_BATCH_SIZE, USER_CACHE_SIZE, CATALOG_NO_REPEAT_WINDOW,
+    LEADERBOARD_CACHE_TTL, FSM_STATE_TTL, FSM_CACHE_SIZE, FSM_FLUSH_INTERVAL_MS, FSM_SWEEP_INTERVAL,
+    REPORTS_ENABLED, REPORT_WEEKDAY, REPORT_HOUR, REPORT_WORKERS, REPORT_RATE, REPORT_PER_CHAT_RATE,
+    OUTBOX_RATE, OUTBOX_PER_CHAT_RATE, OUTBOX_PER_CHAT_BURST,
+    BOT_MODE, WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET,
+    WEBHOOK_QUEUE_SIZE, UPDATE_CONCURRENCY, METRICS_ENABLED, METRICS_HOST, METRICS_PORT,
+    BOT_API_URL, WORKER_INDEX, WORKER_COUNT, IMPORT_MAX_FILE_MB
 )
-from ranks import determine_rank, calculate_progress, get_random_challenge
+import async_db
+import bootstrap
+import broadcast
+import catalogs
+import config
+import database
+import db_connection
+import fsm_storage
+import leaderboard
+import leaderboard_cache
+import metrics
+import migrate_db
+import outbox
+import run_import
+import webhook
+import write_queue
+from database import get_week_range
 from messages import (
-    get_random_motivation, WELCOME_MESSAGE, HELP_MESSAGE,
+    WELCOME_MESSAGE, HELP_MESSAGE,
     UNKNOWN_COMMAND_MESSAGE, RUN_SUCCESS_MESSAGE,
     RUN_SUCCESS_NEXT_RANK_MESSAGE, NO_STATS_MESSAGE,
-    CHALLENGE_MESSAGE, WEEKLY_REPORT_MESSAGE
+    CHALLENGE_MESSAGE, IMPORT_STARTED_MESSAGE, IMPORT_RESULT_MESSAGE,
+    IMPORT_FAILED_MESSAGE, IMPORT_TOO_LARGE_MESSAGE
 )
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
-storage = MemoryStorage()
+# Бот создается при запуске (create_bot), поэтому импорт модуля не требует токена
+bot: Optional[Bot] = None
+bot_outbox: Optional[outbox.Outbox] = None
+
+def create_bot() -> Bot:
+    """
+    Создает бота с очередью исходящих сообщений и замером запросов к Bot API
+    """
+    global bot, bot_outbox
+    bot = Bot(
+        token=BOT_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None
+    )
+    # Все исходящие сообщения (ответы обработчиков и рассылки) проходят через общую очередь с ограничением скорости.
+    # Общий для бота лимит делится между воркерами; лимит в один чат не делится: чат обслуживает один воркер
+    bot_outbox = outbox.install(
+        bot, rate=OUTBOX_RATE / WORKER_COUNT, per_chat_rate=OUTBOX_PER_CHAT_RATE, per_chat_burst=OUTBOX_PER_CHAT_BURST
+    )
+    # Время самих запросов к Bot API, без ожидания в очереди outbox
+    bot.session.middleware(metrics.ApiMetricsMiddleware())
+    return bot
+
+# Состояния диалогов хранятся в базе и переживают перезапуск; в памяти только ограниченный кэш
+storage = fsm_storage.SQLiteStorage(
+    ttl=FSM_STATE_TTL, cache_size=FSM_CACHE_SIZE,
+    flush_interval=FSM_FLUSH_INTERVAL_MS / 1000, sweep_interval=FSM_SWEEP_INTERVAL
+)
 dp = Dispatcher(storage=storage)
 
 # Создаем основной роутер
 router = Router()
+# Задержка каждого обработчика и затраченные им SQL-запросы
+router.message.middleware(metrics.HandlerMetricsMiddleware())
 dp.include_router(router)
 
 # Определение состояний для FSM
@@ -64,7 +115,7 @@ async def cmd_start(message: Message) -> None:
     logging.info(f"Получена команда /start от пользователя {message.from_user.id}")
     user_id = message.from_user.id
     username = message.from_user.username or message.from_user.first_name
-    init_user(user_id, username)
+    await async_db.init_user(user_id, username)
     
     welcome_text = WELCOME_MESSAGE.format(name=message.from_user.first_name)
     await message.answer(welcome_text, reply_markup=get_main_keyboard())
@@ -95,10 +146,10 @@ async def cmd_run(message: Message) -> None:
 # Функция обработки добавления пробежки
 async def process_run(message: Message, user_id: int, distance: float) -> None:
     # Добавление пробежки и получение общей дистанции за неделю
-    weekly_distance = add_run(user_id, distance)
+    weekly_distance = await async_db.add_run(user_id, distance)
     
     # Определение ранга
-    rank = determine_rank(weekly_distance)
+    rank = await async_db.determine_rank(weekly_distance)
     
     # Создание ответного сообщения
     response = RUN_SUCCESS_MESSAGE.format(
@@ -108,7 +159,7 @@ async def process_run(message: Message, user_id: int, distance: float) -> None:
     )
     
     # Добавляем информацию о прогрессе к следующему рангу
-    current_rank, next_rank, km_needed = calculate_progress(weekly_distance)
+    current_rank, next_rank, km_needed = await async_db.calculate_progress(weekly_distance)
     if next_rank:
         response += RUN_SUCCESS_NEXT_RANK_MESSAGE.format(
             next_rank=next_rank,
@@ -116,57 +167,30 @@ async def process_run(message: Message, user_id: int, distance: float) -> None:
         )
     
     # Добавляем случайное мотивационное сообщение
-    motivational_msg = get_random_motivation()
+    motivational_msg = await async_db.get_random_motivation(user_id)
     response += f"\n💪 {motivational_msg}"
     
     await message.answer(response, reply_markup=get_main_keyboard())
 
-# Отправка еженедельного отчета
-async def send_weekly_report(user_id: int) -> None:
-    stats = get_user_stats(user_id)
-    
-    if not stats["weekly_runs"]:
-        return
-    
-    weekly_distance = stats["weekly_distance"]
-    rank = determine_rank(weekly_distance)
-    
-    start_date, end_date = get_week_range()
-    start_date_str = start_date.strftime('%d.%m')
-    end_date_str = end_date.strftime('%d.%m')
-    
-    # Формирование детализации по дням
-    details = ""
-    for run_date, distance in sorted(stats["weekly_runs"].items()):
-        date_obj = datetime.date.fromisoformat(run_date)
-        details += f"• {date_obj.strftime('%d.%m')}: {distance:.1f} км\n"
-    
-    report = WEEKLY_REPORT_MESSAGE.format(
-        start_date=start_date_str,
-        end_date=end_date_str,
-        weekly_distance=weekly_distance,
-        rank=rank,
-        details=details
-    )
-    
-    try:
-        await bot.send_message(user_id, report, reply_markup=get_main_keyboard())
-    except Exception as e:
-        logging.error(f"Failed to send weekly report to user {user_id}: {e}")
+# Отправка еженедельного отчета (вызывается рассылкой broadcast, которая обрабатывает ошибки)
+async def send_weekly_report(user_id: int, report: str) -> None:
+    await bot.send_message(user_id, report, reply_markup=get_main_keyboard())
 
 # Обработчик команды /stats
 @router.message(Command("stats"))
 async def cmd_stats(message: Message) -> None:
     user_id = message.from_user.id
     
-    if not has_runs_this_week(user_id):
+    # Все данные экрана статистики читаются из одного снимка базы
+    stats = await async_db.get_dashboard(user_id)
+    
+    if not stats["weekly_runs"]:
         await message.answer(NO_STATS_MESSAGE, reply_markup=get_main_keyboard())
         return
     
-    stats = get_user_stats(user_id)
     weekly_distance = stats["weekly_distance"]
     total_distance = stats["total_distance"]
-    rank = determine_rank(weekly_distance)
+    rank = stats["rank"]
     
     start_date, end_date = get_week_range()
     
@@ -178,7 +202,7 @@ async def cmd_stats(message: Message) -> None:
     )
     
     # Добавляем информацию о прогрессе к следующему рангу
-    current_rank, next_rank, km_needed = calculate_progress(weekly_distance)
+    next_rank, km_needed = stats["next_rank"], stats["km_needed"]
     if next_rank:
         response += f"До ранга \"{next_rank}\" осталось: {km_needed:.1f} км\n\n"
     
@@ -195,43 +219,22 @@ async def cmd_stats(message: Message) -> None:
 # Обработчик команды /leaderboard - таблица лидеров
 @router.message(Command("leaderboard"))
 async def cmd_leaderboard(message: Message) -> None:
-    user_id = message.from_user.id
-    
-    # Получаем списки лидеров
-    weekly_leaders = get_weekly_leaderboard(10)
-    monthly_leaders = get_monthly_leaderboard(10)
-    
-    if not weekly_leaders:
-        await message.answer("📊 Пока никто не бегал на этой неделе. Будь первым! 🏃‍♂️", reply_markup=get_main_keyboard())
-        return
-    
-    # Формируем таблицу лидеров за неделю
-    weekly_leaderboard = "🏆 Таблица лидеров за неделю:\n\n"
-    for i, leader in enumerate(weekly_leaders, 1):
-        weekly_leaderboard += f"{i}. {leader['username']}: {leader['weekly_distance']:.1f} км — {leader['rank']}\n"
-    
-    # Формируем таблицу лидеров за месяц
-    monthly_leaderboard = "\n🏆 Таблица лидеров за месяц:\n\n"
-    for i, leader in enumerate(monthly_leaders, 1):
-        monthly_leaderboard += f"{i}. {leader['username']}: {leader['monthly_distance']:.1f} км — {leader['rank']}\n"
-    
-    # Объединяем таблицы
-    response = weekly_leaderboard + monthly_leaderboard
-    
+    # Текст таблицы одинаков для всех пользователей и берется из кэша
+    response = await async_db.get_leaderboard_text()
     await message.answer(response, reply_markup=get_main_keyboard())
 
 # Обработчик команды /challenge - дополнительные задания
 @router.message(Command("challenge"))
 async def cmd_challenge(message: Message) -> None:
     user_id = message.from_user.id
-    init_user(user_id)
+    await async_db.init_user(user_id)
     
-    stats = get_user_stats(user_id)
+    stats = await async_db.get_user_stats(user_id)
     weekly_distance = stats["weekly_distance"]
-    rank = determine_rank(weekly_distance)
+    rank = await async_db.determine_rank(weekly_distance)
     
     # Получаем случайное задание для ранга пользователя
-    selected_challenge = get_random_challenge(rank)
+    selected_challenge = await async_db.get_random_challenge(rank, user_id)
     
     response = CHALLENGE_MESSAGE.format(
         rank=rank,
@@ -245,6 +248,39 @@ async def cmd_challenge(message: Message) -> None:
 async def cmd_help(message: Message) -> None:
     await message.answer(HELP_MESSAGE, reply_markup=get_main_keyboard())
 
+# Обработчик файлов выгрузки пробежек (CSV, GPX, FIT)
+@router.message(lambda message: message.document is not None)
+async def import_document(message: Message) -> None:
+    user_id = message.from_user.id
+    document = message.document
+    logging.info(f"Получен файл {document.file_name} ({document.file_size} байт) от пользователя {user_id}")
+    
+    try:
+        fmt = run_import.detect_format(document.file_name)
+    except ValueError as e:
+        await message.answer(IMPORT_FAILED_MESSAGE.format(error=e), reply_markup=get_main_keyboard())
+        return
+    if document.file_size and document.file_size > IMPORT_MAX_FILE_MB * 2 ** 20:
+        await message.answer(IMPORT_TOO_LARGE_MESSAGE.format(limit=IMPORT_MAX_FILE_MB), reply_markup=get_main_keyboard())
+        return
+    
+    await async_db.init_user(user_id, message.from_user.username or message.from_user.first_name)
+    await message.answer(IMPORT_STARTED_MESSAGE)
+    # Файл скачивается на диск частями и разбирается потоково, целиком в память он не читается
+    fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+    os.close(fd)
+    try:
+        await message.bot.download(document, destination=path)
+        result = await async_db.import_runs(user_id, path, fmt)
+    except ValueError as e:
+        await message.answer(IMPORT_FAILED_MESSAGE.format(error=e), reply_markup=get_main_keyboard())
+        return
+    finally:
+        os.unlink(path)
+    
+    logging.info(f"Импорт пользователя {user_id}: {result}")
+    await message.answer(IMPORT_RESULT_MESSAGE.format(**result._asdict()), reply_markup=get_main_keyboard())
+
 # Обработчики для кнопок
 
 # Обработчик кнопки "Статистика"
@@ -303,7 +339,80 @@ async def unknown_message(message: Message) -> None:
 # Запуск бота
 async def main() -> None:
     logging.info("Запуск бота")
-    await dp.start_polling(bot)
+    config.validate()
+    create_bot()
+    metrics_runner = None
+    if METRICS_ENABLED:
+        metrics.enable()
+        metrics.registry.register_gauges("bot_user_cache", database.get_user_cache_stats)
+        metrics.registry.register_gauges("bot_leaderboard_cache", leaderboard_cache.get_stats)
+        metrics.registry.register_gauges("bot_fsm_storage", storage.stats)
+        metrics.registry.register_gauges("bot_outbox", bot_outbox.metrics.snapshot, label="priority")
+        metrics.registry.register_gauges("bot_db_lock", db_connection.lock_wait_stats)
+        metrics_runner = await metrics.serve(METRICS_HOST, METRICS_PORT)
+        logging.info(f"Метрики доступны на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    database.configure_user_cache(USER_CACHE_SIZE)
+    catalogs.configure(CATALOG_NO_REPEAT_WINDOW, USER_CACHE_SIZE)
+    # Создаем таблицы и применяем миграции, затем параллельно загружаем таблицу рангов, каталоги
+    # и таблицу лидеров текущей недели и месяца до начала обработки обновлений
+    bootstrap.start()
+    leaderboard_cache.configure(LEADERBOARD_CACHE_TTL)
+    write_queue.start(WRITE_FLUSH_INTERVAL_MS / 1000, WRITE_BATCH_SIZE)
+    if WORKER_COUNT > 1:
+        # Пробежки и сбросы таблицы лидеров от других воркеров учитываются фоном
+        leaderboard.start_follower()
+    # Номера дней старых пробежек заполняются в фоне небольшими пачками, бот при этом работает
+    if WORKER_INDEX == 0 and migrate_db.start_backfill() is not None:
+        logging.info("Запущено фоновое заполнение runs.run_day")
+    # Еженедельные отчеты рассылаются по расписанию внутри процесса бота (из нескольких воркеров — первым)
+    reports_task = None
+    if REPORTS_ENABLED and WORKER_INDEX == 0:
+        reports_task = asyncio.create_task(broadcast.run_scheduler(
+            send_weekly_report, REPORT_WEEKDAY, REPORT_HOUR,
+            workers=REPORT_WORKERS, rate=REPORT_RATE, per_chat_rate=REPORT_PER_CHAT_RATE
+        ))
+    try:
+        if BOT_MODE in ("webhook", "worker"):
+            # Воркер принимает обновления от supervisor.py и не регистрирует вебхук сам
+            await webhook.run(
+                dp, bot, WEBHOOK_URL if BOT_MODE == "webhook" else "", WEBHOOK_HOST, WEBHOOK_PORT,
+                WEBHOOK_PATH, WEBHOOK_SECRET, concurrency=UPDATE_CONCURRENCY, queue_size=WEBHOOK_QUEUE_SIZE
+            )
+        else:
+            # Пока у бота зарегистрирован вебхук, Telegram не отдает обновления через getUpdates
+            await bot.delete_webhook()
+            await dp.start_polling(bot, tasks_concurrency_limit=UPDATE_CONCURRENCY)
+    finally:
+        # Прерванная рассылка продолжится после перезапуска по журналу report_deliveries
+        if reports_task is not None:
+            reports_task.cancel()
+            try:
+                await reports_task
+            except asyncio.CancelledError:
+                pass
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        # Сначала фиксируем все принятые пробежки, затем останавливаем пул потоков БД
+        write_queue.stop()
+        leaderboard.stop_follower()
+        async_db.shutdown()
+        
+        bot_outbox.log_stats()
+        cache_stats = database.get_user_cache_stats()
+        logging.info(
+            f"Кэш пользователей: попаданий {cache_stats['hit_ratio']:.1%}, "
+            f"записей в БД {cache_stats['db_writes']}, сэкономлено записей {cache_stats['writes_avoided']}"
+        )
+        fsm_stats = storage.stats()
+        logging.info(
+            f"Состояния диалогов: в кэше {fsm_stats['cached']}, попаданий {fsm_stats['hit_ratio']:.1%}, "
+            f"записано {fsm_stats['rows_written']} за {fsm_stats['batches']} транзакций, истекло {fsm_stats['expired']}"
+        )
+        board_stats = leaderboard_cache.get_stats()
+        logging.info(
+            f"Кэш таблицы лидеров: попаданий {board_stats['hit_ratio']:.1%}, "
+            f"сбросов по изменению топа {board_stats['invalidations']}, по времени {board_stats['expirations']}"
+        )
 
 if __name__ == "__main__":
     asyncio.run(main()) 
\ No newline at end of file
@@ -0,0 +1,318 @@
+import asyncio
+import logging
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Awaitable, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+)
+
+import async_db
+import outbox
+import ranks
+import rollups
+from db_connection import get_connection, transaction
+from messages import format_weekly_report
+from rate_limit import KeyedTokenBuckets, TokenBucket
+
+# Рассылка еженедельных отчетов: пользователи, бегавшие на неделе, читаются из базы
+# страницами по возрастанию user_id, отчеты отправляются пулом воркеров с общим
+# и отдельным для каждого чата ограничением скорости. Каждая отправка
+# записывается в report_deliveries, поэтому после перезапуска рассылка продолжается
+# с того же места и никому не приходит второй отчет.
+
+# Статусы в report_deliveries
+SENDING = "sending"   # отправка начата; если процесс упал, исход неизвестен и повтора не будет
+SENT = "sent"
+BLOCKED = "blocked"   # пользователь заблокировал бота
+FAILED = "failed"
+
+# Значения по умолчанию (Telegram допускает около 30 сообщений в секунду и 1 в секунду в один чат)
+DEFAULT_RATE = 25.0
+DEFAULT_PER_CHAT_RATE = 1.0
+DEFAULT_WORKERS = 8
+DEFAULT_PAGE_SIZE = 500
+MAX_ATTEMPTS = 3
+
+# Если бот был выключен в момент рассылки, она догоняется при запуске в течение этого времени
+CATCH_UP_WINDOW = timedelta(hours=24)
+
+class Report(NamedTuple):
+    user_id: int
+    text: str
+
+class BroadcastStats:
+    """Итоги рассылки"""
+
+    def __init__(self) -> None:
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.retry_after = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+
+    @property
+    def rate(self) -> float:
+        return self.sent / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "sent": self.sent,
+            "blocked": self.blocked,
+            "failed": self.failed,
+            "retry_after": self.retry_after,
+            "elapsed": self.elapsed,
+            "rate": self.rate,
+        }
+
+def week_dates(week: int) -> Tuple[date, date]:
+    """Понедельник и воскресенье недели по ключу ГГГГНН"""
+    start = date.fromisocalendar(week // 100, week % 100, 1)
+    return start, start + timedelta(days=6)
+
+# Синхронные функции работы с журналом рассылки (выполняются в пуле потоков БД)
+
+def begin_broadcast(week: int) -> bool:
+    """
+    Отмечает начало рассылки за неделю. Возвращает False, если она уже завершена.
+    Отправки, прерванные падением процесса, помечаются как неудачные без повтора.
+    """
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT OR IGNORE INTO report_broadcasts (week_key, started_at) VALUES (?, ?)",
+            (week, datetime.now().isoformat(timespec='seconds'))
+        )
+        cursor.execute("SELECT finished_at FROM report_broadcasts WHERE week_key = ?", (week,))
+        if cursor.fetchone()[0] is not None:
+            return False
+        cursor.execute(
+            "UPDATE report_deliveries SET status = ? WHERE week_key = ? AND status = ?",
+            (FAILED, week, SENDING)
+        )
+    return True
+
+def finish_broadcast(week: int) -> None:
+    with transaction() as cursor:
+        cursor.execute(
+            "UPDATE report_broadcasts SET finished_at = ? WHERE week_key = ?",
+            (datetime.now().isoformat(timespec='seconds'), week)
+        )
+
+def is_finished(week: int) -> bool:
+    cursor = get_connection().cursor()
+    try:
+        cursor.execute("SELECT finished_at FROM report_broadcasts WHERE week_key = ?", (week,))
+        row = cursor.fetchone()
+    finally:
+        cursor.close()
+    return row is not None and row[0] is not None
+
+def record_delivery(week: int, user_id: int, status: str, attempts: int) -> None:
+    with transaction() as cursor:
+        cursor.execute("""
+            INSERT INTO report_deliveries (week_key, user_id, status, attempts, delivered_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (week_key, user_id) DO UPDATE SET
+                status = excluded.status,
+                attempts = excluded.attempts,
+                delivered_at = excluded.delivered_at
+        """, (week, user_id, status, attempts, datetime.now().isoformat(timespec='seconds')))
+
+def fetch_reports(week: int, after: int = 0, page_size: int = DEFAULT_PAGE_SIZE) -> List[Report]:
+    """
+    Следующая страница отчетов: пользователи с пробежками за неделю, которым отчет
+    еще не отправлялся, с user_id больше after. Пробежки страницы по дням читаются
+    одним запросом, поэтому page_size не должен превышать лимит параметров SQLite (999).
+    """
+    start, end = week_dates(week)
+    cursor = get_connection().cursor()
+    try:
+        cursor.execute("""
+            SELECT w.user_id, w.distance
+            FROM weekly_totals w
+            WHERE w.week_key = ? AND w.user_id > ? AND w.runs_count > 0
+              AND NOT EXISTS (
+                  SELECT 1 FROM report_deliveries d
+                  WHERE d.week_key = w.week_key AND d.user_id = w.user_id
+              )
+            ORDER BY w.user_id
+            LIMIT ?
+        """, (week, after, page_size))
+        totals = cursor.fetchall()
+        if not totals:
+            return []
+
+        user_ids = [user_id for user_id, _ in totals]
+        by_user: Dict[int, Dict[str, float]] = {user_id: {} for user_id in user_ids}
+        # Поиск по индексу (user_id, run_day) для каждого пользователя страницы
+        placeholders = ", ".join("?" * len(user_ids))
+        cursor.execute(f"""
+            SELECT user_id, run_day, SUM(distance)
+            FROM runs
+            WHERE user_id IN ({placeholders}) AND run_day BETWEEN ? AND ?
+            GROUP BY user_id, run_day
+        """, (*user_ids, rollups.day_key(start), rollups.day_key(end)))
+        for user_id, day, distance in cursor.fetchall():
+            by_user[user_id][rollups.day_from_key(day).isoformat()] = distance
+    finally:
+        cursor.close()
+
+    rank_names = ranks.resolve_ranks([distance for _, distance in totals]).names
+    return [
+        Report(user_id, format_weekly_report(start, end, distance, rank, by_user[user_id]))
+        for (user_id, distance), rank in zip(totals, rank_names)
+    ]
+
+# Отправка
+
+SendFunc = Callable[[int, str], Awaitable[Any]]
+
+class WeeklyReportBroadcast:
+    """
+    Рассылка отчетов за неделю week пулом из workers воркеров.
+    Общее ведро ограничивает скорость всей рассылки, ведра по чатам — скорость в каждый чат.
+    TelegramRetryAfter приостанавливает общее ведро и повторяет отправку без учета попытки,
+    прочие ошибки (кроме блокировки бота и неверного запроса) повторяются до MAX_ATTEMPTS раз.
+    """
+
+    def __init__(self, send: SendFunc, week: int, workers: int = DEFAULT_WORKERS,
+                 rate: float = DEFAULT_RATE, per_chat_rate: float = DEFAULT_PER_CHAT_RATE,
+                 page_size: int = DEFAULT_PAGE_SIZE, max_attempts: int = MAX_ATTEMPTS) -> None:
+        self.send = send
+        self.week = week
+        self.workers = workers
+        self.page_size = page_size
+        self.max_attempts = max_attempts
+        self.limiter = TokenBucket(rate)
+        self.chat_limiter = KeyedTokenBuckets(per_chat_rate)
+        self.stats = BroadcastStats()
+
+    async def _produce(self, queue: "asyncio.Queue[Optional[Report]]") -> None:
+        after = 0
+        while True:
+            page = await async_db.run_db(fetch_reports, self.week, after, self.page_size)
+            if not page:
+                break
+            for report in page:
+                await queue.put(report)
+            after = page[-1].user_id
+        # При ошибке воркеров не дожидаются: их отменяет run
+        for _ in range(self.workers):
+            await queue.put(None)
+
+    async def _deliver(self, report: Report) -> Tuple[str, int]:
+        """Отправляет отчет; возвращает итоговый статус и число попыток"""
+        attempts = 0
+        while True:
+            await self.chat_limiter.acquire(report.user_id)
+            await self.limiter.acquire()
+            attempts += 1
+            try:
+                # Ответы пользователям в общей очереди отправки идут раньше рассылки
+                with outbox.priority(outbox.BULK):
+                    await self.send(report.user_id, report.text)
+                return SENT, attempts
+            except TelegramRetryAfter as e:
+                # Ограничение Telegram действует на весь бот: останавливаем всех воркеров
+                self.stats.retry_after += 1
+                self.limiter.pause(e.retry_after)
+                attempts -= 1
+            except TelegramForbiddenError:
+                return BLOCKED, attempts
+            except TelegramBadRequest as e:
+                logging.warning(f"Еженедельный отчет пользователю {report.user_id} отклонен: {e}")
+                return FAILED, attempts
+            except Exception as e:
+                if attempts >= self.max_attempts:
+                    logging.error(f"Не удалось отправить еженедельный отчет пользователю {report.user_id}: {e}")
+                    return FAILED, attempts
+                await asyncio.sleep(2 ** (attempts - 1))
+
+    async def _work(self, queue: "asyncio.Queue[Optional[Report]]") -> None:
+        while True:
+            report = await queue.get()
+            if report is None:
+                return
+            # Сначала фиксируем начало отправки: после падения процесса этот отчет не повторится
+            await async_db.run_db(record_delivery, self.week, report.user_id, SENDING, 0)
+            status, attempts = await self._deliver(report)
+            await async_db.run_db(record_delivery, self.week, report.user_id, status, attempts)
+            if status == SENT:
+                self.stats.sent += 1
+            elif status == BLOCKED:
+                self.stats.blocked += 1
+            else:
+                self.stats.failed += 1
+
+    async def run(self) -> BroadcastStats:
+        if not await async_db.run_db(begin_broadcast, self.week):
+            logging.info(f"Еженедельные отчеты за неделю {self.week} уже разосланы")
+            return self.stats
+
+        queue: "asyncio.Queue[Optional[Report]]" = asyncio.Queue(maxsize=self.workers * 4)
+        producer = asyncio.create_task(self._produce(queue))
+        tasks = [producer] + [asyncio.create_task(self._work(queue)) for _ in range(self.workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            # Если упал воркер или производитель, остальные задачи иначе остались бы ждать
+            # в queue.put и queue.get: отменяем их и дожидаемся завершения
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.stats.elapsed = time.monotonic() - self.stats.started
+
+        await async_db.run_db(finish_broadcast, self.week)
+        logging.info(
+            f"Еженедельные отчеты за неделю {self.week}: отправлено {self.stats.sent}, "
+            f"заблокировали бота {self.stats.blocked}, ошибок {self.stats.failed}, "
+            f"ответов retry_after {self.stats.retry_after}, {self.stats.rate:.1f} сообщ./с"
+        )
+        return self.stats
+
+# Расписание
+
+def last_fire(now: datetime, weekday: int, hour: int) -> datetime:
+    """Последний момент рассылки (день недели weekday, 0 — понедельник, в hour часов) не позже now"""
+    fire = datetime.combine(now.date() - timedelta(days=(now.weekday() - weekday) % 7), datetime.min.time())
+    fire = fire.replace(hour=hour)
+    if fire > now:
+        fire -= timedelta(days=7)
+    return fire
+
+def report_week(fire: datetime) -> int:
+    """
+    Неделя, за которую рассылаются отчеты в момент fire: неделя накануне дня рассылки
+    (при рассылке в воскресенье — текущая, в понедельник — прошедшая)
+    """
+    return rollups.week_key(fire.date() - timedelta(days=1))
+
+async def _run_safely(job: WeeklyReportBroadcast) -> None:
+    # Ошибка одной рассылки не должна останавливать расписание; прогресс сохранен в базе
+    try:
+        await job.run()
+    except Exception:
+        logging.exception(f"Рассылка еженедельных отчетов за неделю {job.week} прервана")
+
+async def run_scheduler(send: SendFunc, weekday: int = 6, hour: int = 20,
+                        **options: Any) -> None:
+    """
+    Бесконечно рассылает отчеты по расписанию. При запуске догоняет рассылку,
+    пропущенную или прерванную за последние CATCH_UP_WINDOW.
+    options передаются в WeeklyReportBroadcast.
+    """
+    now = datetime.now()
+    fire = last_fire(now, weekday, hour)
+    if now - fire <= CATCH_UP_WINDOW:
+        week = report_week(fire)
+        if not await async_db.run_db(is_finished, week):
+            logging.info(f"Продолжаем рассылку еженедельных отчетов за неделю {week}")
+            await _run_safely(WeeklyReportBroadcast(send, week, **options))
+
+    while True:
+        now = datetime.now()
+        fire = last_fire(now, weekday, hour) + timedelta(days=7)
+        await asyncio.sleep((fire - now).total_seconds())
+        await _run_safely(WeeklyReportBroadcast(send, report_week(fire), **options))
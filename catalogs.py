@@ -0,0 +1,230 @@
+import random
+import threading
+from collections import OrderedDict, deque
+from typing import Collection, Deque, Dict, List, Optional, Sequence, Tuple
+
+from db_connection import get_connection
+from table_versions import TableVersion
+
+# Сообщение, если таблица мотивационных сообщений пуста
+DEFAULT_MOTIVATION = "Продолжай двигаться вперед! Каждый шаг приближает тебя к цели."
+
+# Сколько последних выданных пользователю заданий и сообщений не повторять
+DEFAULT_NO_REPEAT_WINDOW = 3
+
+# Сколько раз перевыбирать элемент, попавший в окно недавних, прежде чем выбрать среди остальных перебором
+MAX_REDRAWS = 8
+
+class AliasSampler:
+    """
+    Выбор индекса с вероятностью, пропорциональной весу, за O(1) (метод псевдонимов Уокера).
+    Если все веса равны, выбор сводится к одному randrange.
+    """
+
+    def __init__(self, weights: Sequence[float]) -> None:
+        self.size = len(weights)
+        self._prob: Optional[List[float]] = None
+        self._alias: Optional[List[int]] = None
+        if self.size == 0 or len(set(weights)) == 1:
+            return
+
+        total = sum(weights)
+        scaled = [weight * self.size / total for weight in weights]
+        prob = [1.0] * self.size
+        alias = list(range(self.size))
+        small = [i for i, value in enumerate(scaled) if value < 1.0]
+        large = [i for i, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            prob[less] = scaled[less]
+            alias[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            (small if scaled[more] < 1.0 else large).append(more)
+        # Оставшиеся (из-за погрешности округления) получают вероятность 1
+        self._prob, self._alias = prob, alias
+
+    def sample(self, rng: random.Random) -> int:
+        index = rng.randrange(self.size)
+        if self._prob is None or rng.random() < self._prob[index]:
+            return index
+        return self._alias[index]
+
+class Catalog:
+    """
+    Неизменяемый набор текстов (id, текст) с весами для случайного выбора.
+    Элементы с неположительным весом не выдаются.
+    """
+
+    def __init__(self, rows: Sequence[Tuple[int, str, float]]) -> None:
+        rows = [row for row in rows if row[2] > 0]
+        self.ids: Tuple[int, ...] = tuple(item_id for item_id, _, _ in rows)
+        self.texts: Tuple[str, ...] = tuple(text for _, text, _ in rows)
+        self.weights: Tuple[float, ...] = tuple(weight for _, _, weight in rows)
+        self._sampler = AliasSampler(self.weights)
+
+    def sample(self, rng: random.Random, recent: Collection[int] = ()) -> Optional[Tuple[int, str]]:
+        """
+        Возвращает случайный (id, текст), по возможности не из recent, или None, если каталог пуст
+        """
+        if not self.ids:
+            return None
+        index = self._sampler.sample(rng)
+        # Если недавние покрывают весь каталог, избегать их бессмысленно
+        if not recent or len(recent) >= len(self.ids):
+            return self.ids[index], self.texts[index]
+
+        redraws = MAX_REDRAWS
+        while self.ids[index] in recent and redraws:
+            index = self._sampler.sample(rng)
+            redraws -= 1
+        if self.ids[index] in recent:
+            # Редкий случай (маленький каталог): выбираем среди оставшихся элементов напрямую
+            allowed = [i for i, item_id in enumerate(self.ids) if item_id not in recent]
+            index = rng.choices(allowed, weights=[self.weights[i] for i in allowed])[0]
+        return self.ids[index], self.texts[index]
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+class RecentPicks:
+    """
+    Последние выданные пользователю элементы (по каждому виду каталога).
+    Хранит не больше max_users пользователей, вытесняя давно неактивных.
+    """
+
+    def __init__(self, window: int, max_users: int = 100000) -> None:
+        self.window = window
+        self.max_users = max_users
+        self._recent: "OrderedDict[Tuple[str, int], Deque[int]]" = OrderedDict()
+
+    def get(self, kind: str, user_id: int) -> Collection[int]:
+        picks = self._recent.get((kind, user_id))
+        return picks if picks is not None else ()
+
+    def add(self, kind: str, user_id: int, item_id: int) -> None:
+        if self.window <= 0:
+            return
+        key = (kind, user_id)
+        picks = self._recent.get(key)
+        if picks is None:
+            picks = self._recent[key] = deque(maxlen=self.window)
+        self._recent.move_to_end(key)
+        picks.append(item_id)
+        while len(self._recent) > self.max_users:
+            self._recent.popitem(last=False)
+
+class _Snapshot:
+    """Каталоги, прочитанные из базы при одной версии справочных таблиц"""
+
+    def __init__(self, version: int, challenges: Dict[int, Catalog], rank_ids: Dict[str, int],
+                 fallback_rank_id: Optional[int], motivations: Catalog) -> None:
+        self.version = version
+        self.challenges = challenges
+        self.rank_ids = rank_ids
+        self.fallback_rank_id = fallback_rank_id
+        self.motivations = motivations
+
+    def challenges_for(self, rank: str) -> Catalog:
+        # Если для ранга нет заданий, используются задания самого низкого ранга
+        catalog = self.challenges.get(self.rank_ids.get(rank))
+        if catalog:
+            return catalog
+        return self.challenges.get(self.fallback_rank_id) or Catalog([])
+
+class CatalogCache:
+    """
+    Кэш заданий (по id ранга) и мотивационных сообщений.
+    Перечитывается из базы, только когда меняются таблицы ranks, challenges или motivational_messages.
+    """
+
+    def __init__(self, window: int = DEFAULT_NO_REPEAT_WINDOW, max_users: int = 100000,
+                 rng: Optional[random.Random] = None) -> None:
+        self._version = TableVersion("ranks", "challenges", "motivational_messages")
+        self._snapshot: Optional[_Snapshot] = None
+        self._recent = RecentPicks(window, max_users)
+        self._rng = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def configure(self, window: int, max_users: int) -> None:
+        with self._lock:
+            self._recent = RecentPicks(window, max_users)
+
+    def _load(self, version: int) -> _Snapshot:
+        cursor = get_connection().cursor()
+        try:
+            cursor.execute("SELECT id, name FROM ranks ORDER BY min_km DESC, id DESC")
+            rank_rows = cursor.fetchall()
+            # При одинаковых названиях используется ранг с меньшей нижней границей
+            rank_ids = {name: rank_id for rank_id, name in rank_rows}
+            fallback_rank_id = rank_rows[-1][0] if rank_rows else None
+
+            cursor.execute("SELECT rank_id, id, challenge_text, weight FROM challenges ORDER BY id")
+            by_rank: Dict[int, List[Tuple[int, str, float]]] = {}
+            for rank_id, item_id, text, weight in cursor.fetchall():
+                by_rank.setdefault(rank_id, []).append((item_id, text, weight))
+
+            cursor.execute("SELECT id, message, weight FROM motivational_messages ORDER BY id")
+            motivations = Catalog(cursor.fetchall())
+        finally:
+            cursor.close()
+
+        challenges = {rank_id: Catalog(rows) for rank_id, rows in by_rank.items()}
+        return _Snapshot(version, challenges, rank_ids, fallback_rank_id, motivations)
+
+    def snapshot(self) -> _Snapshot:
+        version = self._version.current()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot.version == version:
+            return snapshot
+        with self._lock:
+            if self._snapshot is None or self._snapshot.version != version:
+                self._snapshot = self._load(version)
+            return self._snapshot
+
+    def invalidate(self) -> None:
+        """Сбрасывает каталоги; при следующем обращении они будут прочитаны заново"""
+        self._version.invalidate()
+        with self._lock:
+            self._snapshot = None
+
+    def _pick(self, kind: str, catalog: Catalog, user_id: Optional[int]) -> Optional[str]:
+        with self._lock:
+            recent = self._recent.get(kind, user_id) if user_id is not None else ()
+            picked = catalog.sample(self._rng, recent)
+            if picked is None:
+                return None
+            if user_id is not None:
+                self._recent.add(kind, user_id, picked[0])
+        return picked[1]
+
+    def challenges(self, rank: str) -> List[str]:
+        return list(self.snapshot().challenges_for(rank).texts)
+
+    def random_challenge(self, rank: str, user_id: Optional[int] = None) -> str:
+        text = self._pick("challenge", self.snapshot().challenges_for(rank), user_id)
+        if text is None:
+            raise LookupError(f"Нет заданий для ранга {rank}")
+        return text
+
+    def random_motivation(self, user_id: Optional[int] = None) -> str:
+        text = self._pick("motivation", self.snapshot().motivations, user_id)
+        return text if text is not None else DEFAULT_MOTIVATION
+
+# Общий для процесса кэш каталогов
+catalog = CatalogCache()
+
+def configure(window: int, max_users: int = 100000) -> None:
+    """Задает окно неповторения и число пользователей, для которых оно хранится"""
+    catalog.configure(window, max_users)
+
+def invalidate() -> None:
+    catalog.invalidate()
+
+def get_challenges(rank: str) -> List[str]:
+    return catalog.challenges(rank)
+
+def get_random_challenge(rank: str, user_id: Optional[int] = None) -> str:
+    return catalog.random_challenge(rank, user_id)
+
+def get_random_motivation(user_id: Optional[int] = None) -> str:
+    return catalog.random_motivation(user_id)
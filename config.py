@@ -4,9 +4,91 @@ from dotenv import load_dotenv
 # Загрузка переменных окружения из файла .env
 load_dotenv()
 
-# Получение токена бота из переменных окружения
+# Получение токена бота из переменных окружения (наличие проверяет validate() при запуске бота)
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 
-# Проверка наличия токена
-if not BOT_TOKEN:
-    raise ValueError("Не указан токен бота! Укажите его в файле .env или в переменных окружения.") 
\ No newline at end of file
+# Групповая запись пробежек: сколько миллисекунд ждать попутных записей и максимальный размер пачки
+WRITE_FLUSH_INTERVAL_MS = float(os.getenv("WRITE_FLUSH_INTERVAL_MS", "5"))
+WRITE_BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", "100"))
+
+# Максимальное число пользователей в кэше известных пользователей
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000"))
+
+# Сколько последних заданий и мотивационных сообщений не повторять одному пользователю
+CATALOG_NO_REPEAT_WINDOW = int(os.getenv("CATALOG_NO_REPEAT_WINDOW", "3"))
+
+# Сколько секунд готовая таблица лидеров может использоваться без проверки изменений вне процесса
+LEADERBOARD_CACHE_TTL = float(os.getenv("LEADERBOARD_CACHE_TTL", "30"))
+
+# Состояния диалогов (FSM): через сколько секунд без изменений состояние истекает, сколько состояний
+# держать в памяти, как часто записывать изменения в базу (мс) и удалять истекшие состояния (с)
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", "86400"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "10000"))
+FSM_FLUSH_INTERVAL_MS = float(os.getenv("FSM_FLUSH_INTERVAL_MS", "50"))
+FSM_SWEEP_INTERVAL = float(os.getenv("FSM_SWEEP_INTERVAL", "600"))
+
+# Еженедельные отчеты: день недели (0 — понедельник) и час рассылки, число воркеров
+# и ограничения скорости (сообщений в секунду всего и в один чат)
+REPORTS_ENABLED = os.getenv("REPORTS_ENABLED", "1") == "1"
+REPORT_WEEKDAY = int(os.getenv("REPORT_WEEKDAY", "6"))
+REPORT_HOUR = int(os.getenv("REPORT_HOUR", "20"))
+REPORT_WORKERS = int(os.getenv("REPORT_WORKERS", "8"))
+REPORT_RATE = float(os.getenv("REPORT_RATE", "25"))
+REPORT_PER_CHAT_RATE = float(os.getenv("REPORT_PER_CHAT_RATE", "1"))
+
+# Очередь исходящих сообщений: сообщений в секунду всего, в один чат и допустимый всплеск в один чат
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "28"))
+OUTBOX_PER_CHAT_RATE = float(os.getenv("OUTBOX_PER_CHAT_RATE", "1"))
+OUTBOX_PER_CHAT_BURST = float(os.getenv("OUTBOX_PER_CHAT_BURST", "3"))
+
+# Метрики в формате Prometheus (задержка обработчиков, SQL-запросы, Bot API): включены ли
+# и на каком адресе и порту отдаются по GET /metrics
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+
+# Наибольший размер файла выгрузки пробежек, присланного боту, в МБ
+# (Bot API отдает ботам файлы до 20 МБ, локальный telegram-bot-api — до 2000 МБ)
+IMPORT_MAX_FILE_MB = float(os.getenv("IMPORT_MAX_FILE_MB", "20"))
+
+# Адрес сервера Bot API (пусто — api.telegram.org; например, локальный telegram-bot-api)
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+
+# Способ получения обновлений: "polling" (по умолчанию), "webhook" или "worker"
+# (воркер supervisor.py: принимает обновления от супервизора, вебхук не регистрирует)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+
+# Вебхук: публичный адрес бота, путь, адрес и порт встроенного сервера и секретный токен,
+# который Telegram передает в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Сколько принятых обновлений может ждать обработки, прежде чем вебхук начнет отвечать 503
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+
+# Сколько обновлений обрабатывается одновременно (в обоих режимах)
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+
+# Несколько процессов бота (supervisor.py): число воркеров и их внутренние порты, начиная с базового.
+# Номер воркера и их общее число супервизор передает каждому воркеру
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", str(os.cpu_count() or 1)))
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "8100"))
+WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+WORKER_COUNT = int(os.getenv("WORKER_COUNT", "1"))
+
+def validate() -> None:
+    """
+    Проверяет настройки, без которых бот не запустится. Вызывается при запуске bot.py и supervisor.py,
+    а не при импорте: скрипты администрирования и бенчмарки импортируют config без токена.
+    """
+    if not BOT_TOKEN:
+        raise ValueError("Не указан токен бота! Укажите его в файле .env или в переменных окружения.")
+    if BOT_MODE not in ("polling", "webhook", "worker"):
+        raise ValueError(f"Неизвестный режим BOT_MODE={BOT_MODE}: ожидается polling, webhook или worker")
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise ValueError("Для режима webhook укажите публичный адрес бота в WEBHOOK_URL.")
+    if BOT_MODE == "webhook" and not WEBHOOK_SECRET:
+        # Без секрета любой, кто может обратиться к публичному адресу, подделает обновления
+        raise ValueError("Для режима webhook укажите секретный токен в WEBHOOK_SECRET.")
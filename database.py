@@ -1,18 +1,24 @@
 import datetime
+import logging
 import sqlite3
 import os
 from datetime import date, timedelta
-from typing import Dict, List, Any, Tuple, Optional
+from collections.abc import Mapping
+from typing import Dict, List, Any, Tuple, Optional, Sequence, Iterator
 
-# Путь к базе данных SQLite
-DB_PATH = 'running_bot.db'
+import leaderboard
+import rollups
+from ranks import calculate_progress, determine_ranks
+from user_cache import KnownUserCache, UNKNOWN
+from db_connection import get_connection, read_snapshot, transaction
+from migrate_db import apply_migrations
 
 # Инициализация базы данных
 def init_db() -> None:
     """
     Создает базу данных и таблицы, если они не существуют
     """
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
     # Создаем таблицу пользователей
@@ -66,10 +72,10 @@ def init_db() -> None:
     ''')
     
     conn.commit()
-    conn.close()
-
-# Инициализируем базу данных при импорте модуля
-init_db()
+    cursor.close()
+    
+    # Применяем версионированные миграции (индексы и последующие изменения схемы)
+    apply_migrations(conn)
 
 # Получение номера текущей недели
 def get_current_week() -> int:
@@ -94,48 +100,98 @@ def get_month_range() -> Tuple[date, date]:
     end_of_month = next_month - timedelta(days=1)
     return start_of_month, end_of_month
 
+# Получение начала и конца текущего года
+def get_year_range() -> Tuple[date, date]:
+    today = date.today()
+    return date(today.year, 1, 1), date(today.year, 12, 31)
+
+# Диапазон текущей недели в номерах дней (runs.run_day)
+def get_week_days() -> Tuple[int, int]:
+    start_of_week, end_of_week = get_week_range()
+    return rollups.day_key(start_of_week), rollups.day_key(end_of_week)
+
+def _runs_by_day(rows: List[Tuple[int, float]]) -> Dict[str, float]:
+    """Пробежки по дням с ключами в виде ISO-дат, как их ожидают обработчики"""
+    return {rollups.day_from_key(day).isoformat(): distance for day, distance in rows}
+
+# Окна таблицы лидеров: функция диапазона дат (None — за все время) и ключ в результате
+LEADERBOARD_WINDOWS = {
+    "week": (get_week_range, "weekly_distance"),
+    "month": (get_month_range, "monthly_distance"),
+    "year": (get_year_range, "yearly_distance"),
+    "all": (None, "all_time_distance"),
+}
+
+# Кэш известных пользователей и их последних сохраненных имен
+known_users = KnownUserCache()
+
+def configure_user_cache(capacity: int) -> None:
+    """
+    Задает максимальное число пользователей в кэше
+    """
+    global known_users
+    known_users = KnownUserCache(capacity)
+
+def get_user_cache_stats() -> Dict[str, Any]:
+    """
+    Возвращает метрики кэша пользователей: доля попаданий, записи в БД и сэкономленные записи
+    """
+    return known_users.stats()
+
 # Инициализация пользователя в БД
 def init_user(user_id: int, username: str = None) -> None:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    username = username or None
     
-    # Проверяем, существует ли пользователь
-    cursor.execute("SELECT user_id FROM users WHERE user_id = ?", (user_id,))
-    if not cursor.fetchone():
-        current_week = get_current_week()
-        joined_date = datetime.date.today().isoformat()
-        
-        # Добавляем пользователя
-        cursor.execute(
-            "INSERT INTO users (user_id, username, current_week, total_distance, joined_date) VALUES (?, ?, ?, ?, ?)",
-            (user_id, username, current_week, 0, joined_date)
-        )
-        conn.commit()
-    elif username:
-        # Обновляем имя пользователя, если оно предоставлено
-        cursor.execute(
-            "UPDATE users SET username = ? WHERE user_id = ?",
-            (username, user_id)
-        )
-        conn.commit()
+    # Известный пользователь с тем же именем не требует обращения к базе
+    known, stored_username = known_users.lookup(user_id)
+    if known and (username is None or stored_username == username):
+        known_users.record(hit=True, wrote=False if username else None)
+        return
     
-    conn.close()
+    # Регистрируем пользователя или обновляем имя, только если оно действительно изменилось
+    with transaction() as cursor:
+        cursor.execute("""
+            INSERT INTO users (user_id, username, current_week, total_distance, joined_date)
+            VALUES (?, ?, ?, 0, ?)
+            ON CONFLICT (user_id) DO UPDATE SET username = excluded.username
+            WHERE excluded.username IS NOT NULL AND users.username IS NOT excluded.username
+        """, (user_id, username, get_current_week(), datetime.date.today().isoformat()))
+        wrote = cursor.rowcount > 0
+    
+    if username is not None:
+        known_users.remember(user_id, username)
+        if wrote:
+            leaderboard.set_username(user_id, username)
+    else:
+        # Если запись была, это новый пользователь без имени, иначе имя в базе нам неизвестно
+        known_users.remember(user_id, None if wrote else UNKNOWN)
+    known_users.record(hit=known, wrote=wrote)
 
-# Добавление новой пробежки
-def add_run(user_id: int, distance: float) -> float:
+def _reregister_user(user_id: int) -> None:
     """
-    Добавляет новую пробежку пользователя и возвращает общую дистанцию за неделю
+    Регистрирует заново пользователя, которого нет в базе, хотя кэш считает его известным
+    (например, его удалили командой db_admin.py delete или из другого процесса)
     """
+    known_users.forget(user_id)
     init_user(user_id)
-    current_week = get_current_week()
-    current_date = datetime.date.today().isoformat()
+
+# Запись пробежки в рамках уже открытой транзакции
+def _insert_run(cursor: sqlite3.Cursor, user_id: int, distance: float, today: date) -> Tuple[float, Optional[str], int]:
+    """
+    Добавляет пробежку, обновляет общую дистанцию и агрегаты.
+    Возвращает недельную дистанцию пользователя с учетом этой пробежки, его имя и id пробежки.
+    """
+    current_week = today.isocalendar()[1]
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    # Регистрируем пользователя, если его еще нет
+    cursor.execute(
+        "INSERT OR IGNORE INTO users (user_id, username, current_week, total_distance, joined_date) VALUES (?, NULL, ?, 0, ?)",
+        (user_id, current_week, today.isoformat())
+    )
     
     # Проверяем текущую неделю пользователя
-    cursor.execute("SELECT current_week FROM users WHERE user_id = ?", (user_id,))
-    user_week = cursor.fetchone()[0]
+    cursor.execute("SELECT current_week, username FROM users WHERE user_id = ?", (user_id,))
+    user_week, username = cursor.fetchone()
     
     # Если неделя изменилась, обновляем неделю пользователя
     if user_week != current_week:
@@ -143,28 +199,57 @@ def add_run(user_id: int, distance: float) -> float:
     
     # Добавляем пробежку
     cursor.execute(
-        "INSERT INTO runs (user_id, run_date, distance) VALUES (?, ?, ?)",
-        (user_id, current_date, distance)
+        "INSERT INTO runs (user_id, run_date, run_day, distance) VALUES (?, ?, ?, ?)",
+        (user_id, today.isoformat(), rollups.day_key(today), distance)
     )
+    run_id = cursor.lastrowid
     
-    # Обновляем общую дистанцию пользователя
+    # Обновляем общую дистанцию пользователя и агрегаты за неделю и месяц
     cursor.execute(
         "UPDATE users SET total_distance = total_distance + ? WHERE user_id = ?",
         (distance, user_id)
     )
-    
-    conn.commit()
+    rollups.add_run(cursor, user_id, today, distance)
     
     # Получаем общую дистанцию за текущую неделю
-    start_of_week, end_of_week = get_week_range()
     cursor.execute(
-        "SELECT SUM(distance) FROM runs WHERE user_id = ? AND run_date BETWEEN ? AND ?",
-        (user_id, start_of_week.isoformat(), end_of_week.isoformat())
+        "SELECT distance FROM weekly_totals WHERE user_id = ? AND week_key = ?",
+        (user_id, rollups.week_key(today))
     )
-    weekly_distance = cursor.fetchone()[0] or 0
+    return cursor.fetchone()[0], username, run_id
+
+# Добавление новой пробежки
+def add_run(user_id: int, distance: float) -> float:
+    """
+    Добавляет новую пробежку пользователя и возвращает общую дистанцию за неделю
+    """
+    return add_runs_batch([(user_id, distance)])[0]
+
+# Добавление нескольких пробежек одной транзакцией
+def add_runs_batch(runs: Sequence[Tuple[int, float]]) -> List[float]:
+    """
+    Записывает пробежки (user_id, дистанция) в одной транзакции.
+    Возвращает недельную дистанцию каждого пользователя сразу после его пробежки.
+    """
+    today = datetime.date.today()
     
-    conn.close()
-    return weekly_distance
+    # Индексы таблицы лидеров обновляются после фиксации транзакции, но под той же блокировкой,
+    # чтобы их прогрев из БД не учел пробежки повторно
+    with leaderboard.updating():
+        with transaction() as cursor:
+            results = [_insert_run(cursor, user_id, distance, today) for user_id, distance in runs]
+        
+        try:
+            for (user_id, distance), (_, username, run_id) in zip(runs, results):
+                leaderboard.record_run(user_id, username, today, distance, run_id)
+                known_users.remember(user_id, username)
+        except Exception:
+            # Пробежки уже зафиксированы: ошибка не передается вызывающему, иначе он запишет их
+            # повторно. Индексы перечитаются из агрегатов при следующем обращении.
+            logging.exception(f"Не удалось обновить таблицу лидеров после записи {len(runs)} пробежек")
+            leaderboard.invalidate()
+    
+    return [weekly_distance for weekly_distance, _, _ in results]
 
 # Получение статистики пользователя
 def get_user_stats(user_id: int) -> Dict[str, Any]:
@@ -173,33 +258,37 @@ def get_user_stats(user_id: int) -> Dict[str, Any]:
     """
     init_user(user_id)
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
     # Получаем общую дистанцию и дату регистрации
     cursor.execute("SELECT total_distance, joined_date FROM users WHERE user_id = ?", (user_id,))
     user_data = cursor.fetchone()
+    if user_data is None:
+        _reregister_user(user_id)
+        cursor.execute("SELECT total_distance, joined_date FROM users WHERE user_id = ?", (user_id,))
+        user_data = cursor.fetchone()
     total_distance = user_data[0]
     joined_date = user_data[1]
     
-    # Получаем пробежки за текущую неделю
-    start_of_week, end_of_week = get_week_range()
+    # Получаем недельную сумму из агрегата
     cursor.execute(
-        "SELECT run_date, distance FROM runs WHERE user_id = ? AND run_date BETWEEN ? AND ?",
-        (user_id, start_of_week.isoformat(), end_of_week.isoformat())
+        "SELECT distance, runs_count FROM weekly_totals WHERE user_id = ? AND week_key = ?",
+        (user_id, rollups.week_key(date.today()))
     )
-    runs_data = cursor.fetchall()
+    weekly_data = cursor.fetchone()
+    weekly_distance = weekly_data[0] if weekly_data else 0
     
+    # Детализацию по дням читаем только если на неделе были пробежки
     weekly_runs = {}
-    for run_date, distance in runs_data:
-        if run_date in weekly_runs:
-            weekly_runs[run_date] += distance
-        else:
-            weekly_runs[run_date] = distance
-    
-    weekly_distance = sum(weekly_runs.values())
+    if weekly_data and weekly_data[1]:
+        cursor.execute(
+            "SELECT run_day, SUM(distance) FROM runs WHERE user_id = ? AND run_day BETWEEN ? AND ? GROUP BY run_day",
+            (user_id, *get_week_days())
+        )
+        weekly_runs = _runs_by_day(cursor.fetchall())
     
-    conn.close()
+    cursor.close()
     
     return {
         "weekly_distance": weekly_distance,
@@ -208,106 +297,105 @@ def get_user_stats(user_id: int) -> Dict[str, Any]:
         "joined_date": joined_date
     }
 
+# Все данные для экрана статистики из одного снимка базы
+def get_dashboard(user_id: int) -> Dict[str, Any]:
+    """
+    Возвращает пробежки за неделю, общую дистанцию, текущий и следующий ранг
+    и километраж до следующего ранга. Все чтения выполняются в одной транзакции,
+    поэтому значения согласованы между собой.
+    """
+    today = date.today()
+    first_day, last_day = get_week_days()
+    
+    with read_snapshot() as cursor:
+        cursor.execute("SELECT total_distance, joined_date FROM users WHERE user_id = ?", (user_id,))
+        user_data = cursor.fetchone()
+        
+        cursor.execute(
+            "SELECT distance, runs_count FROM weekly_totals WHERE user_id = ? AND week_key = ?",
+            (user_id, rollups.week_key(today))
+        )
+        weekly_data = cursor.fetchone()
+        
+        weekly_runs = {}
+        if weekly_data and weekly_data[1]:
+            cursor.execute(
+                "SELECT run_day, SUM(distance) FROM runs WHERE user_id = ? AND run_day BETWEEN ? AND ? GROUP BY run_day",
+                (user_id, first_day, last_day)
+            )
+            weekly_runs = _runs_by_day(cursor.fetchall())
+    
+    if user_data is None:
+        # Новый или удаленный пользователь: регистрируем его, как и остальные команды
+        _reregister_user(user_id)
+        user_data = (0, today.isoformat())
+    
+    weekly_distance = weekly_data[0] if weekly_data else 0
+    rank, next_rank, km_needed = calculate_progress(weekly_distance)
+    
+    return {
+        "weekly_distance": weekly_distance,
+        "total_distance": user_data[0],
+        "weekly_runs": weekly_runs,
+        "joined_date": user_data[1],
+        "rank": rank,
+        "next_rank": next_rank,
+        "km_needed": km_needed
+    }
+
 # Проверка, есть ли у пользователя пробежки на текущей неделе
 def has_runs_this_week(user_id: int) -> bool:
     init_user(user_id)
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = get_connection()
     cursor = conn.cursor()
     
-    start_of_week, end_of_week = get_week_range()
     cursor.execute(
-        "SELECT COUNT(*) FROM runs WHERE user_id = ? AND run_date BETWEEN ? AND ?",
-        (user_id, start_of_week.isoformat(), end_of_week.isoformat())
+        "SELECT runs_count FROM weekly_totals WHERE user_id = ? AND week_key = ?",
+        (user_id, rollups.week_key(date.today()))
     )
-    count = cursor.fetchone()[0]
+    row = cursor.fetchone()
     
-    conn.close()
-    return count > 0
+    cursor.close()
+    return bool(row and row[0] > 0)
 
 # Получение таблицы лидеров по недельному километражу
 def get_weekly_leaderboard(limit: int = 10) -> List[Dict[str, Any]]:
     """
     Возвращает таблицу лидеров по недельному километражу
     """
-    # Импортируем функцию из db_utils для избежания циклического импорта
-    from db_utils import determine_rank_db
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    top = leaderboard.top_weekly(limit)
+    ranks = determine_ranks([weekly_distance for _, _, weekly_distance in top])
     
-    start_of_week, end_of_week = get_week_range()
-    
-    cursor.execute("""
-        SELECT u.user_id, u.username, SUM(r.distance) as weekly_distance
-        FROM users u
-        JOIN runs r ON u.user_id = r.user_id
-        WHERE r.run_date BETWEEN ? AND ?
-        GROUP BY u.user_id, u.username
-        ORDER BY weekly_distance DESC
-        LIMIT ?
-    """, (start_of_week.isoformat(), end_of_week.isoformat(), limit))
-    
-    leaderboard = []
-    for user_id, username, weekly_distance in cursor.fetchall():
-        # Определяем ранг для пользователя
-        rank = determine_rank_db(weekly_distance)
-        
+    leaderboard_rows = []
+    for (user_id, username, weekly_distance), rank in zip(top, ranks):
         # Используем более дружественный формат имени
         user_name = username if username else f"Бегун #{user_id}"
         
-        leaderboard.append({
+        leaderboard_rows.append({
             "user_id": user_id,
             "username": user_name,
             "weekly_distance": weekly_distance,
             "rank": rank
         })
     
-    conn.close()
-    return leaderboard
+    return leaderboard_rows
 
 # Получение таблицы лидеров по месячному километражу
 def get_monthly_leaderboard(limit: int = 10) -> List[Dict[str, Any]]:
     """
     Возвращает таблицу лидеров по месячному километражу
     """
-    # Импортируем функцию из db_utils для избежания циклического импорта
-    from db_utils import determine_rank_db
+    top = leaderboard.top_monthly(limit)
+    # Ранги определяются по недельному километражу, все сразу
+    ranks = determine_ranks([weekly_distance for _, _, _, weekly_distance in top])
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    start_of_month, end_of_month = get_month_range()
-    
-    cursor.execute("""
-        SELECT u.user_id, u.username, SUM(r.distance) as monthly_distance
-        FROM users u
-        JOIN runs r ON u.user_id = r.user_id
-        WHERE r.run_date BETWEEN ? AND ?
-        GROUP BY u.user_id, u.username
-        ORDER BY monthly_distance DESC
-        LIMIT ?
-    """, (start_of_month.isoformat(), end_of_month.isoformat(), limit))
-    
-    leaderboard = []
-    for user_id, username, monthly_distance in cursor.fetchall():
-        # Определяем ранг для пользователя на основе недельного километража
-        start_of_week, end_of_week = get_week_range()
-        
-        cursor.execute("""
-            SELECT SUM(distance) 
-            FROM runs 
-            WHERE user_id = ? AND run_date BETWEEN ? AND ?
-        """, (user_id, start_of_week.isoformat(), end_of_week.isoformat()))
-        
-        weekly_distance = cursor.fetchone()[0] or 0
-        
-        rank = determine_rank_db(weekly_distance)
-        
+    leaderboard_rows = []
+    for (user_id, username, monthly_distance, weekly_distance), rank in zip(top, ranks):
         # Используем более дружественный формат имени
         user_name = username if username else f"Бегун #{user_id}"
         
-        leaderboard.append({
+        leaderboard_rows.append({
             "user_id": user_id,
             "username": user_name,
             "weekly_distance": weekly_distance,
@@ -315,48 +403,188 @@ def get_monthly_leaderboard(limit: int = 10) -> List[Dict[str, Any]]:
             "rank": rank
         })
     
-    conn.close()
-    return leaderboard
+    return leaderboard_rows
 
-# Для совместимости с существующим кодом, поддерживаем переменную users_db
-# Эта переменная будет использоваться только для чтения данных, 
-# но все изменения будут выполняться через функции работы с БД
-def get_users_db() -> Dict[int, Dict[str, Any]]:
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Получаем всех пользователей
-    cursor.execute("SELECT user_id, username, current_week, total_distance, joined_date FROM users")
-    users = cursor.fetchall()
-    
-    users_db = {}
+# Таблица лидеров по нескольким окнам за один проход
+def compute_leaderboard(windows: Sequence[str] = ("week", "month"), order_by: str = "month",
+                        limit: Optional[int] = 10) -> List[Dict[str, Any]]:
+    """
+    Считает километраж лидеров сразу по нескольким окнам (week, month, year, all)
+    одним агрегирующим запросом с условными суммами и определяет ранги пакетно.
+    Сортировка — по окну order_by, ранг — по недельному километражу.
+    """
+    for window in list(windows) + [order_by]:
+        if window not in LEADERBOARD_WINDOWS:
+            raise ValueError(f"Неизвестное окно таблицы лидеров: {window}")
+    
+    # Недельный километраж нужен всегда — по нему определяется ранг
+    columns = list(dict.fromkeys(list(windows) + [order_by, "week"]))
+    
+    select_parts = []
+    params: List[Any] = []
+    starts, ends = [], []
+    for window in columns:
+        range_func, key = LEADERBOARD_WINDOWS[window]
+        if range_func is None:
+            select_parts.append(f"SUM(r.distance) AS {key}")
+            starts = ends = None
+        else:
+            start, end = range_func()
+            select_parts.append(
+                f"SUM(CASE WHEN r.run_day BETWEEN ? AND ? THEN r.distance ELSE 0 END) AS {key}"
+            )
+            params += [rollups.day_key(start), rollups.day_key(end)]
+            if starts is not None:
+                starts.append(start)
+                ends.append(end)
+    
+    # Просматриваем только пробежки из самого широкого окна
+    where = ""
+    if starts is not None:
+        where = "WHERE r.run_day BETWEEN ? AND ?"
+        params += [rollups.day_key(min(starts)), rollups.day_key(max(ends))]
+    
+    order_key = LEADERBOARD_WINDOWS[order_by][1]
+    params.append(-1 if limit is None else limit)
+    
+    cursor = get_connection().cursor()
+    # Сначала агрегируем пробежки, а имена подтягиваем только для попавших в топ
+    cursor.execute(f"""
+        SELECT t.*, u.username
+        FROM (
+            SELECT r.user_id, {", ".join(select_parts)}
+            FROM runs r
+            {where}
+            GROUP BY r.user_id
+            HAVING {order_key} > 0
+            ORDER BY {order_key} DESC
+            LIMIT ?
+        ) t
+        JOIN users u ON u.user_id = t.user_id
+        ORDER BY t.{order_key} DESC
+    """, params)
+    rows = cursor.fetchall()
+    cursor.close()
+    
+    keys = [LEADERBOARD_WINDOWS[window][1] for window in columns]
+    ranks = determine_ranks([row[1 + columns.index("week")] for row in rows])
+    
+    result = []
+    for row, rank in zip(rows, ranks):
+        user_id, username = row[0], row[-1]
+        entry = {
+            "user_id": user_id,
+            "username": username if username else f"Бегун #{user_id}",
+        }
+        entry.update(zip(keys, row[1:-1]))
+        entry["rank"] = rank
+        result.append(entry)
+    return result
+
+# Пересчет агрегатов по таблице runs
+def rebuild_rollups() -> None:
+    """
+    Заново строит недельные и месячные агрегаты по всем пробежкам
+    """
+    with leaderboard.updating():
+        with transaction() as cursor:
+            rollups.rebuild(cursor)
+        leaderboard.invalidate()
+
+# Постраничный обход пользователей вместе с их пробежками за текущую неделю
+def iter_users(page_size: int = 500, after: Optional[int] = None) -> Iterator[Tuple[int, Dict[str, Any]]]:
+    """
+    Отдает пары (user_id, данные пользователя) по возрастанию user_id, начиная после after.
+    Каждая страница читается одним запросом с присоединенными пробежками недели,
+    поэтому в памяти одновременно находится не больше page_size пользователей.
+    """
+    first_day, last_day = get_week_days()
+    # Условие только по диапазону ключа: с "? IS NULL OR user_id > ?" SQLite просматривал
+    # таблицу с начала на каждой странице, и обход становился квадратичным
+    last_user_id = after if after is not None else -2 ** 63
     
-    for user_id, username, current_week, total_distance, joined_date in users:
-        # Получаем пробежки за текущую неделю
-        start_of_week, end_of_week = get_week_range()
-        cursor.execute(
-            "SELECT run_date, distance FROM runs WHERE user_id = ? AND run_date BETWEEN ? AND ?",
-            (user_id, start_of_week.isoformat(), end_of_week.isoformat())
-        )
-        runs_data = cursor.fetchall()
+    while True:
+        cursor = get_connection().cursor()
+        cursor.execute("""
+            SELECT u.user_id, u.username, u.current_week, u.total_distance, u.joined_date,
+                   r.run_day, SUM(r.distance)
+            FROM (
+                SELECT user_id, username, current_week, total_distance, joined_date
+                FROM users
+                WHERE user_id > ?
+                ORDER BY user_id
+                LIMIT ?
+            ) u
+            LEFT JOIN runs r
+                ON r.user_id = u.user_id AND r.run_day BETWEEN ? AND ?
+            GROUP BY u.user_id, r.run_day
+            ORDER BY u.user_id, r.run_day
+        """, (last_user_id, page_size, first_day, last_day))
         
-        weekly_runs = {}
-        for run_date, distance in runs_data:
-            if run_date in weekly_runs:
-                weekly_runs[run_date] += distance
-            else:
-                weekly_runs[run_date] = distance
+        # Страница читается целиком, чтобы не держать транзакцию чтения, пока вызывающий ее обрабатывает
+        rows = cursor.fetchall()
+        cursor.close()
         
-        users_db[user_id] = {
-            "username": username,
-            "weekly_runs": weekly_runs,
-            "current_week": current_week,
-            "total_distance": total_distance,
-            "joined_date": joined_date
-        }
+        # Группируем строки страницы по пользователю
+        current_id, current = None, None
+        users_on_page = 0
+        for user_id, username, current_week, total_distance, joined_date, run_day, distance in rows:
+            if user_id != current_id:
+                if current is not None:
+                    yield current_id, current
+                current_id = user_id
+                current = {
+                    "username": username,
+                    "weekly_runs": {},
+                    "current_week": current_week,
+                    "total_distance": total_distance,
+                    "joined_date": joined_date
+                }
+                users_on_page += 1
+            if run_day is not None:
+                current["weekly_runs"][rollups.day_from_key(run_day).isoformat()] = distance
+        
+        if current is not None:
+            yield current_id, current
+        if users_on_page < page_size:
+            return
+        last_user_id = current_id
+
+class UsersView(Mapping):
+    """
+    Представление пользователей только для чтения.
+    Итерация и items() читают базу постранично и не строят полный словарь.
+    """
+    
+    def __getitem__(self, user_id: int) -> Dict[str, Any]:
+        for found_id, data in iter_users(page_size=1, after=user_id - 1):
+            if found_id == user_id:
+                return data
+        raise KeyError(user_id)
     
-    conn.close()
-    return users_db
+    def __iter__(self) -> Iterator[int]:
+        return (user_id for user_id, _ in iter_users())
+    
+    def __len__(self) -> int:
+        cursor = get_connection().cursor()
+        cursor.execute("SELECT COUNT(*) FROM users")
+        count = cursor.fetchone()[0]
+        cursor.close()
+        return count
+    
+    def items(self) -> Iterator[Tuple[int, Dict[str, Any]]]:
+        return iter_users()
+    
+    def values(self) -> Iterator[Dict[str, Any]]:
+        return (data for _, data in iter_users())
+
+# Для совместимости с существующим кодом, поддерживаем переменную users_db.
+# Она используется только для чтения данных, все изменения выполняются через функции работы с БД
+def get_users_db() -> Dict[int, Dict[str, Any]]:
+    """
+    Возвращает всех пользователей одним словарем. Для больших баз используйте iter_users().
+    """
+    return dict(iter_users())
 
-# Создаем свойство users_db для получения текущего состояния базы данных
-users_db = property(get_users_db) 
\ No newline at end of file
+# Представление users_db для получения текущего состояния базы данных
+users_db = UsersView()
@@ -1,10 +1,18 @@
 import sqlite3
 import argparse
 import os
+import re
+import urllib.request
 from datetime import datetime, timedelta, date
 
+import rollups
+import table_versions
+
 DB_PATH = 'running_bot.db'
 
+# Адрес метрик работающего бота (METRICS_HOST и METRICS_PORT в config.py)
+METRICS_URL = f"http://127.0.0.1:{os.getenv('METRICS_PORT', '9100')}/metrics"
+
 def backup_database():
     """Создает резервную копию базы данных"""
     if not os.path.exists(DB_PATH):
@@ -15,10 +23,14 @@ def backup_database():
     backup_path = f"backup_{timestamp}.db"
     
     try:
-        # Копирование базы данных
-        with open(DB_PATH, 'rb') as source:
-            with open(backup_path, 'wb') as dest:
-                dest.write(source.read())
+        # Копирование базы данных через backup API, чтобы учесть изменения из WAL-журнала
+        source = sqlite3.connect(DB_PATH)
+        dest = sqlite3.connect(backup_path)
+        try:
+            source.backup(dest)
+        finally:
+            dest.close()
+            source.close()
         print(f"Резервная копия успешно создана: {backup_path}")
     except Exception as e:
         print(f"Ошибка при создании резервной копии: {e}")
@@ -72,7 +84,7 @@ def user_stats(user_id):
     
     try:
         # Получаем информацию о пользователе
-        cursor.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
+        cursor.execute("SELECT user_id, username, current_week, total_distance, joined_date FROM users WHERE user_id = ?", (user_id,))
         user = cursor.fetchone()
         
         if not user:
@@ -93,11 +105,11 @@ def user_stats(user_id):
         
         # Получаем пробежки пользователя
         cursor.execute("""
-        SELECT run_date, SUM(distance) as total
+        SELECT run_day, SUM(distance) as total
         FROM runs 
-        WHERE user_id = ? 
-        GROUP BY run_date
-        ORDER BY run_date DESC
+        WHERE user_id = ? AND run_day IS NOT NULL
+        GROUP BY run_day
+        ORDER BY run_day DESC
         LIMIT 10
         """, (user_id,))
         
@@ -110,8 +122,8 @@ def user_stats(user_id):
             print("-" * 30)
             
             for run in runs:
-                run_date, distance = run
-                date_formatted = datetime.fromisoformat(run_date).strftime("%d.%m.%Y")
+                run_day, distance = run
+                date_formatted = rollups.day_from_key(run_day).strftime("%d.%m.%Y")
                 print(f"{date_formatted:^15} | {distance:^15.1f}")
         else:
             print("\nПользователь еще не записал ни одной пробежки.")
@@ -144,8 +156,10 @@ def clear_user_runs(user_id):
         cursor.execute("SELECT SUM(distance) FROM runs WHERE user_id = ?", (user_id,))
         total = cursor.fetchone()[0] or 0
         
-        # Удаляем все пробежки
+        # Удаляем все пробежки и их агрегаты; бот перечитает таблицу лидеров
         cursor.execute("DELETE FROM runs WHERE user_id = ?", (user_id,))
+        rollups.delete_user(cursor, user_id)
+        table_versions.bump(cursor, table_versions.LEADERBOARD)
         
         # Обновляем общую дистанцию пользователя
         cursor.execute("UPDATE users SET total_distance = 0 WHERE user_id = ?", (user_id,))
@@ -178,8 +192,10 @@ def delete_user(user_id):
             print(f"Пользователь с ID {user_id} не найден.")
             return
         
-        # Удаляем пробежки пользователя
+        # Удаляем пробежки пользователя и их агрегаты; бот перечитает таблицу лидеров
         cursor.execute("DELETE FROM runs WHERE user_id = ?", (user_id,))
+        rollups.delete_user(cursor, user_id)
+        table_versions.bump(cursor, table_versions.LEADERBOARD)
         
         # Удаляем пользователя
         cursor.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
@@ -193,6 +209,33 @@ def delete_user(user_id):
     finally:
         conn.close()
 
+def rebuild_rollups():
+    """Пересчитывает недельные и месячные агрегаты по таблице пробежек"""
+    if not os.path.exists(DB_PATH):
+        print(f"Ошибка: Файл базы данных {DB_PATH} не найден.")
+        return
+    
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    
+    try:
+        rollups.create_tables(cursor)
+        rollups.rebuild(cursor)
+        table_versions.bump(cursor, table_versions.LEADERBOARD)
+        conn.commit()
+        
+        cursor.execute("SELECT COUNT(*) FROM weekly_totals")
+        weekly_count = cursor.fetchone()[0]
+        cursor.execute("SELECT COUNT(*) FROM monthly_totals")
+        monthly_count = cursor.fetchone()[0]
+        print(f"Агрегаты пересчитаны: {weekly_count} недельных и {monthly_count} месячных записей.")
+    
+    except Exception as e:
+        conn.rollback()
+        print(f"Ошибка при пересчете агрегатов: {e}")
+    finally:
+        conn.close()
+
 def show_leaderboard():
     """Показывает таблицу лидеров"""
     if not os.path.exists(DB_PATH):
@@ -221,11 +264,11 @@ def show_leaderboard():
             SELECT u.user_id, u.username, SUM(r.distance) as weekly_distance
             FROM users u
             JOIN runs r ON u.user_id = r.user_id
-            WHERE r.run_date BETWEEN ? AND ?
+            WHERE r.run_day BETWEEN ? AND ?
             GROUP BY u.user_id, u.username
             ORDER BY weekly_distance DESC
             LIMIT 10
-        """, (start_of_week.isoformat(), end_of_week.isoformat()))
+        """, (rollups.day_key(start_of_week), rollups.day_key(end_of_week)))
         
         weekly_leaders = cursor.fetchall()
         
@@ -247,11 +290,11 @@ def show_leaderboard():
             SELECT u.user_id, u.username, SUM(r.distance) as monthly_distance
             FROM users u
             JOIN runs r ON u.user_id = r.user_id
-            WHERE r.run_date BETWEEN ? AND ?
+            WHERE r.run_day BETWEEN ? AND ?
             GROUP BY u.user_id, u.username
             ORDER BY monthly_distance DESC
             LIMIT 10
-        """, (start_of_month.isoformat(), end_of_month.isoformat()))
+        """, (rollups.day_key(start_of_month), rollups.day_key(end_of_month)))
         
         monthly_leaders = cursor.fetchall()
         
@@ -273,6 +316,156 @@ def show_leaderboard():
     finally:
         conn.close()
 
+def reload_catalogs():
+    """Помечает ранги, задания и мотивационные сообщения измененными, чтобы бот перечитал их"""
+    if not os.path.exists(DB_PATH):
+        print(f"Ошибка: Файл базы данных {DB_PATH} не найден.")
+        return
+    
+    conn = sqlite3.connect(DB_PATH)
+    cursor = conn.cursor()
+    
+    try:
+        for table in ("ranks", "challenges", "motivational_messages"):
+            table_versions.bump(cursor, table)
+        conn.commit()
+        print("Справочники помечены для перечитывания, бот загрузит их при следующем обращении.")
+    
+    except Exception as e:
+        conn.rollback()
+        print(f"Ошибка при сбросе кэша справочников: {e}")
+    finally:
+        conn.close()
+
+def check_leaderboard(limit=10):
+    """Сверяет таблицу лидеров из памяти с агрегирующим SQL-запросом по пробежкам"""
+    if not os.path.exists(DB_PATH):
+        print(f"Ошибка: Файл базы данных {DB_PATH} не найден.")
+        return
+    
+    import leaderboard
+    
+    leaderboard.warm()
+    problems = leaderboard.check_consistency(limit)
+    if problems:
+        print("Найдены расхождения в таблице лидеров:")
+        for problem in problems:
+            print(f"  {problem}")
+    else:
+        print(f"Таблица лидеров (топ-{limit}) совпадает с результатом SQL-запроса.")
+
+def import_runs(user_id, path, fmt=None, batch_size=None):
+    """Импортирует историю пробежек пользователя из выгрузки CSV, GPX или FIT"""
+    if not os.path.exists(DB_PATH):
+        print(f"Ошибка: Файл базы данных {DB_PATH} не найден.")
+        return
+    if not os.path.exists(path):
+        print(f"Ошибка: Файл {path} не найден.")
+        return
+    
+    import run_import
+    
+    try:
+        result = run_import.import_file(user_id, path, fmt, batch_size or run_import.BATCH_SIZE)
+    except ValueError as e:
+        print(f"Ошибка при импорте: {e}")
+        return
+    
+    print(f"Тренировок в файле: {result.parsed}")
+    print(f"Добавлено пробежек: {result.imported} ({result.distance:.1f} км)")
+    print(f"Уже были записаны: {result.duplicates}")
+    print(f"Пропущено: {result.skipped}")
+    if result.first_day is not None:
+        print(f"Период: {result.first_day.isoformat()} - {result.last_day.isoformat()}")
+
+_METRIC_LINE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})? (\S+)$')
+_METRIC_LABEL = re.compile(r'([a-zA-Z_][a-zA-Z0-9_]*)="((?:[^"\\]|\\.)*)"')
+
+def parse_metrics(text):
+    """Разбирает текст в формате Prometheus в список (имя, метки, значение)"""
+    samples = []
+    for line in text.splitlines():
+        match = _METRIC_LINE.match(line)
+        if line.startswith('#') or not match:
+            continue
+        name, labels_text, value = match.groups()
+        labels = {
+            key: re.sub(r'\\(.)', lambda m: '\n' if m.group(1) == 'n' else m.group(1), raw)
+            for key, raw in _METRIC_LABEL.findall(labels_text or '')
+        }
+        samples.append((name, labels, float(value)))
+    return samples
+
+def show_profile(url=METRICS_URL, top=10):
+    """Выводит самые медленные SQL-запросы и разбивку времени обработчиков по метрикам работающего бота"""
+    try:
+        with urllib.request.urlopen(url, timeout=5) as response:
+            samples = parse_metrics(response.read().decode('utf-8'))
+    except OSError as e:
+        print(f"Ошибка: не удалось получить метрики бота с {url}: {e}")
+        return
+
+    queries = {}
+    handlers = {}
+    for name, labels, value in samples:
+        if name.startswith('bot_db_query_'):
+            key = (labels.get('handler', ''), labels.get('query', ''))
+            queries.setdefault(key, {})[name] = value
+        elif name.startswith('bot_handler_') and name.endswith(('_sum', '_count')):
+            handlers.setdefault(labels.get('handler', ''), {})[name] = value
+
+    if not queries:
+        print("Бот еще не выполнил ни одного SQL-запроса с включенными метриками.")
+        return
+
+    total_seconds = sum(stats.get('bot_db_query_seconds_total', 0) for stats in queries.values()) or 1
+    slowest = sorted(queries.items(), key=lambda item: item[1].get('bot_db_query_seconds_total', 0), reverse=True)
+
+    print("\nСамые медленные SQL-запросы (по суммарному времени):")
+    print("-" * 110)
+    print(f"{'Всего, мс':>10} | {'Доля':>6} | {'Число':>7} | {'Сред., мс':>9} | {'Макс., мс':>9} | {'Обработчик':<20} | Запрос")
+    print("-" * 110)
+    for (handler, query), stats in slowest[:top]:
+        seconds = stats.get('bot_db_query_seconds_total', 0)
+        count = stats.get('bot_db_query_total', 0)
+        average = seconds / count * 1000 if count else 0
+        print(f"{seconds * 1000:>10.1f} | {seconds / total_seconds:>6.1%} | {count:>7.0f} | {average:>9.2f} | "
+              f"{stats.get('bot_db_query_max_seconds', 0) * 1000:>9.2f} | {handler:<20} | {query}")
+
+    if handlers:
+        print("\nВремя обработчиков (в среднем на вызов):")
+        print("-" * 80)
+        print(f"{'Обработчик':<20} | {'Вызовов':>8} | {'Всего, мс':>10} | {'SQL, мс':>8} | {'Запросов':>8} | {'Bot API, мс':>11}")
+        print("-" * 80)
+        for handler, stats in sorted(handlers.items(), key=lambda item: item[1].get('bot_handler_seconds_sum', 0), reverse=True):
+            calls = stats.get('bot_handler_seconds_count', 0)
+            if not calls:
+                continue
+            print(f"{handler:<20} | {calls:>8.0f} | {stats.get('bot_handler_seconds_sum', 0) / calls * 1000:>10.2f} | "
+                  f"{stats.get('bot_handler_db_seconds_sum', 0) / calls * 1000:>8.2f} | "
+                  f"{stats.get('bot_handler_db_queries_sum', 0) / calls:>8.1f} | "
+                  f"{stats.get('bot_handler_api_seconds_sum', 0) / calls * 1000:>11.2f}")
+
+# Команды, которые не читают таблицы бота: резервная копия снимается с базы как есть,
+# профиль запрашивается у работающего бота
+NO_SCHEMA_COMMANDS = {None, 'backup', 'profile'}
+
+def prepare_database():
+    """
+    Создает недостающие таблицы, применяет миграции и дозаполняет runs.run_day, чтобы команды
+    работали и с базой старой версии: отчеты выбирают пробежки по run_day
+    """
+    import bootstrap
+    import db_connection
+    import migrate_db
+    
+    if db_connection.DB_PATH != DB_PATH:
+        db_connection.configure(DB_PATH)
+    bootstrap.init_db()
+    if migrate_db.backfill_pending():
+        migrate_db.backfill_run_days(verbose=True)
+    db_connection.close_all()
+
 def main():
     parser = argparse.ArgumentParser(description='Утилита администрирования базы данных бота для бега')
     
@@ -299,8 +492,33 @@ def main():
     # Команда leaderboard
     leaderboard_parser = subparsers.add_parser('leaderboard', help='Показать таблицу лидеров')
     
+    # Команда rebuild-rollups
+    rebuild_parser = subparsers.add_parser('rebuild-rollups', help='Пересчитать недельные и месячные агрегаты')
+    
+    # Команда reload-catalogs
+    reload_parser = subparsers.add_parser('reload-catalogs', help='Заставить бота перечитать ранги, задания и сообщения')
+    
+    # Команда check-leaderboard
+    check_parser = subparsers.add_parser('check-leaderboard', help='Сверить таблицу лидеров из памяти с SQL')
+    check_parser.add_argument('--limit', type=int, default=10, help='Размер проверяемого топа')
+    
+    # Команда profile
+    profile_parser = subparsers.add_parser('profile', help='Показать самые медленные SQL-запросы работающего бота')
+    profile_parser.add_argument('--url', default=METRICS_URL, help='Адрес метрик бота')
+    profile_parser.add_argument('--top', type=int, default=10, help='Сколько запросов показать')
+    
+    # Команда import
+    import_parser = subparsers.add_parser('import', help='Импортировать пробежки из выгрузки CSV, GPX или FIT')
+    import_parser.add_argument('user_id', type=int, help='ID пользователя')
+    import_parser.add_argument('path', help='Путь к файлу выгрузки')
+    import_parser.add_argument('--format', choices=['csv', 'gpx', 'fit'], help='Формат (по умолчанию по расширению)')
+    import_parser.add_argument('--batch-size', type=int, help='Сколько пробежек записывать одной транзакцией')
+    
     args = parser.parse_args()
     
+    if args.command not in NO_SCHEMA_COMMANDS and os.path.exists(DB_PATH):
+        prepare_database()
+    
     if args.command == 'backup':
         backup_database()
     elif args.command == 'list':
@@ -313,6 +531,16 @@ def main():
         delete_user(args.user_id)
     elif args.command == 'leaderboard':
         show_leaderboard()
+    elif args.command == 'rebuild-rollups':
+        rebuild_rollups()
+    elif args.command == 'reload-catalogs':
+        reload_catalogs()
+    elif args.command == 'check-leaderboard':
+        check_leaderboard(args.limit)
+    elif args.command == 'profile':
+        show_profile(args.url, args.top)
+    elif args.command == 'import':
+        import_runs(args.user_id, args.path, args.format, args.batch_size)
     else:
         parser.print_help()
 
@@ -0,0 +1,186 @@
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Type
+
+# Путь к базе данных SQLite
+DB_PATH = 'running_bot.db'
+
+# Настройки соединения
+JOURNAL_MODE = 'WAL'
+SYNCHRONOUS = 'NORMAL'
+BUSY_TIMEOUT_MS = 5000
+CACHED_STATEMENTS = 256
+
+# Каждому потоку выдается собственное долгоживущее соединение
+_local = threading.local()
+_connections: List[sqlite3.Connection] = []
+_lock = threading.Lock()
+# Увеличивается при закрытии соединений, чтобы потоки переоткрыли свои
+_generation = 0
+# Класс соединения (например, metrics.ProfiledConnection с замером запросов)
+_factory: Type[sqlite3.Connection] = sqlite3.Connection
+
+# Ожидание блокировки записи в transaction(): BEGIN IMMEDIATE ждет (до busy_timeout), пока
+# пишет другое соединение. Более долгий BEGIN считается ожиданием чужой транзакции.
+LOCK_WAIT_THRESHOLD = 0.001
+_wait_lock = threading.Lock()
+_transactions = 0
+_lock_waits = 0
+_lock_wait_seconds = 0.0
+_lock_wait_max = 0.0
+
+def configure(db_path: Optional[str] = None, synchronous: Optional[str] = None,
+              factory: Optional[Type[sqlite3.Connection]] = None) -> None:
+    """
+    Меняет параметры подключения (например, путь к тестовой базе).
+    Все открытые соединения закрываются и будут переоткрыты при следующем обращении.
+    """
+    global DB_PATH, SYNCHRONOUS, _factory
+    close_all()
+    if db_path is not None:
+        DB_PATH = db_path
+    if synchronous is not None:
+        SYNCHRONOUS = synchronous
+    if factory is not None:
+        _factory = factory
+
+def _open_connection() -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=BUSY_TIMEOUT_MS / 1000,
+        cached_statements=CACHED_STATEMENTS,
+        check_same_thread=False,
+        factory=_factory,
+        # Пишущие транзакции сразу берут блокировку записи (BEGIN IMMEDIATE): если базу пишут
+        # несколько процессов, транзакция ждет своей очереди busy_timeout, а не получает
+        # SQLITE_BUSY при попытке перейти от чтения к записи
+        isolation_level='IMMEDIATE'
+    )
+    conn.execute(f"PRAGMA journal_mode = {JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous = {SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}")
+    return conn
+
+def get_connection() -> sqlite3.Connection:
+    """
+    Возвращает долгоживущее соединение текущего потока, открывая его при первом обращении
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None or getattr(_local, 'generation', None) != _generation:
+        conn = _open_connection()
+        _local.conn = conn
+        _local.generation = _generation
+        with _lock:
+            _connections.append(conn)
+    return conn
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Cursor]:
+    """
+    Открывает транзакцию на соединении текущего потока.
+    Фиксирует изменения при успешном выходе и откатывает их при исключении.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    try:
+        if not conn.in_transaction:
+            start = time.perf_counter()
+            cursor.execute("BEGIN IMMEDIATE")
+            _record_lock_wait(time.perf_counter() - start)
+        yield cursor
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+@contextmanager
+def read_snapshot() -> Iterator[sqlite3.Cursor]:
+    """
+    Читает из одного снимка базы: открывает транзакцию чтения на соединении текущего потока
+    и завершает ее на выходе. Если транзакция уже открыта вызывающим кодом, чтения идут в ней,
+    и она не завершается.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    own = not conn.in_transaction
+    try:
+        if own:
+            cursor.execute("BEGIN")
+        yield cursor
+    finally:
+        if own:
+            conn.commit()
+        cursor.close()
+
+def _record_lock_wait(seconds: float) -> None:
+    global _transactions, _lock_waits, _lock_wait_seconds, _lock_wait_max
+    with _wait_lock:
+        _transactions += 1
+        if seconds >= LOCK_WAIT_THRESHOLD:
+            _lock_waits += 1
+            _lock_wait_seconds += seconds
+            _lock_wait_max = max(_lock_wait_max, seconds)
+
+def lock_wait_stats() -> Dict[str, Any]:
+    """
+    Пишущие транзакции transaction() и ожидание ими блокировки записи
+    """
+    with _wait_lock:
+        return {
+            "transactions": _transactions,
+            "waits": _lock_waits,
+            "wait_ratio": _lock_waits / _transactions if _transactions else 0.0,
+            "wait_seconds": _lock_wait_seconds,
+            "max_wait_seconds": _lock_wait_max,
+        }
+
+def reset_lock_wait_stats() -> None:
+    global _transactions, _lock_waits, _lock_wait_seconds, _lock_wait_max
+    with _wait_lock:
+        _transactions = _lock_waits = 0
+        _lock_wait_seconds = _lock_wait_max = 0.0
+
+@contextmanager
+def count_queries() -> Iterator[List[str]]:
+    """
+    Собирает SQL-запросы, выполненные на соединении текущего потока внутри блока
+    """
+    statements: List[str] = []
+    conn = get_connection()
+    conn.set_trace_callback(statements.append)
+    try:
+        yield statements
+    finally:
+        conn.set_trace_callback(None)
+
+def release() -> None:
+    """
+    Закрывает соединение текущего потока (для короткоживущих потоков, например прогрева кэшей)
+    """
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        return
+    _local.conn = None
+    with _lock:
+        if conn in _connections:
+            _connections.remove(conn)
+    conn.close()
+
+def close_all() -> None:
+    """
+    Закрывает все открытые соединения (используется в тестах и при остановке бота)
+    """
+    global _generation
+    with _lock:
+        connections = list(_connections)
+        _connections.clear()
+        _generation += 1
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.ProgrammingError:
+            pass
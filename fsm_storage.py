@@ -0,0 +1,295 @@
+import asyncio
+import json
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+
+import async_db
+from db_connection import get_connection, transaction
+
+# Хранилище состояний диалогов (FSM) в таблице fsm_states той же базы SQLite.
+# Перед базой стоит ограниченный LRU-кэш: изменения сразу попадают в кэш и очередь записи,
+# а фоновая задача фиксирует очередь в базе пачками раз в flush_interval секунд.
+# Состояние, которое не менялось ttl секунд, считается истекшим; фоновая очистка
+# раз в sweep_interval секунд удаляет такие строки из базы.
+
+# Значения по умолчанию: срок жизни состояния, размер кэша, интервалы записи и очистки
+DEFAULT_TTL = 24 * 60 * 60.0
+DEFAULT_CACHE_SIZE = 10000
+DEFAULT_FLUSH_INTERVAL = 0.05
+DEFAULT_SWEEP_INTERVAL = 600.0
+
+# Сколько изменений может накопиться до внеочередной записи в базу
+MAX_PENDING = 1000
+# Сколько истекших строк удаляется одной транзакцией
+SWEEP_BATCH = 1000
+
+# (bot_id, chat_id, user_id, thread_id, business_connection_id, destiny)
+Key = Tuple[int, int, int, int, str, str]
+
+class Record(NamedTuple):
+    state: Optional[str]
+    # Данные хранятся сериализованными в JSON, как в базе
+    data: str
+    expires_at: float
+
+    def is_empty(self) -> bool:
+        return self.state is None and self.data == EMPTY_DATA
+
+EMPTY_DATA = "{}"
+# Отсутствующее состояние; кэшируется, чтобы не обращаться к базе на каждое обновление
+EMPTY = Record(None, EMPTY_DATA, math.inf)
+
+def make_key(key: StorageKey) -> Key:
+    return (key.bot_id, key.chat_id, key.user_id, key.thread_id or 0,
+            key.business_connection_id or "", key.destiny)
+
+_KEY_WHERE = ("bot_id = ? AND chat_id = ? AND user_id = ? AND thread_id = ? "
+              "AND business_connection_id = ? AND destiny = ?")
+
+def load_record(key: Key) -> Optional[Record]:
+    row = get_connection().execute(
+        f"SELECT state, data, expires_at FROM fsm_states WHERE {_KEY_WHERE}", key
+    ).fetchone()
+    return Record(*row) if row is not None else None
+
+def write_records(records: List[Tuple[Key, Record]]) -> None:
+    """
+    Фиксирует пачку изменений одной транзакцией; пустые состояния удаляются
+    """
+    deleted = [key for key, record in records if record.is_empty()]
+    stored = [key + tuple(record) for key, record in records if not record.is_empty()]
+    with transaction() as cursor:
+        if deleted:
+            cursor.executemany(f"DELETE FROM fsm_states WHERE {_KEY_WHERE}", deleted)
+        if stored:
+            cursor.executemany("""
+                INSERT INTO fsm_states (bot_id, chat_id, user_id, thread_id, business_connection_id,
+                                        destiny, state, data, expires_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (bot_id, chat_id, user_id, thread_id, business_connection_id, destiny)
+                DO UPDATE SET state = excluded.state, data = excluded.data, expires_at = excluded.expires_at
+            """, stored)
+
+def delete_expired(now: float, limit: int = SWEEP_BATCH) -> int:
+    """Удаляет не больше limit истекших состояний и возвращает их число"""
+    with transaction() as cursor:
+        cursor.execute("""
+            DELETE FROM fsm_states
+            WHERE (bot_id, chat_id, user_id, thread_id, business_connection_id, destiny) IN (
+                SELECT bot_id, chat_id, user_id, thread_id, business_connection_id, destiny
+                FROM fsm_states WHERE expires_at <= ? LIMIT ?
+            )
+        """, (now, limit))
+        return cursor.rowcount
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM aiogram в таблице fsm_states с LRU-кэшем и пакетной записью.
+    В памяти держится не больше cache_size состояний и изменения, еще не записанные в базу,
+    поэтому память не растет с числом пользователей, а после перезапуска состояния читаются из базы.
+    Данные состояния должны сериализоваться в JSON.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL, cache_size: int = DEFAULT_CACHE_SIZE,
+                 flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 sweep_interval: float = DEFAULT_SWEEP_INTERVAL, max_pending: int = MAX_PENDING) -> None:
+        self.ttl = ttl
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.sweep_interval = sweep_interval
+        self.max_pending = max_pending
+        self._cache: "OrderedDict[Key, Record]" = OrderedDict()
+        # Изменения, ожидающие записи, и пачка, которая пишется прямо сейчас
+        self._pending: Dict[Key, Record] = {}
+        self._flushing: Dict[Key, Record] = {}
+        self._flush_lock = asyncio.Lock()
+        self._dirty = asyncio.Event()
+        self._full = asyncio.Event()
+        self._flush_task: Optional[asyncio.Task] = None
+        self._sweep_task: Optional[asyncio.Task] = None
+        # Ключи, которые сейчас читаются из базы: [число ожидающих чтений, число изменений ключа
+        # за время чтения]. Изменение во время чтения делает прочитанное устаревшим, и его не кэшируем;
+        # изменения других ключей на чтение не влияют
+        self._loading: Dict[Key, List[int]] = {}
+        self.hits = 0
+        self.misses = 0
+        self.rows_written = 0
+        self.batches = 0
+        self.expired = 0
+
+    def _start(self) -> None:
+        # Фоновые задачи запускаются при первом обращении, когда уже есть цикл событий;
+        # после close() хранилище можно снова использовать, в том числе в другом цикле
+        if self._flush_task is None:
+            self._flush_lock = asyncio.Lock()
+            self._dirty = asyncio.Event()
+            self._full = asyncio.Event()
+            if self._pending:
+                self._dirty.set()
+            self._flush_task = asyncio.create_task(self._flush_loop())
+        if self._sweep_task is None:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+
+    def _lookup(self, key: Key) -> Optional[Record]:
+        record = self._pending.get(key)
+        if record is None:
+            record = self._flushing.get(key)
+        if record is None:
+            record = self._cache.get(key)
+            if record is not None:
+                self._cache.move_to_end(key)
+        return record
+
+    def _remember(self, key: Key, record: Record) -> None:
+        self._cache[key] = record
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    async def _get(self, key: StorageKey) -> Tuple[Key, Record]:
+        self._start()
+        db_key = make_key(key)
+        record = self._lookup(db_key)
+        if record is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            loading = self._loading.setdefault(db_key, [0, 0])
+            loading[0] += 1
+            try:
+                while record is None:
+                    writes = loading[1]
+                    loaded = await async_db.run_db(load_record, db_key)
+                    record = self._lookup(db_key)
+                    if record is None and writes == loading[1]:
+                        record = loaded or EMPTY
+                        self._remember(db_key, record)
+            finally:
+                loading[0] -= 1
+                if not loading[0]:
+                    del self._loading[db_key]
+        if record.expires_at <= time.time():
+            record = EMPTY
+        return db_key, record
+
+    def _put(self, key: Key, record: Record) -> None:
+        # Между чтением в _get и этим вызовом нет await, поэтому изменение атомарно для цикла событий
+        if not record.is_empty():
+            record = record._replace(expires_at=time.time() + self.ttl)
+        loading = self._loading.get(key)
+        if loading is not None:
+            loading[1] += 1
+        self._pending[key] = record
+        self._remember(key, record)
+        self._dirty.set()
+        if len(self._pending) >= self.max_pending:
+            self._full.set()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        db_key, record = await self._get(key)
+        self._put(db_key, record._replace(state=state.state if isinstance(state, State) else state))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key))[1].state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        # Сериализуем сразу, чтобы ошибка досталась вызывающему, а не фоновой записи
+        encoded = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+        db_key, record = await self._get(key)
+        self._put(db_key, record._replace(data=encoded))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return json.loads((await self._get(key))[1].data)
+
+    async def flush(self) -> None:
+        """Записывает в базу все накопленные изменения"""
+        async with self._flush_lock:
+            if not self._pending:
+                return
+            self._flushing, self._pending = self._pending, {}
+            self._dirty.clear()
+            self._full.clear()
+            try:
+                await async_db.run_db(write_records, list(self._flushing.items()))
+                self.rows_written += len(self._flushing)
+                self.batches += 1
+            except Exception:
+                logging.exception(f"Не удалось записать {len(self._flushing)} состояний FSM, повторим позже")
+                # Более новые изменения тех же ключей важнее неудачной пачки
+                for key, record in self._flushing.items():
+                    self._pending.setdefault(key, record)
+                self._dirty.set()
+            finally:
+                self._flushing = {}
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await self._dirty.wait()
+            # Ждем попутные изменения, но не дольше flush_interval и не больше max_pending
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def sweep(self) -> int:
+        """
+        Удаляет истекшие состояния из базы и кэша, возвращает число удаленных строк
+        """
+        now = time.time()
+        removed = 0
+        while True:
+            deleted = await async_db.run_db(delete_expired, now, SWEEP_BATCH)
+            removed += deleted
+            if deleted < SWEEP_BATCH:
+                break
+        for key in [key for key, record in self._cache.items() if record.expires_at <= now]:
+            del self._cache[key]
+        self.expired += removed
+        return removed
+
+    async def _sweep_loop(self) -> None:
+        while True:
+            try:
+                removed = await self.sweep()
+                if removed:
+                    logging.info(f"Удалено истекших состояний FSM: {removed}")
+            except Exception:
+                logging.exception("Ошибка очистки истекших состояний FSM")
+            await asyncio.sleep(self.sweep_interval)
+
+    async def close(self) -> None:
+        """
+        Останавливает фоновые задачи и записывает оставшиеся изменения
+        """
+        # Под блокировкой задача записи не может оказаться посреди пачки
+        async with self._flush_lock:
+            tasks = [task for task in (self._flush_task, self._sweep_task) if task is not None]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._flush_task = None
+            self._sweep_task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "cached": len(self._cache),
+            "pending": len(self._pending),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "rows_written": self.rows_written,
+            "batches": self.batches,
+            "expired": self.expired,
+        }
@@ -0,0 +1,391 @@
+import logging
+import threading
+from contextlib import contextmanager
+from datetime import date
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sortedcontainers import SortedList
+
+import rollups
+from db_connection import get_connection, transaction
+from table_versions import LEADERBOARD, TableVersion, bump
+
+class LeaderboardIndex:
+    """
+    Отсортированный по дистанции список пользователей за одно окно (неделю или месяц).
+    Добавление пробежки и чтение топа выполняются за O(log n).
+    version увеличивается, только когда изменение затрагивает первые watch мест
+    (watch — наибольший запрошенный размер топа), по нему кэши топа проверяют актуальность.
+    """
+
+    def __init__(self, key: int) -> None:
+        self.key = key
+        self.totals: Dict[int, float] = {}
+        self._order = SortedList()
+        self.watch = 0
+        self.version = 0
+
+    def load(self, rows: List[Tuple[int, float]]) -> None:
+        self.totals = dict(rows)
+        self._order = SortedList((-distance, user_id) for user_id, distance in rows)
+        self.version += 1
+
+    def _in_top(self, entry: Tuple[float, int]) -> bool:
+        return self._order.bisect_left(entry) < self.watch
+
+    def in_top(self, user_id: int) -> bool:
+        """Входит ли пользователь в первые watch мест"""
+        total = self.totals.get(user_id)
+        return total is not None and self._in_top((-total, user_id))
+
+    def add(self, user_id: int, distance: float) -> None:
+        old = self.totals.get(user_id)
+        changed_top = False
+        if old is not None:
+            changed_top = self._in_top((-old, user_id))
+            self._order.remove((-old, user_id))
+        new = (old or 0) + distance
+        self.totals[user_id] = new
+        self._order.add((-new, user_id))
+        if changed_top or self._in_top((-new, user_id)):
+            self.version += 1
+
+    def remove_user(self, user_id: int) -> None:
+        old = self.totals.pop(user_id, None)
+        if old is not None:
+            if self._in_top((-old, user_id)):
+                self.version += 1
+            self._order.remove((-old, user_id))
+
+    def top(self, limit: int) -> List[Tuple[int, float]]:
+        return [(user_id, -neg_distance) for neg_distance, user_id in self._order[:limit]]
+
+    def __len__(self) -> int:
+        return len(self.totals)
+
+# Все изменения индексов и их прогрев выполняются под одной блокировкой,
+# чтобы пробежка не была учтена дважды (при прогреве и при добавлении)
+_lock = threading.RLock()
+_weekly: Optional[LeaderboardIndex] = None
+_monthly: Optional[LeaderboardIndex] = None
+_usernames: Dict[int, Optional[str]] = {}
+# Наибольший запрошенный размер топа: изменения ниже этих мест не меняют версию индексов
+_top_watch = 0
+# Увеличивается при перезагрузке индексов и смене имени пользователя из топа
+_generation = 0
+# Изменения агрегатов вне процесса (db_admin.py) замечаются по счетчику в table_versions
+_external_version = TableVersion(LEADERBOARD)
+_loaded_external = 0
+# Наибольший runs.id, учтенный в индексах. Пробежки с большим id, записанные другими процессами,
+# учитываются через catch_up()
+_last_run_id = 0
+# Индексы общие с другими процессами бота (воркерами supervisor.py), их изменения отслеживаются фоном
+_shared = False
+_follower: Optional[threading.Thread] = None
+_follower_stop = threading.Event()
+# Версия топов (см. state), которую пишущие публикуют под _lock после каждого изменения.
+# Кортеж заменяется целиком, поэтому state(load=False) читает его без блокировки и не ждет
+# записи пробежки, которая держит _lock на время транзакции
+_published: Optional[Tuple[int, int, int, int, int]] = None
+
+def _publish() -> None:
+    global _published
+    if _weekly is None or _monthly is None:
+        _published = None
+    else:
+        _published = (_generation, _weekly.key, _weekly.version, _monthly.key, _monthly.version)
+
+def warm(today: Optional[date] = None) -> None:
+    """
+    Загружает недельный и месячный индексы из таблиц агрегатов
+    """
+    global _weekly, _monthly, _generation, _loaded_external, _last_run_id
+    today = today or date.today()
+    week, month = rollups.week_key(today), rollups.month_key(today)
+
+    with _lock:
+        conn = get_connection()
+        cursor = conn.cursor()
+        # Агрегаты и последний учтенный id пробежки читаются из одного снимка базы
+        snapshot = not conn.in_transaction
+        if snapshot:
+            cursor.execute("BEGIN")
+        try:
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM runs")
+            last_run_id = cursor.fetchone()[0]
+
+            cursor.execute("SELECT user_id, distance FROM weekly_totals WHERE week_key = ?", (week,))
+            weekly = LeaderboardIndex(week)
+            weekly.load(cursor.fetchall())
+
+            cursor.execute("SELECT user_id, distance FROM monthly_totals WHERE month_key = ?", (month,))
+            monthly = LeaderboardIndex(month)
+            monthly.load(cursor.fetchall())
+
+            cursor.execute("""
+                SELECT user_id, username FROM users
+                WHERE user_id IN (
+                    SELECT user_id FROM weekly_totals WHERE week_key = ?
+                    UNION
+                    SELECT user_id FROM monthly_totals WHERE month_key = ?
+                )
+            """, (week, month))
+            _usernames.clear()
+            _usernames.update(cursor.fetchall())
+        finally:
+            if snapshot:
+                conn.commit()
+            cursor.close()
+
+        weekly.watch = monthly.watch = _top_watch
+        _weekly, _monthly = weekly, monthly
+        _last_run_id = last_run_id
+        _loaded_external = _external_version.current()
+        _generation += 1
+        _publish()
+
+def invalidate() -> None:
+    """
+    Сбрасывает индексы; при следующем обращении они будут загружены из БД заново
+    """
+    global _weekly, _monthly, _generation
+    with _lock:
+        _weekly = _monthly = None
+        _generation += 1
+        _publish()
+
+def sync_external() -> bool:
+    """
+    Перезагружает индексы, если агрегаты изменили вне процесса (например, db_admin.py
+    удалил пользователя). Возвращает True, если индексы были перезагружены.
+    """
+    with _lock:
+        if _weekly is None or _external_version.current() == _loaded_external:
+            return False
+        warm()
+        return True
+
+def state(load: bool = True) -> Optional[Tuple[int, int, int, int, int]]:
+    """
+    Версия топов недели и месяца: меняется, когда меняется состав или километраж первых мест,
+    имя их участника или окно (новая неделя или месяц). Если load=False и индексы
+    не загружены или относятся к прошедшему окну, возвращает None, не обращаясь к базе
+    и не беря блокировку (такой вызов допустим из цикла событий).
+    """
+    today = date.today()
+    if not load:
+        published = _published
+        if (published is None or published[1] != rollups.week_key(today)
+                or published[3] != rollups.month_key(today)):
+            return None
+        return published
+    with _lock:
+        _current(today)
+        return _published
+
+def _current(today: date) -> Tuple[LeaderboardIndex, LeaderboardIndex]:
+    # На границе недели или месяца индексы перезагружаются для нового окна
+    if (_weekly is None or _monthly is None
+            or _weekly.key != rollups.week_key(today)
+            or _monthly.key != rollups.month_key(today)):
+        warm(today)
+    return _weekly, _monthly
+
+@contextmanager
+def updating() -> Iterator[None]:
+    """
+    Блокировка, под которой фиксируется запись пробежки и обновляются индексы
+    """
+    with _lock:
+        yield
+
+def _apply_run(user_id: int, username: Optional[str], day: date, distance: float) -> None:
+    if _weekly.key == rollups.week_key(day):
+        _weekly.add(user_id, distance)
+    if _monthly.key == rollups.month_key(day):
+        _monthly.add(user_id, distance)
+    _usernames[user_id] = username
+    _publish()
+
+def record_run(user_id: int, username: Optional[str], day: date, distance: float,
+               run_id: Optional[int] = None) -> None:
+    """
+    Учитывает зафиксированную в БД пробежку в индексах текущей недели и месяца.
+    Если перед run_id есть пробежки, записанные другими процессами, учитывает и их.
+    """
+    global _last_run_id
+    with _lock:
+        if _weekly is None or _monthly is None:
+            # Индексы еще не загружены и прочитают пробежку из БД при прогреве
+            return
+        if run_id is not None:
+            if run_id <= _last_run_id:
+                # Уже учтена через catch_up()
+                return
+            if run_id != _last_run_id + 1:
+                # Пробежка уже зафиксирована, поэтому catch_up() прочитает и ее
+                catch_up()
+                return
+            _last_run_id = run_id
+        _apply_run(user_id, username, day, distance)
+
+def catch_up() -> int:
+    """
+    Учитывает пробежки, записанные после последней учтенной (другими процессами).
+    Возвращает число учтенных пробежек.
+    """
+    global _last_run_id
+    with _lock:
+        if _weekly is None or _monthly is None:
+            return 0
+        # Пробежки раньше загруженных недели и месяца (например, импорт истории) индексы
+        # не меняют: они отбрасываются в запросе, а последний учтенный id берется из того же
+        # снимка базы, поэтому такие пробежки не читаются повторно
+        since = min(
+            date.fromisocalendar(_weekly.key // 100, _weekly.key % 100, 1),
+            date(_monthly.key // 100, _monthly.key % 100, 1),
+        )
+        conn = get_connection()
+        cursor = conn.cursor()
+        snapshot = not conn.in_transaction
+        if snapshot:
+            cursor.execute("BEGIN")
+        try:
+            cursor.execute("SELECT COALESCE(MAX(id), 0) FROM runs")
+            last_run_id = cursor.fetchone()[0]
+            if last_run_id <= _last_run_id:
+                return 0
+            cursor.execute("""
+                SELECT r.id, r.user_id, r.run_day, r.run_date, r.distance, u.username
+                FROM runs r LEFT JOIN users u ON u.user_id = r.user_id
+                WHERE r.id > ? AND r.id <= ? AND (r.run_day >= ? OR r.run_day IS NULL)
+                ORDER BY r.id
+            """, (_last_run_id, last_run_id, rollups.day_key(since)))
+            rows = cursor.fetchall()
+        finally:
+            if snapshot:
+                conn.commit()
+            cursor.close()
+        applied = 0
+        for run_id, user_id, run_day, run_date, distance, username in rows:
+            day = date.fromordinal(run_day) if run_day is not None else date.fromisoformat(run_date)
+            if day >= since:
+                _apply_run(user_id, username, day, distance)
+                applied += 1
+        _last_run_id = last_run_id
+        return applied
+
+def set_username(user_id: int, username: Optional[str]) -> None:
+    global _generation
+    with _lock:
+        if user_id in _usernames and _usernames[user_id] != username:
+            _usernames[user_id] = username
+            if any(index is not None and index.in_top(user_id) for index in (_weekly, _monthly)):
+                _generation += 1
+                _publish()
+                if _shared:
+                    # Имя из топа показывают и другие процессы: они перечитают индексы
+                    with transaction() as cursor:
+                        bump(cursor, LEADERBOARD)
+
+def remove_user(user_id: int) -> None:
+    """
+    Убирает пользователя из индексов (после удаления его пробежек)
+    """
+    with _lock:
+        if _weekly is not None:
+            _weekly.remove_user(user_id)
+        if _monthly is not None:
+            _monthly.remove_user(user_id)
+        _usernames.pop(user_id, None)
+        _publish()
+
+def follow(interval: float) -> None:
+    """
+    Цикл фонового потока: при фиксации изменений другим соединением (PRAGMA data_version)
+    учитывает новые пробежки, а при изменении счетчика leaderboard перечитывает индексы
+    """
+    data_version = None
+    while not _follower_stop.wait(interval):
+        try:
+            current = get_connection().execute("PRAGMA data_version").fetchone()[0]
+            if current == data_version:
+                continue
+            data_version = current
+            if not sync_external():
+                catch_up()
+        except Exception:
+            logging.exception("Ошибка синхронизации таблицы лидеров с другими процессами")
+
+def start_follower(interval: float = 0.1) -> None:
+    """
+    Запускает фоновое отслеживание пробежек и сбросов, сделанных другими процессами бота
+    """
+    global _follower, _shared
+    if _follower is not None:
+        return
+    _shared = True
+    _follower_stop.clear()
+    _follower = threading.Thread(target=follow, args=(interval,), name='leaderboard-follower', daemon=True)
+    _follower.start()
+
+def stop_follower() -> None:
+    global _follower
+    if _follower is None:
+        return
+    _follower_stop.set()
+    _follower.join()
+    _follower = None
+
+def _watch_top(limit: int, weekly: LeaderboardIndex, monthly: LeaderboardIndex) -> None:
+    global _top_watch
+    if limit > _top_watch:
+        _top_watch = weekly.watch = monthly.watch = limit
+
+def top_weekly(limit: int) -> List[Tuple[int, Optional[str], float]]:
+    """
+    Возвращает (user_id, username, недельная дистанция) лидеров недели
+    """
+    with _lock:
+        weekly, monthly = _current(date.today())
+        _watch_top(limit, weekly, monthly)
+        return [(user_id, _usernames.get(user_id), distance) for user_id, distance in weekly.top(limit)]
+
+def top_monthly(limit: int) -> List[Tuple[int, Optional[str], float, float]]:
+    """
+    Возвращает (user_id, username, месячная дистанция, недельная дистанция) лидеров месяца
+    """
+    with _lock:
+        weekly, monthly = _current(date.today())
+        _watch_top(limit, weekly, monthly)
+        return [
+            (user_id, _usernames.get(user_id), distance, weekly.totals.get(user_id, 0))
+            for user_id, distance in monthly.top(limit)
+        ]
+
+def check_consistency(limit: int = 10) -> List[str]:
+    """
+    Сравнивает топ из памяти с результатом агрегирующего SQL-запроса по таблице runs.
+    Возвращает список найденных расхождений (пустой, если все совпадает).
+    """
+    from database import compute_leaderboard
+
+    problems = []
+    windows = [
+        ("неделя", top_weekly(limit), compute_leaderboard(("week",), "week", limit), "weekly_distance"),
+        ("месяц", top_monthly(limit), compute_leaderboard(("month",), "month", limit), "monthly_distance"),
+    ]
+    for title, memory_rows, sql_rows, key in windows:
+        if len(sql_rows) != len(memory_rows):
+            problems.append(f"{title}: в памяти {len(memory_rows)} строк, в SQL {len(sql_rows)}")
+            continue
+
+        for position, (sql_row, memory_row) in enumerate(zip(sql_rows, memory_rows), 1):
+            # При равных дистанциях порядок пользователей может отличаться
+            mem_user, mem_total = memory_row[0], memory_row[2]
+            if abs(sql_row[key] - mem_total) > 1e-6:
+                problems.append(
+                    f"{title}, место {position}: SQL {sql_row['user_id']}={sql_row[key]:.3f}, "
+                    f"память {mem_user}={mem_total:.3f}"
+                )
+    return problems
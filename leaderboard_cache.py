@@ -0,0 +1,119 @@
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+import database
+import leaderboard
+from messages import format_leaderboard
+
+# Значения по умолчанию: сколько секунд запись считается свежей и сколько мест показывать
+DEFAULT_TTL = 30.0
+DEFAULT_LIMIT = 10
+
+class RenderedLeaderboard(NamedTuple):
+    text: str
+    weekly: List[Dict[str, Any]]
+    monthly: List[Dict[str, Any]]
+    state: Tuple[int, ...]
+    created: float
+
+class LeaderboardCache:
+    """
+    Готовый текст таблицы лидеров и строки, из которых он собран, — общие для всех пользователей.
+    Запись действительна, пока не изменились первые места недели и месяца (leaderboard.state())
+    и не прошло ttl секунд. ttl ограничивает устаревание из-за того, что версия топа не отражает:
+    переименования рангов и изменений агрегатов вне процесса бота.
+    """
+
+    def __init__(self, ttl: float = DEFAULT_TTL, limit: int = DEFAULT_LIMIT) -> None:
+        self.ttl = ttl
+        self.limit = limit
+        self._entry: Optional[RenderedLeaderboard] = None
+        # Одновременные промахи собирают таблицу один раз
+        self._build_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.expirations = 0
+
+    def _fresh(self, entry: Optional[RenderedLeaderboard], load: bool) -> bool:
+        return (entry is not None and time.monotonic() - entry.created < self.ttl
+                and leaderboard.state(load) == entry.state)
+
+    def peek(self) -> Optional[RenderedLeaderboard]:
+        """
+        Актуальная запись или None. Не обращается к базе, поэтому вызывается прямо из цикла событий.
+        """
+        entry = self._entry
+        if not self._fresh(entry, load=False):
+            return None
+        with self._stats_lock:
+            self.hits += 1
+        return entry
+
+    def get(self) -> RenderedLeaderboard:
+        """
+        Возвращает актуальную запись, при необходимости собирая таблицу заново (обращается к базе)
+        """
+        entry = self.peek()
+        if entry is not None:
+            return entry
+
+        with self._build_lock:
+            entry = self._entry
+            if self._fresh(entry, load=True):
+                with self._stats_lock:
+                    self.hits += 1
+                return entry
+
+            expired = entry is not None and time.monotonic() - entry.created >= self.ttl
+            with self._stats_lock:
+                self.misses += 1
+                if expired:
+                    self.expirations += 1
+                elif entry is not None:
+                    self.invalidations += 1
+            if expired:
+                # Раз в ttl проверяем, не изменил ли агрегаты db_admin.py
+                leaderboard.sync_external()
+
+            # Версия читается до сборки: изменение во время сборки приведет к повторной сборке
+            state = leaderboard.state()
+            weekly = database.get_weekly_leaderboard(self.limit)
+            monthly = database.get_monthly_leaderboard(self.limit)
+            entry = RenderedLeaderboard(
+                format_leaderboard(weekly, monthly), weekly, monthly, state, time.monotonic()
+            )
+            self._entry = entry
+            return entry
+
+    def invalidate(self) -> None:
+        self._entry = None
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "expirations": self.expirations,
+            }
+
+# Общий для процесса кэш таблицы лидеров
+cache = LeaderboardCache()
+
+def configure(ttl: float, limit: int = DEFAULT_LIMIT) -> None:
+    global cache
+    cache = LeaderboardCache(ttl, limit)
+
+def get_leaderboard() -> RenderedLeaderboard:
+    return cache.get()
+
+def get_stats() -> Dict[str, Any]:
+    """
+    Возвращает метрики кэша таблицы лидеров: попадания, промахи, сбросы по изменению топа и по ttl
+    """
+    return cache.stats()
@@ -1,12 +1,14 @@
 import random
-from typing import List
-from db_utils import get_random_motivation_db
+from datetime import date
+from typing import Any, Dict, List, Optional
+import catalogs
 
-def get_random_motivation() -> str:
+def get_random_motivation(user_id: Optional[int] = None) -> str:
     """
-    Возвращает случайное мотивационное сообщение из базы данных.
+    Возвращает случайное мотивационное сообщение из кэша каталогов.
+    Если указан user_id, последние показанные ему сообщения по возможности не повторяются.
     """
-    return get_random_motivation_db()
+    return catalogs.get_random_motivation(user_id)
 
 # Шаблоны сообщений для различных команд
 WELCOME_MESSAGE = """
@@ -34,6 +36,8 @@ HELP_MESSAGE = """
 /leaderboard — Показать таблицу лидеров по километражу
 /help — Показать эту справку
 
+Чтобы перенести историю из часов или другого приложения, пришли файл выгрузки CSV, GPX или FIT.
+
 Система рангов:
 🔹 Падаван (0-10 км в неделю)
 🔹 Рыцарь-джедай (11-30 км в неделю)
@@ -77,4 +81,57 @@ WEEKLY_REPORT_MESSAGE = """
 {details}
 
 Новая неделя - новые возможности! Да пребудет с тобой Сила! 💫
-""" 
\ No newline at end of file
+"""
+
+def format_weekly_report(start_date: date, end_date: date, weekly_distance: float,
+                         rank: str, weekly_runs: Dict[str, float]) -> str:
+    """
+    Формирует текст еженедельного отчета; weekly_runs — километраж по ISO-датам
+    """
+    details = ""
+    for run_date, distance in sorted(weekly_runs.items()):
+        details += f"• {date.fromisoformat(run_date).strftime('%d.%m')}: {distance:.1f} км\n"
+    
+    return WEEKLY_REPORT_MESSAGE.format(
+        start_date=start_date.strftime('%d.%m'),
+        end_date=end_date.strftime('%d.%m'),
+        weekly_distance=weekly_distance,
+        rank=rank,
+        details=details
+    )
+
+IMPORT_STARTED_MESSAGE = "⏳ Загружаю пробежки из файла, это может занять некоторое время..."
+
+IMPORT_RESULT_MESSAGE = """
+📥 Импорт завершен!
+
+Тренировок в файле: {parsed}
+Добавлено пробежек: {imported} ({distance:.1f} км)
+Уже были записаны: {duplicates}
+Пропущено (не пробежки или без даты и дистанции): {skipped}
+"""
+
+IMPORT_FAILED_MESSAGE = "⚠️ Не удалось прочитать файл: {error}"
+
+IMPORT_TOO_LARGE_MESSAGE = "⚠️ Файл слишком большой: можно прислать до {limit:.0f} МБ."
+
+LEADERBOARD_EMPTY_MESSAGE = "📊 Пока никто не бегал на этой неделе. Будь первым! 🏃‍♂️"
+
+def format_leaderboard(weekly_leaders: List[Dict[str, Any]], monthly_leaders: List[Dict[str, Any]]) -> str:
+    """
+    Формирует текст таблицы лидеров за неделю и месяц
+    """
+    if not weekly_leaders:
+        return LEADERBOARD_EMPTY_MESSAGE
+    
+    # Формируем таблицу лидеров за неделю
+    weekly_leaderboard = "🏆 Таблица лидеров за неделю:\n\n"
+    for i, leader in enumerate(weekly_leaders, 1):
+        weekly_leaderboard += f"{i}. {leader['username']}: {leader['weekly_distance']:.1f} км — {leader['rank']}\n"
+    
+    # Формируем таблицу лидеров за месяц
+    monthly_leaderboard = "\n🏆 Таблица лидеров за месяц:\n\n"
+    for i, leader in enumerate(monthly_leaders, 1):
+        monthly_leaderboard += f"{i}. {leader['username']}: {leader['monthly_distance']:.1f} км — {leader['rank']}\n"
+    
+    return weekly_leaderboard + monthly_leaderboard
@@ -0,0 +1,381 @@
+import bisect
+import contextvars
+import re
+import sqlite3
+import threading
+import time
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional, Sequence, Tuple
+
+import db_connection
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+# Метрики бота в формате Prometheus: задержка обработчиков, время и число SQL-запросов
+# в каждом вызове обработчика, время функций БД (включая ожидание пула потоков) и запросов
+# к Bot API. Запросы SQLite замеряет курсор ProfiledCursor, число шагов виртуальной машины
+# считает progress handler соединения. Вызов обработчика хранится в ContextVar, а async_db.run_db
+# переносит контекст в поток БД, поэтому запросы приписываются обработчику, который их вызвал.
+# Модуль импортируется слоем данных (async_db), поэтому aiogram и aiohttp он не импортирует:
+# middleware — обычные вызываемые объекты, сервер метрик импортирует aiohttp при запуске.
+
+# Границы корзин гистограмм времени (секунды) и числа запросов
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55)
+
+# Progress handler вызывается раз в столько инструкций виртуальной машины SQLite
+PROGRESS_STEPS = 1000
+
+# Сколько различных запросов учитывать отдельно; остальные попадают в строку OTHER_QUERY
+MAX_QUERIES = 500
+OTHER_QUERY = "other"
+MAX_QUERY_LENGTH = 200
+
+# Запросы, выполненные вне обработчиков (фоновые задачи, рассылка)
+NO_HANDLER = "-"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 9100
+
+# Включает замеры в run_db и обработчиках; курсоры замеряют запросы, пока включен ProfiledConnection
+ENABLED = False
+
+_PLACEHOLDER_LIST = re.compile(r"\b(IN\s*\()\?(\s*,\s*\?)+", re.IGNORECASE)
+
+def normalize_query(sql: str) -> str:
+    """Приводит запрос к метке: одна строка, списки параметров IN (?, ?, ...) схлопнуты"""
+    normalized = _PLACEHOLDER_LIST.sub(r"\1?, ...", " ".join(sql.split()))
+    return normalized[:MAX_QUERY_LENGTH]
+
+class Histogram:
+    def __init__(self, buckets: Sequence[float]) -> None:
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class QueryStats:
+    __slots__ = ("count", "seconds", "max_seconds", "steps")
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.steps = 0
+
+class HandlerCall:
+    """Затраты одного вызова обработчика: SQL-запросы, их время и время запросов к Bot API"""
+    __slots__ = ("handler", "queries", "db_seconds", "api_seconds")
+
+    def __init__(self, handler: str) -> None:
+        self.handler = handler
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.api_seconds = 0.0
+
+_current_call: contextvars.ContextVar[Optional[HandlerCall]] = contextvars.ContextVar(
+    "metrics_handler_call", default=None
+)
+
+class Registry:
+    """
+    Накопленные метрики процесса; обновляются из цикла событий и потоков БД под одной блокировкой
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.handler_seconds: Dict[str, Histogram] = {}
+        self.handler_queries: Dict[str, Histogram] = {}
+        self.handler_db_seconds: Dict[str, Histogram] = {}
+        self.handler_api_seconds: Dict[str, Histogram] = {}
+        self.handler_errors: Dict[str, int] = {}
+        self.db_calls: Dict[str, Histogram] = {}
+        self.api_requests: Dict[str, Histogram] = {}
+        self.queries: Dict[Tuple[str, str], QueryStats] = {}
+        self._gauges: List[Tuple[str, Optional[str], Callable[[], Dict[str, Any]]]] = []
+
+    @staticmethod
+    def _histogram(table: Dict[str, Histogram], key: str, buckets: Sequence[float]) -> Histogram:
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram(buckets)
+        return histogram
+
+    def observe_handler(self, call: HandlerCall, seconds: float, failed: bool) -> None:
+        with self._lock:
+            self._histogram(self.handler_seconds, call.handler, LATENCY_BUCKETS).observe(seconds)
+            self._histogram(self.handler_queries, call.handler, COUNT_BUCKETS).observe(call.queries)
+            self._histogram(self.handler_db_seconds, call.handler, LATENCY_BUCKETS).observe(call.db_seconds)
+            self._histogram(self.handler_api_seconds, call.handler, LATENCY_BUCKETS).observe(call.api_seconds)
+            if failed:
+                self.handler_errors[call.handler] = self.handler_errors.get(call.handler, 0) + 1
+
+    def observe_db_call(self, function: str, seconds: float) -> None:
+        with self._lock:
+            self._histogram(self.db_calls, function, LATENCY_BUCKETS).observe(seconds)
+
+    def observe_api_request(self, method: str, seconds: float) -> None:
+        with self._lock:
+            self._histogram(self.api_requests, method, LATENCY_BUCKETS).observe(seconds)
+
+    def observe_query(self, sql: str, seconds: float, steps: int, executed: bool) -> None:
+        """
+        Учитывает выполнение запроса (executed=True) или дочитывание его строк
+        """
+        call = _current_call.get()
+        handler = call.handler if call is not None else NO_HANDLER
+        query = normalize_query(sql)
+        with self._lock:
+            stats = self.queries.get((handler, query))
+            if stats is None:
+                if len(self.queries) >= MAX_QUERIES:
+                    query = OTHER_QUERY
+                stats = self.queries.setdefault((handler, query), QueryStats())
+            if executed:
+                stats.count += 1
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.steps += steps
+            if call is not None:
+                if executed:
+                    call.queries += 1
+                call.db_seconds += seconds
+
+    def register_gauges(self, prefix: str, collect: Callable[[], Dict[str, Any]],
+                        label: Optional[str] = None) -> None:
+        """
+        Добавляет числовые значения словаря collect() как метрики prefix_<ключ>.
+        Если задан label, collect() возвращает словари значений по значениям этой метки.
+        """
+        self._gauges.append((prefix, label, collect))
+
+    def render(self) -> str:
+        """Текст метрик в формате Prometheus"""
+        lines: List[str] = []
+        with self._lock:
+            _render_histograms(lines, "bot_handler_seconds", "Время обработки сообщения обработчиком",
+                               "handler", self.handler_seconds)
+            _render_histograms(lines, "bot_handler_db_queries", "SQL-запросов за вызов обработчика",
+                               "handler", self.handler_queries)
+            _render_histograms(lines, "bot_handler_db_seconds", "Время SQL-запросов за вызов обработчика",
+                               "handler", self.handler_db_seconds)
+            _render_histograms(lines, "bot_handler_api_seconds", "Время запросов к Bot API за вызов обработчика",
+                               "handler", self.handler_api_seconds)
+            lines.append("# HELP bot_handler_errors_total Вызовы обработчика, завершившиеся исключением")
+            lines.append("# TYPE bot_handler_errors_total counter")
+            for handler, errors in sorted(self.handler_errors.items()):
+                lines.append(f"bot_handler_errors_total{_labels(handler=handler)} {errors}")
+            _render_histograms(lines, "bot_db_call_seconds",
+                               "Время функций БД в async_db.run_db, включая ожидание пула потоков",
+                               "function", self.db_calls)
+            _render_histograms(lines, "bot_api_request_seconds", "Время запросов к Bot API",
+                               "method", self.api_requests)
+            queries = sorted(self.queries.items())
+            for name, kind, help_text, value in (
+                ("bot_db_query_seconds_total", "counter", "Суммарное время SQL-запроса",
+                 lambda stats: stats.seconds),
+                ("bot_db_query_total", "counter", "Число выполнений SQL-запроса",
+                 lambda stats: stats.count),
+                ("bot_db_query_max_seconds", "gauge", "Наибольшее время одного выполнения SQL-запроса",
+                 lambda stats: stats.max_seconds),
+                ("bot_db_query_vm_steps_total", "counter",
+                 f"Шагов виртуальной машины SQLite (с точностью до {PROGRESS_STEPS})",
+                 lambda stats: stats.steps),
+            ):
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {kind}")
+                for (handler, query), stats in queries:
+                    lines.append(f"{name}{_labels(handler=handler, query=query)} {_number(value(stats))}")
+        for prefix, label, collect in self._gauges:
+            values = collect()
+            groups = values.items() if label else [(None, values)]
+            for group, group_values in groups:
+                for key, value in group_values.items():
+                    if isinstance(value, (int, float)) and not isinstance(value, bool):
+                        labels = _labels(**{label: group}) if label else ""
+                        lines.append(f"{prefix}_{key}{labels} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def _labels(**labels: Any) -> str:
+    return "{" + ",".join(f'{key}="{_escape(str(value))}"' for key, value in labels.items()) + "}"
+
+def _number(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _render_histograms(lines: List[str], name: str, help_text: str, label: str,
+                       histograms: Dict[str, Histogram]) -> None:
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for key, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(**{label: key, 'le': _number(bound)})} {cumulative}")
+        lines.append(f"{name}_sum{_labels(**{label: key})} {_number(histogram.sum)}")
+        lines.append(f"{name}_count{_labels(**{label: key})} {histogram.count}")
+
+registry = Registry()
+
+# Замер SQL-запросов
+
+_steps = threading.local()
+
+def _count_steps() -> int:
+    _steps.value = getattr(_steps, "value", 0) + PROGRESS_STEPS
+    return 0
+
+def _current_steps() -> int:
+    return getattr(_steps, "value", 0)
+
+class ProfiledCursor(sqlite3.Cursor):
+    """
+    Курсор, учитывающий время выполнения запроса и чтения его строк через fetch*
+    """
+    _sql = ""
+
+    def execute(self, sql: str, parameters: Any = ()) -> "ProfiledCursor":
+        self._sql = sql
+        steps = _current_steps()
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            registry.observe_query(sql, time.perf_counter() - start, _current_steps() - steps, True)
+
+    def executemany(self, sql: str, seq_of_parameters: Any) -> "ProfiledCursor":
+        self._sql = sql
+        steps = _current_steps()
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            registry.observe_query(sql, time.perf_counter() - start, _current_steps() - steps, True)
+
+    def _timed_fetch(self, fetch: Callable[..., Any], *args: Any) -> Any:
+        steps = _current_steps()
+        start = time.perf_counter()
+        try:
+            return fetch(*args)
+        finally:
+            if self._sql:
+                registry.observe_query(self._sql, time.perf_counter() - start, _current_steps() - steps, False)
+
+    def fetchone(self) -> Any:
+        return self._timed_fetch(super().fetchone)
+
+    def fetchmany(self, size: Optional[int] = None) -> List[Any]:
+        if size is None:
+            return self._timed_fetch(super().fetchmany)
+        return self._timed_fetch(super().fetchmany, size)
+
+    def fetchall(self) -> List[Any]:
+        return self._timed_fetch(super().fetchall)
+
+class ProfiledConnection(sqlite3.Connection):
+    """
+    Соединение, все курсоры которого замеряют запросы, с подсчетом шагов виртуальной машины
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.set_progress_handler(_count_steps, PROGRESS_STEPS)
+
+    def cursor(self, factory: Any = None) -> sqlite3.Cursor:
+        return super().cursor(factory or ProfiledCursor)
+
+    # Connection.execute создает обычный курсор в обход cursor()
+    def execute(self, sql: str, parameters: Any = ()) -> sqlite3.Cursor:
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Any) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+def enable() -> None:
+    """
+    Включает сбор метрик; соединения с базой переоткрываются с замером запросов
+    """
+    global ENABLED
+    ENABLED = True
+    db_connection.configure(factory=ProfiledConnection)
+
+def observe_db_call(function: Callable[..., Any], seconds: float) -> None:
+    registry.observe_db_call(getattr(function, "__name__", type(function).__name__), seconds)
+
+# Middleware aiogram (aiogram принимает любой вызываемый объект с сигнатурой BaseMiddleware)
+
+class HandlerMetricsMiddleware:
+    """
+    Внутренний middleware роутера: замеряет вызов обработчика и собирает затраты этого вызова
+    """
+
+    async def __call__(self, handler: Callable[[Any, Dict[str, Any]], Awaitable[Any]],
+                       event: Any, data: Dict[str, Any]) -> Any:
+        if not ENABLED:
+            return await handler(event, data)
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        call = HandlerCall(name)
+        token = _current_call.set(call)
+        failed = False
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            _current_call.reset(token)
+            registry.observe_handler(call, time.perf_counter() - start, failed)
+
+class ApiMetricsMiddleware:
+    """
+    Middleware сессии бота: время каждого запроса к Bot API по методам.
+    Подключается после outbox, поэтому ожидание в очереди отправки сюда не входит.
+    """
+
+    async def __call__(self, make_request: Any, bot: Any, method: Any) -> Any:
+        if not ENABLED:
+            return await make_request(bot, method)
+        start = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            elapsed = time.perf_counter() - start
+            registry.observe_api_request(type(method).__name__, elapsed)
+            call = _current_call.get()
+            if call is not None:
+                call.api_seconds += elapsed
+
+# HTTP-сервер метрик
+
+def create_app() -> "web.Application":
+    from aiohttp import web
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(body=registry.render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    return app
+
+async def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT) -> "web.AppRunner":
+    """
+    Запускает сервер метрик на host:port (GET /metrics); остановка — await runner.cleanup()
+    """
+    from aiohttp import web
+
+    runner = web.AppRunner(create_app())
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
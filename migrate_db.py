@@ -1,40 +1,383 @@
+import argparse
+import datetime
+import os
+import re
+import shutil
 import sqlite3
 import sys
+import tempfile
+import threading
+import time
+from typing import Any, Callable, List, Optional, Tuple
 
-DB_PATH = 'running_bot.db'
+import db_connection
+import rollups
+import table_versions
+from db_connection import get_connection
 
-def migrate_database():
+# Миграция: (версия, описание, функция, выполняющая изменения схемы).
+# Текущая версия схемы хранится в PRAGMA user_version, миграции применяются по возрастанию версии.
+Migration = Tuple[int, str, Callable[[sqlite3.Cursor], None]]
+
+def _add_username_column(cursor: sqlite3.Cursor) -> None:
     """Добавляет столбец username в таблицу users, если его нет"""
-    print("Начинаю миграцию базы данных...")
-    
-    conn = sqlite3.connect(DB_PATH)
+    cursor.execute("PRAGMA table_info(users)")
+    column_names = [column[1] for column in cursor.fetchall()]
+    if 'username' not in column_names:
+        cursor.execute("ALTER TABLE users ADD COLUMN username TEXT")
+
+def _add_runs_indexes(cursor: sqlite3.Cursor) -> None:
+    """Покрывающие индексы для выборок пробежек по пользователю и по диапазону дат"""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_runs_user_date ON runs (user_id, run_date, distance)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_runs_date_user ON runs (run_date, user_id, distance)")
+
+def _add_rollup_tables(cursor: sqlite3.Cursor) -> None:
+    """Недельные и месячные агрегаты пробежек, заполненные по существующим данным"""
+    rollups.create_tables(cursor)
+    rollups.rebuild(cursor)
+
+# Индексы по текстовой дате, которые заменяются индексами по номеру дня после заполнения run_day
+LEGACY_DATE_INDEXES = ("idx_runs_user_date", "idx_runs_date_user")
+
+def _add_run_day_column(cursor: sqlite3.Cursor) -> None:
+    """
+    Целочисленный номер дня пробежки и индексы по нему.
+    Существующие строки заполняются позже небольшими пачками (см. backfill_run_days),
+    а триггер заполняет run_day для пробежек, которые добавляет код, еще не знающий о столбце.
+    """
+    cursor.execute("PRAGMA table_info(runs)")
+    if 'run_day' not in [column[1] for column in cursor.fetchall()]:
+        cursor.execute("ALTER TABLE runs ADD COLUMN run_day INTEGER")
+    cursor.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS runs_fill_run_day AFTER INSERT ON runs
+        WHEN NEW.run_day IS NULL AND NEW.run_date IS NOT NULL
+        BEGIN
+            UPDATE runs SET run_day = {rollups.RUN_DAY_SQL} WHERE id = NEW.id;
+        END
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_runs_user_day ON runs (user_id, run_day, distance)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_runs_day_user ON runs (run_day, user_id, distance)")
+
+    # В пустой таблице заполнять нечего, старые индексы можно удалить сразу
+    cursor.execute("SELECT EXISTS (SELECT 1 FROM runs)")
+    if not cursor.fetchone()[0]:
+        _drop_legacy_date_indexes(cursor)
+
+def _drop_legacy_date_indexes(cursor: sqlite3.Cursor) -> None:
+    for name in LEGACY_DATE_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+
+def _add_table_versions(cursor: sqlite3.Cursor) -> None:
+    """Счетчик изменений таблицы ranks, по которому перечитывается таблица рангов в памяти"""
+    table_versions.track(cursor, ["ranks"])
+
+def _add_catalog_weights(cursor: sqlite3.Cursor) -> None:
+    """Веса заданий и мотивационных сообщений и счетчики изменений этих таблиц"""
+    for table in ("challenges", "motivational_messages"):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if 'weight' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN weight REAL NOT NULL DEFAULT 1")
+    table_versions.track(cursor, ["challenges", "motivational_messages"])
+
+def _add_report_deliveries(cursor: sqlite3.Cursor) -> None:
+    """Журнал рассылки еженедельных отчетов, по которому она продолжается после перезапуска"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS report_broadcasts (
+            week_key INTEGER PRIMARY KEY,
+            started_at TEXT NOT NULL,
+            finished_at TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS report_deliveries (
+            week_key INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 1,
+            delivered_at TEXT NOT NULL,
+            PRIMARY KEY (week_key, user_id)
+        ) WITHOUT ROWID
+    """)
+    # Постраничный обход пользователей, бегавших на неделе, по возрастанию user_id
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_weekly_totals_week_user ON weekly_totals (week_key, user_id)")
+
+def _add_fsm_states(cursor: sqlite3.Cursor) -> None:
+    """Состояния диалогов (FSM) бота, переживающие перезапуск"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS fsm_states (
+            bot_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            thread_id INTEGER NOT NULL,
+            business_connection_id TEXT NOT NULL,
+            destiny TEXT NOT NULL,
+            state TEXT,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL,
+            PRIMARY KEY (bot_id, chat_id, user_id, thread_id, business_connection_id, destiny)
+        ) WITHOUT ROWID
+    """)
+    # Удаление истекших состояний фоновой очисткой
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fsm_states_expires ON fsm_states (expires_at)")
+
+MIGRATIONS: List[Migration] = [
+    (1, "Столбец username в таблице users", _add_username_column),
+    (2, "Индексы runs(user_id, run_date) и runs(run_date)", _add_runs_indexes),
+    (3, "Таблицы агрегатов weekly_totals и monthly_totals", _add_rollup_tables),
+    (4, "Столбец runs.run_day и индексы по номеру дня", _add_run_day_column),
+    (5, "Счетчики версий справочных таблиц", _add_table_versions),
+    (6, "Веса заданий и мотивационных сообщений", _add_catalog_weights),
+    (7, "Журнал рассылки еженедельных отчетов", _add_report_deliveries),
+    (8, "Таблица состояний диалогов fsm_states", _add_fsm_states),
+]
+
+def get_schema_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+def apply_migrations(conn: Optional[sqlite3.Connection] = None, verbose: bool = False) -> int:
+    """
+    Применяет все недостающие миграции и возвращает итоговую версию схемы.
+    Каждая миграция выполняется в отдельной транзакции вместе с обновлением версии.
+    """
+    if conn is None:
+        conn = get_connection()
+
+    for version, description, migrate in MIGRATIONS:
+        if get_schema_version(conn) >= version:
+            continue
+
+        cursor = conn.cursor()
+        # BEGIN IMMEDIATE не дает двум процессам применить одну миграцию одновременно
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            if get_schema_version(conn) < version:
+                if verbose:
+                    print(f"Применяю миграцию {version}: {description}...")
+                migrate(cursor)
+                cursor.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+    return get_schema_version(conn)
+
+def backfill_pending(conn: Optional[sqlite3.Connection] = None) -> bool:
+    """Остались ли пробежки без run_day (старые индексы по дате удаляются только после заполнения)"""
+    if conn is None:
+        conn = get_connection()
+    placeholders = ", ".join("?" * len(LEGACY_DATE_INDEXES))
+    row = conn.execute(
+        f"SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'index' AND name IN ({placeholders}))",
+        LEGACY_DATE_INDEXES
+    ).fetchone()
+    return get_schema_version(conn) >= 4 and bool(row[0])
+
+def backfill_run_days(conn: Optional[sqlite3.Connection] = None, batch_size: int = 1000,
+                      pause: float = 0.01, verbose: bool = False) -> int:
+    """
+    Заполняет runs.run_day для существующих пробежек, не останавливая бота.
+    Строки обрабатываются диапазонами id от новых к старым, каждый диапазон — короткой
+    отдельной транзакцией, поэтому пробежки текущей недели получают run_day первыми,
+    а записи бота ждут не дольше одной пачки. После заполнения удаляет индексы по текстовой дате.
+    Возвращает число обновленных строк.
+    """
+    if conn is None:
+        conn = get_connection()
+
+    max_id = conn.execute("SELECT MAX(id) FROM runs").fetchone()[0] or 0
+    updated = 0
+    upper = max_id
+    while upper > 0:
+        lower = max(upper - batch_size, 0)
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            # Унарный плюс не дает планировщику выбрать индекс по run_day вместо диапазона id:
+            # иначе каждая пачка заново просматривала бы все еще не заполненные строки
+            cursor.execute(
+                f"UPDATE runs SET run_day = {rollups.RUN_DAY_SQL} "
+                "WHERE id > ? AND id <= ? AND +run_day IS NULL AND run_date IS NOT NULL",
+                (lower, upper)
+            )
+            updated += cursor.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cursor.close()
+
+        if verbose and (max_id - lower) // batch_size % 50 == 0:
+            print(f"Заполнение run_day: обработаны id до {lower} из {max_id}, обновлено {updated}")
+        upper = lower
+        if pause:
+            time.sleep(pause)
+
+    # Строки, добавленные во время обхода, заполнены триггером или новым кодом,
+    # но проверяем это в той же транзакции, что и удаление старых индексов
     cursor = conn.cursor()
-    
+    cursor.execute("BEGIN IMMEDIATE")
     try:
-        # Проверяем, существует ли столбец username
-        cursor.execute("PRAGMA table_info(users)")
-        columns = cursor.fetchall()
-        column_names = [column[1] for column in columns]
-        
-        if 'username' not in column_names:
-            print("Добавляю столбец 'username' в таблицу 'users'...")
-            cursor.execute("ALTER TABLE users ADD COLUMN username TEXT")
-            conn.commit()
-            print("Миграция успешно завершена!")
+        cursor.execute(f"UPDATE runs SET run_day = {rollups.RUN_DAY_SQL} WHERE run_day IS NULL AND run_date IS NOT NULL")
+        updated += cursor.rowcount
+        _drop_legacy_date_indexes(cursor)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+
+    if verbose:
+        print(f"Заполнение run_day завершено: обновлено {updated} пробежек")
+    return updated
+
+def start_backfill(batch_size: int = 1000, pause: float = 0.01) -> Optional[threading.Thread]:
+    """
+    Запускает заполнение run_day в фоновом потоке, если оно еще не завершено
+    """
+    if not backfill_pending():
+        return None
+    thread = threading.Thread(
+        target=backfill_run_days, kwargs={"batch_size": batch_size, "pause": pause},
+        name='run-day-backfill', daemon=True
+    )
+    thread.start()
+    return thread
+
+def migrate_database() -> bool:
+    """Приводит схему базы данных к последней версии"""
+    print("Начинаю миграцию базы данных...")
+
+    try:
+        conn = get_connection()
+        current_version = get_schema_version(conn)
+        new_version = apply_migrations(conn, verbose=True)
+        if new_version == current_version:
+            print(f"Схема базы данных уже актуальна (версия {current_version}).")
         else:
-            print("Столбец 'username' уже существует в таблице 'users'.")
+            print(f"Миграция успешно завершена: версия {current_version} -> {new_version}")
+        if backfill_pending(conn):
+            backfill_run_days(conn, verbose=True)
     except Exception as e:
-        conn.rollback()
         print(f"Ошибка при миграции базы данных: {e}")
         return False
-    finally:
-        conn.close()
-    
+
     return True
 
+# Таблицы, которые горячие запросы должны читать по индексу, и их псевдонимы в запросах
+# database.py: в плане шаг называет таблицу псевдонимом
+PLAN_TABLES = ("runs", "weekly_totals", "monthly_totals")
+_PLAN_ALIASES = ("r",)
+_PLAN_TABLES_RE = re.compile(r"\b(?:" + "|".join(PLAN_TABLES) + r")\b")
+_PLAN_STATEMENTS = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+def hot_functions() -> List[Tuple[str, Callable[[], Any]]]:
+    """Горячие функции слоя данных в порядке вызова: первой записывается пробежка"""
+    import database
+    import leaderboard
+
+    def rebuild_user() -> None:
+        # Пересчет агрегатов пользователя после импорта истории (run_import._finish)
+        today = datetime.date.today()
+        with db_connection.transaction() as cursor:
+            rollups.rebuild_user(cursor, 1, today, today)
+
+    return [
+        ("add_run", lambda: database.add_run(1, 5.0)),
+        ("leaderboard.warm", leaderboard.warm),
+        ("get_user_stats", lambda: database.get_user_stats(1)),
+        ("get_dashboard", lambda: database.get_dashboard(1)),
+        ("has_runs_this_week", lambda: database.has_runs_this_week(1)),
+        ("get_weekly_leaderboard", lambda: database.get_weekly_leaderboard(10)),
+        ("get_monthly_leaderboard", lambda: database.get_monthly_leaderboard(10)),
+        ("compute_leaderboard", lambda: database.compute_leaderboard(("week", "month", "year", "all"), "month", 10)),
+        ("get_users_db", lambda: database.get_users_db()),
+        ("rollups.rebuild_user", rebuild_user),
+    ]
+
+def collect_query_plans() -> List[Tuple[str, str, List[str]]]:
+    """
+    Выполняет горячие функции (hot_functions) на текущей базе, перехватывает их запросы
+    и возвращает (функция, запрос, строки EXPLAIN QUERY PLAN) для каждого запроса к PLAN_TABLES.
+    База должна быть инициализирована, а таблица рангов заполнена.
+    """
+    conn = get_connection()
+    plans = []
+    for name, call in hot_functions():
+        with db_connection.count_queries() as statements:
+            call()
+        for sql in statements:
+            normalized = " ".join(sql.split())
+            if not normalized.upper().startswith(_PLAN_STATEMENTS) or not _PLAN_TABLES_RE.search(normalized):
+                continue
+            rows = conn.execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+            if rows:
+                plans.append((name, normalized, [row[-1] for row in rows]))
+    return plans
+
+def _uses_index(step: str) -> bool:
+    """
+    Шаг плана читает таблицу по индексу, по rowid (INTEGER PRIMARY KEY) или одним переходом
+    к краю b-дерева rowid: так SQLite выполняет MIN(id) и MAX(id), в плане это "SEARCH runs"
+    """
+    words = step.split()
+    return "INDEX" in step or "PRIMARY KEY" in step or (words[0] == "SEARCH" and len(words) == 2)
+
+def full_scans(plan: List[str]) -> List[str]:
+    """Шаги плана, читающие PLAN_TABLES без индекса"""
+    return [
+        line for line in plan
+        if line.split()[:1] in (["SCAN"], ["SEARCH"]) and line.split()[1] in PLAN_TABLES + _PLAN_ALIASES
+        and not _uses_index(line)
+    ]
+
+def check_query_plans() -> bool:
+    """
+    Проверяет на временной базе, что каждый горячий запрос использует индекс (то же проверяет
+    tests/test_query_plans.py)
+    """
+    import database
+
+    saved_path = db_connection.DB_PATH
+    tmp_dir = tempfile.mkdtemp()
+    db_connection.configure(os.path.join(tmp_dir, 'plans.db'))
+    try:
+        database.init_db()
+        conn = get_connection()
+        conn.execute("INSERT INTO ranks (name, min_km, max_km) VALUES ('Падаван', 0, ?)", (float('inf'),))
+        conn.commit()
+
+        ok = True
+        for name, sql, plan in collect_query_plans():
+            uses_index = not full_scans(plan)
+            status = "OK" if uses_index else "ПОЛНЫЙ ПРОСМОТР"
+            print(f"[{status}] {name}: {sql}")
+            for line in plan:
+                print(f"    {line}")
+            ok = ok and uses_index
+        return ok
+    finally:
+        db_connection.configure(saved_path)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
 if __name__ == "__main__":
-    if migrate_database():
+    parser = argparse.ArgumentParser(description='Миграции схемы базы данных')
+    parser.add_argument('--check-plans', action='store_true',
+                        help='Проверить, что горячие запросы database.py используют индексы')
+    args = parser.parse_args()
+
+    if args.check_plans:
+        if check_query_plans():
+            print("Все горячие запросы используют индексы.")
+        else:
+            print("Найдены запросы без индекса.")
+            sys.exit(1)
+    elif migrate_database():
         print("База данных успешно обновлена.")
     else:
         print("Не удалось обновить базу данных.")
-        sys.exit(1) 
\ No newline at end of file
+        sys.exit(1)
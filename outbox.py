@@ -0,0 +1,161 @@
+import logging
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Deque, Dict, Iterator, List
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import Response, TelegramMethod
+from aiogram.methods.base import TelegramType
+
+from rate_limit import KeyedTokenBuckets, PriorityTokenBucket
+
+# Единая очередь исходящих сообщений. Подключается к сессии бота как middleware запросов,
+# поэтому через нее проходят и message.answer в обработчиках, и bot.send_message в рассылках.
+# Отправка ждет токена в ведре своего чата и в общем ведре бота; общее ведро выдает
+# токены по приоритету: ответы пользователям раньше массовых рассылок.
+
+# Классы приоритета (меньше — раньше)
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+# Ограничения Telegram: около 30 сообщений в секунду всего (берем с небольшим запасом)
+# и 1 в секунду в один чат (короткие всплески в личный чат допускаются)
+DEFAULT_RATE = 28.0
+DEFAULT_PER_CHAT_RATE = 1.0
+DEFAULT_PER_CHAT_BURST = 3.0
+
+# Сколько раз повторять запрос после TelegramRetryAfter, прежде чем вернуть ошибку вызывающему
+MAX_RETRIES = 3
+
+# Сколько последних задержек хранить для перцентилей
+LATENCY_WINDOW = 1024
+
+# Методы Bot API, отправляющие сообщения в чат и подпадающие под ограничения.
+# sendChatAction не ограничивается.
+_LIMITED_PREFIXES = ("send", "copyMessage", "forwardMessage", "editMessage")
+
+_priority: ContextVar[int] = ContextVar("outbox_priority", default=INTERACTIVE)
+
+@contextmanager
+def priority(level: int) -> Iterator[None]:
+    """Отправки внутри блока (в текущей задаче) идут с приоритетом level"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+def is_limited(api_method: str) -> bool:
+    return api_method.startswith(_LIMITED_PREFIXES) and api_method != "sendChatAction"
+
+def _percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+class OutboxMetrics:
+    """Глубина очереди, итоги отправок и задержка (от постановки в очередь до ответа API) по классам"""
+
+    def __init__(self) -> None:
+        self.depth = {level: 0 for level in PRIORITY_NAMES}
+        self.max_depth = {level: 0 for level in PRIORITY_NAMES}
+        self.sent = {level: 0 for level in PRIORITY_NAMES}
+        self.failed = {level: 0 for level in PRIORITY_NAMES}
+        self.retry_after = {level: 0 for level in PRIORITY_NAMES}
+        self.latencies: Dict[int, Deque[float]] = {
+            level: deque(maxlen=LATENCY_WINDOW) for level in PRIORITY_NAMES
+        }
+
+    def enqueued(self, level: int) -> None:
+        self.depth[level] += 1
+        self.max_depth[level] = max(self.max_depth[level], self.depth[level])
+
+    def dequeued(self, level: int) -> None:
+        self.depth[level] -= 1
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        result = {}
+        for level, name in PRIORITY_NAMES.items():
+            latencies = sorted(self.latencies[level])
+            result[name] = {
+                "depth": self.depth[level],
+                "max_depth": self.max_depth[level],
+                "sent": self.sent[level],
+                "failed": self.failed[level],
+                "retry_after": self.retry_after[level],
+                "latency_p50": _percentile(latencies, 0.5),
+                "latency_p95": _percentile(latencies, 0.95),
+                "latency_max": latencies[-1] if latencies else 0.0,
+            }
+        return result
+
+class Outbox(BaseRequestMiddleware):
+    """
+    Middleware сессии бота, ограничивающий скорость отправки сообщений.
+    При TelegramRetryAfter общее ведро приостанавливается один раз на максимальный
+    из полученных retry_after, а запрос возвращается в очередь на свое прежнее место:
+    все отложенные запросы выходят после паузы по очереди, а не одновременно.
+    """
+
+    def __init__(self, rate: float = DEFAULT_RATE, per_chat_rate: float = DEFAULT_PER_CHAT_RATE,
+                 per_chat_burst: float = DEFAULT_PER_CHAT_BURST, max_retries: int = MAX_RETRIES) -> None:
+        # Общее ведро без запаса: сообщения идут равномерно, без всплеска в начале
+        self.limiter = PriorityTokenBucket(rate, capacity=1)
+        self.chat_limiter = KeyedTokenBuckets(per_chat_rate, per_chat_burst)
+        self.max_retries = max_retries
+        self.metrics = OutboxMetrics()
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        if not is_limited(method.__api_method__):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        level = _priority.get()
+        # Номер сохраняется при повторах, чтобы запрос не терял место в очереди
+        seq = self.limiter.next_seq()
+        started = time.monotonic()
+        metrics = self.metrics
+        metrics.enqueued(level)
+        try:
+            retries = 0
+            while True:
+                if chat_id is not None:
+                    await self.chat_limiter.acquire(chat_id)
+                await self.limiter.acquire(level, seq)
+                try:
+                    response = await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    metrics.retry_after[level] += 1
+                    self.limiter.pause(e.retry_after)
+                    retries += 1
+                    if retries > self.max_retries:
+                        raise
+                    continue
+                metrics.sent[level] += 1
+                metrics.latencies[level].append(time.monotonic() - started)
+                return response
+        except Exception:
+            metrics.failed[level] += 1
+            raise
+        finally:
+            metrics.dequeued(level)
+
+    def log_stats(self) -> None:
+        for name, stats in self.metrics.snapshot().items():
+            logging.info(
+                f"Очередь отправки {name}: отправлено {stats['sent']}, ошибок {stats['failed']}, "
+                f"ответов retry_after {stats['retry_after']}, наибольшая длина {stats['max_depth']}, "
+                f"задержка p50 {stats['latency_p50'] * 1000:.0f} мс, p95 {stats['latency_p95'] * 1000:.0f} мс"
+            )
+
+def install(bot: Bot, **options: Any) -> Outbox:
+    """Подключает очередь исходящих сообщений к сессии бота"""
+    outbox = Outbox(**options)
+    bot.session.middleware(outbox)
+    return outbox
@@ -1,32 +1,224 @@
-from typing import Dict, Tuple, Optional, List
-import random
-from db_utils import determine_rank_db, calculate_progress_db, get_challenges_for_rank
+import threading
+from array import array
+from bisect import bisect_right
+from typing import Dict, NamedTuple, Tuple, Optional, List, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # NumPy необязателен: без него пакетное определение рангов идет через bisect
+    np = None
+
+import catalogs
+from db_connection import get_connection
+from table_versions import TableVersion
+
+class RankBatch(NamedTuple):
+    """Ранги для набора километражей (в том же порядке)"""
+    indices: Sequence[int]
+    names: List[str]
+    next_names: List[Optional[str]]
+    km_needed: List[Optional[float]]
+
+class RankTable:
+    """
+    Неизменяемая таблица рангов, отсортированная по нижней границе километража.
+    Ранг и следующий ранг находятся двоичным поиском за O(log n).
+    """
+
+    __slots__ = ("version", "names", "min_km", "max_km", "_next", "_next_names", "_highest", "_prefix_max")
+
+    def __init__(self, rows: Sequence[Tuple[str, float, float]], version: int = 0) -> None:
+        if not rows:
+            raise LookupError("Таблица рангов пуста")
+        rows = sorted(rows, key=lambda row: row[1])
+        self.version = version
+        self.names: Tuple[str, ...] = tuple(name for name, _, _ in rows)
+        self.min_km = array('d', (min_km for _, min_km, _ in rows))
+        self.max_km = array('d', (max_km for _, _, max_km in rows))
+
+        # Для каждого ранга — индекс ранга с ближайшей большей нижней границей (или None)
+        lowest_min: Dict[str, float] = {}
+        for name, min_km, _ in rows:
+            lowest_min.setdefault(name, min_km)
+        next_index = []
+        for name in self.names:
+            position = bisect_right(self.min_km, lowest_min[name])
+            next_index.append(position if position < len(rows) else None)
+        self._next: Tuple[Optional[int], ...] = tuple(next_index)
+        self._next_names = tuple(None if index is None else self.names[index] for index in next_index)
+        self._highest = max(range(len(rows)), key=self.max_km.__getitem__)
+
+        # Наибольшая верхняя граница среди рангов 0..i: если km больше нее,
+        # ни один ранг с нижней границей не выше km не подходит и выбирается самый высокий ранг
+        prefix_max, current = [], float('-inf')
+        for max_km in self.max_km:
+            current = max(current, max_km)
+            prefix_max.append(current)
+        self._prefix_max = array('d', prefix_max)
+
+    def rank_index(self, km: float) -> int:
+        """
+        Индекс ранга с наибольшей нижней границей, диапазон которого содержит km.
+        Если такого нет (km попал в промежуток между рангами), используется ранг
+        с наибольшей верхней границей — так же, как раньше делал determine_rank_db.
+        """
+        position = bisect_right(self.min_km, km) - 1
+        if position < 0 or km > self._prefix_max[position]:
+            return self._highest
+        # Диапазоны рангов не пересекаются, поэтому обычно подходит первый же кандидат
+        while position >= 0:
+            if km <= self.max_km[position]:
+                return position
+            position -= 1
+        return self._highest
+
+    def determine(self, km: float) -> str:
+        return self.names[self.rank_index(km)]
+
+    def progress(self, km: float) -> Tuple[str, Optional[str], Optional[float]]:
+        """Возвращает: (текущий ранг, следующий ранг, км до следующего ранга)"""
+        index = self.rank_index(km)
+        next_index = self._next[index]
+        if next_index is None:
+            return self.names[index], None, None
+        return self.names[index], self.names[next_index], self.min_km[next_index] - km
+
+    def rank_indices(self, distances: Sequence[float], use_numpy: bool = True) -> Sequence[int]:
+        """
+        Индексы рангов для последовательности или массива километражей за один проход:
+        через numpy.searchsorted, если NumPy установлен, иначе через bisect.
+        Поштучно через rank_index дорешиваются только значения, для которых диапазоны рангов пересекаются.
+        """
+        if np is not None and use_numpy:
+            km = np.asarray(distances, dtype=float)
+            indices = np.searchsorted(np.frombuffer(self.min_km), km, side='right') - 1
+            clipped = np.maximum(indices, 0)
+            matched = (indices >= 0) & (km <= np.frombuffer(self.max_km)[clipped])
+            if not matched.all():
+                # Промежутки между рангами разрешаются без цикла, поштучно — только пересекающиеся диапазоны
+                highest = ~matched & ((indices < 0) | (km > np.frombuffer(self._prefix_max)[clipped]))
+                indices[highest] = self._highest
+                for position in np.flatnonzero(~matched & ~highest):
+                    indices[position] = self.rank_index(float(km[position]))
+            return indices
+
+        min_km, max_km, prefix_max, highest = self.min_km, self.max_km, self._prefix_max, self._highest
+        indices = []
+        for km in distances:
+            index = bisect_right(min_km, km) - 1
+            if index < 0 or km > prefix_max[index]:
+                index = highest
+            elif km > max_km[index]:
+                index = self.rank_index(km)
+            indices.append(index)
+        return indices
+
+    def resolve_many(self, distances: Sequence[float], use_numpy: bool = True) -> RankBatch:
+        """Ранги, следующие ранги и км до следующего ранга для набора километражей"""
+        indices = self.rank_indices(distances, use_numpy)
+        if np is not None and use_numpy:
+            km = np.asarray(distances, dtype=float)
+            next_min = np.array([
+                self.min_km[index] if index is not None else np.nan for index in self._next
+            ])[indices]
+            needed = next_min - km
+            km_needed = [None if value != value else value for value in needed.tolist()]
+            return RankBatch(
+                indices,
+                np.array(self.names, dtype=object)[indices].tolist(),
+                np.array(self._next_names, dtype=object)[indices].tolist(),
+                km_needed,
+            )
+
+        names, next_names, next_index = self.names, self._next_names, self._next
+        min_km = self.min_km
+        return RankBatch(
+            indices,
+            [names[index] for index in indices],
+            [next_names[index] for index in indices],
+            [
+                None if next_index[index] is None else min_km[next_index[index]] - km
+                for index, km in zip(indices, distances)
+            ],
+        )
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+_ranks_version = TableVersion("ranks")
+_table: Optional[RankTable] = None
+_lock = threading.Lock()
+
+def get_rank_table() -> RankTable:
+    """
+    Возвращает таблицу рангов из памяти и перечитывает ее из БД, только если таблица ranks изменилась
+    """
+    global _table
+    version = _ranks_version.current()
+    table = _table
+    if table is not None and table.version == version:
+        return table
+
+    with _lock:
+        if _table is None or _table.version != version:
+            cursor = get_connection().cursor()
+            cursor.execute("SELECT name, min_km, max_km FROM ranks")
+            rows = cursor.fetchall()
+            cursor.close()
+            _table = RankTable(rows, version)
+        return _table
+
+def invalidate() -> None:
+    """
+    Сбрасывает таблицу рангов после изменения ranks из этого же процесса
+    (изменения из других процессов обнаруживаются автоматически)
+    """
+    global _table
+    _ranks_version.invalidate()
+    with _lock:
+        _table = None
 
 # Функция для определения ранга пользователя по километражу
 def determine_rank(km: float) -> str:
     """
     Определяет ранг пользователя на основе километража за неделю.
-    Использует данные из базы данных.
+    Использует таблицу рангов из памяти.
+    """
+    return get_rank_table().determine(km)
+
+def determine_ranks(distances: Sequence[float]) -> List[str]:
+    """
+    Определяет ранги сразу для списка недельных километражей
+    """
+    if len(distances) == 0:
+        return []
+    table = get_rank_table()
+    names = table.names
+    return [names[index] for index in table.rank_indices(distances)]
+
+def resolve_ranks(distances: Sequence[float]) -> RankBatch:
+    """
+    Ранги, следующие ранги и км до следующего ранга для набора недельных километражей
     """
-    return determine_rank_db(km)
+    return get_rank_table().resolve_many(distances)
 
 def calculate_progress(km: float) -> Tuple[str, Optional[str], Optional[float]]:
     """
     Рассчитывает прогресс до следующего ранга.
-    Использует данные из базы данных.
+    Использует таблицу рангов из памяти.
     Возвращает: (текущий ранг, следующий ранг, км до следующего ранга)
     """
-    return calculate_progress_db(km)
+    return get_rank_table().progress(km)
 
 def get_challenges(rank: str) -> List[str]:
     """
-    Получает список заданий для конкретного ранга из базы данных.
+    Получает список заданий для конкретного ранга из кэша каталогов.
     """
-    return get_challenges_for_rank(rank)
+    return catalogs.get_challenges(rank)
 
-def get_random_challenge(rank: str) -> str:
+def get_random_challenge(rank: str, user_id: Optional[int] = None) -> str:
     """
-    Возвращает случайное задание для указанного ранга
+    Возвращает случайное задание для указанного ранга.
+    Если указан user_id, последние выданные ему задания по возможности не повторяются.
     """
-    challenges = get_challenges(rank)
-    return random.choice(challenges)
\ No newline at end of file
+    return catalogs.get_random_challenge(rank, user_id)
\ No newline at end of file
@@ -0,0 +1,145 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+class TokenBucket:
+    """
+    Ограничитель скорости: rate токенов в секунду, не больше capacity накопленных.
+    Ожидающие получают токены в порядке очереди. pause() останавливает выдачу
+    (например, на время retry_after от Telegram).
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        start = max(self._updated, self._paused_until)
+        if now > start:
+            self._tokens = min(self.capacity, self._tokens + (now - start) * self.rate)
+        self._updated = max(self._updated, now)
+
+    def try_acquire(self) -> float:
+        """
+        Забирает токен, если он есть, и возвращает 0; иначе возвращает, сколько секунд ждать
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                wait = self.try_acquire()
+                if wait <= 0:
+                    return
+                await asyncio.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены seconds секунд, после паузы начать с пустого ведра"""
+        now = time.monotonic()
+        self._paused_until = max(self._paused_until, now + seconds)
+        self._tokens = 0.0
+        self._updated = now
+
+    @property
+    def idle(self) -> bool:
+        """Ведро полное и никто не ждет — его можно удалить без потери ограничения"""
+        self._refill(time.monotonic())
+        return self._tokens >= self.capacity and not self._lock.locked()
+
+class PriorityTokenBucket:
+    """
+    Token bucket, который выдает токены ожидающим по приоритету (меньшее значение — раньше),
+    а при равном приоритете — по порядковому номеру seq (по умолчанию в порядке прихода).
+    Ожидающие не опрашивают ведро сами: токены раздает одна фоновая задача.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.bucket = TokenBucket(rate, capacity)
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump: Optional[asyncio.Task] = None
+
+    def next_seq(self) -> int:
+        return next(self._seq)
+
+    async def acquire(self, priority: int = 0, seq: Optional[int] = None) -> None:
+        # Без очереди токен можно взять сразу
+        if not self._waiters and self.bucket.try_acquire() <= 0:
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self.next_seq() if seq is None else seq, future))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run())
+        await future
+
+    def _drop_cancelled(self) -> None:
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+
+    async def _run(self) -> None:
+        while True:
+            self._drop_cancelled()
+            if not self._waiters:
+                return
+            wait = self.bucket.try_acquire()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            # Между проверкой и выдачей нет await, поэтому первый ожидающий еще не отменен
+            heapq.heappop(self._waiters)[2].set_result(None)
+
+    def pause(self, seconds: float) -> None:
+        self.bucket.pause(seconds)
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, future in self._waiters if not future.done())
+
+class KeyedTokenBuckets:
+    """
+    Отдельное ведро для каждого ключа (например, чата). Хранится не больше max_keys ведер:
+    при переполнении удаляются давно не использованные полные ведра.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, max_keys: int = 100000) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+    def get(self, key: int) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+            if len(self._buckets) > self.max_keys:
+                self._evict()
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def _evict(self) -> None:
+        for key in list(self._buckets):
+            if len(self._buckets) <= self.max_keys:
+                break
+            if self._buckets[key].idle:
+                del self._buckets[key]
+
+    async def acquire(self, key: int) -> None:
+        await self.get(key).acquire()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
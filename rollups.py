@@ -0,0 +1,132 @@
+import sqlite3
+from datetime import date, timedelta
+
+# Агрегаты пробежек по пользователю за ISO-неделю и календарный месяц.
+# Обновляются в той же транзакции, что и таблица runs, и позволяют
+# получать недельные и месячные суммы одной строкой вместо суммирования пробежек.
+
+CREATE_TABLES_SQL = [
+    '''
+    CREATE TABLE IF NOT EXISTS weekly_totals (
+        user_id INTEGER NOT NULL,
+        week_key INTEGER NOT NULL,
+        distance REAL NOT NULL DEFAULT 0,
+        runs_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, week_key)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS monthly_totals (
+        user_id INTEGER NOT NULL,
+        month_key INTEGER NOT NULL,
+        distance REAL NOT NULL DEFAULT 0,
+        runs_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, month_key)
+    ) WITHOUT ROWID
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_weekly_totals_week ON weekly_totals (week_key, distance DESC)",
+    "CREATE INDEX IF NOT EXISTS idx_monthly_totals_month ON monthly_totals (month_key, distance DESC)",
+]
+
+def week_key(day: date) -> int:
+    """Ключ ISO-недели вида ГГГГНН (например, 202642)"""
+    iso_year, iso_week, _ = day.isocalendar()
+    return iso_year * 100 + iso_week
+
+def month_key(day: date) -> int:
+    """Ключ месяца вида ГГГГММ (например, 202610)"""
+    return day.year * 100 + day.month
+
+# Номер дня пробежки (runs.run_day) совпадает с date.toordinal(), чтобы диапазоны
+# сравнивались как целые числа. В SQL он вычисляется из юлианской даты.
+RUN_DAY_SQL = "CAST(julianday(run_date) - 1721424.5 AS INTEGER)"
+
+def day_key(day: date) -> int:
+    """Номер дня для столбца runs.run_day"""
+    return day.toordinal()
+
+def day_from_key(key: int) -> date:
+    return date.fromordinal(key)
+
+def create_tables(cursor: sqlite3.Cursor) -> None:
+    for sql in CREATE_TABLES_SQL:
+        cursor.execute(sql)
+
+def add_run(cursor: sqlite3.Cursor, user_id: int, day: date, distance: float) -> None:
+    """
+    Учитывает пробежку в недельном и месячном агрегатах.
+    Должна вызываться в той же транзакции, что и INSERT в runs.
+    """
+    cursor.execute("""
+        INSERT INTO weekly_totals (user_id, week_key, distance, runs_count) VALUES (?, ?, ?, 1)
+        ON CONFLICT (user_id, week_key) DO UPDATE SET
+            distance = distance + excluded.distance,
+            runs_count = runs_count + 1
+    """, (user_id, week_key(day), distance))
+    cursor.execute("""
+        INSERT INTO monthly_totals (user_id, month_key, distance, runs_count) VALUES (?, ?, ?, 1)
+        ON CONFLICT (user_id, month_key) DO UPDATE SET
+            distance = distance + excluded.distance,
+            runs_count = runs_count + 1
+    """, (user_id, month_key(day), distance))
+
+def delete_user(cursor: sqlite3.Cursor, user_id: int) -> None:
+    """Удаляет агрегаты пользователя (при удалении всех его пробежек)"""
+    cursor.execute("DELETE FROM weekly_totals WHERE user_id = ?", (user_id,))
+    cursor.execute("DELETE FROM monthly_totals WHERE user_id = ?", (user_id,))
+
+# Агрегаты по таблице runs; неделя определяется по четвергу ISO-недели, которой принадлежит дата пробежки
+_WEEKLY_FROM_RUNS_SQL = """
+    INSERT INTO weekly_totals (user_id, week_key, distance, runs_count)
+    SELECT user_id,
+           CAST(strftime('%Y', thursday) AS INTEGER) * 100
+               + (CAST(strftime('%j', thursday) AS INTEGER) - 1) / 7 + 1,
+           SUM(distance), COUNT(*)
+    FROM (
+        SELECT user_id, distance, date(run_date, '-3 days', 'weekday 4') AS thursday
+        FROM runs {where}
+    )
+    GROUP BY 1, 2
+"""
+_MONTHLY_FROM_RUNS_SQL = """
+    INSERT INTO monthly_totals (user_id, month_key, distance, runs_count)
+    SELECT user_id, CAST(strftime('%Y%m', run_date) AS INTEGER), SUM(distance), COUNT(*)
+    FROM runs {where}
+    GROUP BY 1, 2
+"""
+
+def rebuild(cursor: sqlite3.Cursor) -> None:
+    """
+    Пересчитывает агрегаты заново по таблице runs
+    """
+    cursor.execute("DELETE FROM weekly_totals")
+    cursor.execute("DELETE FROM monthly_totals")
+    cursor.execute(_WEEKLY_FROM_RUNS_SQL.format(where=""))
+    cursor.execute(_MONTHLY_FROM_RUNS_SQL.format(where=""))
+
+def rebuild_user(cursor: sqlite3.Cursor, user_id: int, first: date, last: date) -> None:
+    """
+    Пересчитывает по таблице runs агрегаты пользователя за все недели и месяцы,
+    задевающие дни с first по last включительно
+    """
+    where = "WHERE user_id = ? AND run_day BETWEEN ? AND ?"
+
+    # Недели целиком: с понедельника первой до воскресенья последней
+    week_start = first - timedelta(days=first.weekday())
+    week_end = last + timedelta(days=6 - last.weekday())
+    cursor.execute(
+        "DELETE FROM weekly_totals WHERE user_id = ? AND week_key BETWEEN ? AND ?",
+        (user_id, week_key(first), week_key(last))
+    )
+    cursor.execute(_WEEKLY_FROM_RUNS_SQL.format(where=where),
+                   (user_id, day_key(week_start), day_key(week_end)))
+
+    # Месяцы целиком: с первого числа первого до последнего числа последнего
+    month_start = first.replace(day=1)
+    month_end = (last.replace(day=28) + timedelta(days=4)).replace(day=1) - timedelta(days=1)
+    cursor.execute(
+        "DELETE FROM monthly_totals WHERE user_id = ? AND month_key BETWEEN ? AND ?",
+        (user_id, month_key(first), month_key(last))
+    )
+    cursor.execute(_MONTHLY_FROM_RUNS_SQL.format(where=where),
+                   (user_id, day_key(month_start), day_key(month_end)))
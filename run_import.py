@@ -0,0 +1,477 @@
+import csv
+import datetime
+import io
+import math
+import os
+import sqlite3
+import struct
+import xml.etree.ElementTree as ET
+from datetime import date
+from typing import Any, BinaryIO, Callable, Dict, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+import leaderboard
+import rollups
+import table_versions
+from db_connection import transaction
+
+# Импорт истории пробежек из выгрузок часов и других приложений: CSV, GPX и FIT.
+# Файл читается потоково (CSV по строкам, GPX через iterparse с удалением разобранных точек,
+# FIT по одной записи), поэтому память не зависит от размера файла. Пробежки записываются
+# пачками по batch_size в отдельных транзакциях; повторы (тот же день и та же дистанция
+# с точностью до 10 м) отбрасываются и среди уже записанных пробежек, и внутри файла.
+# Агрегаты, общий километраж пользователя и таблица лидеров обновляются один раз в конце
+# пересчетом по таблице runs, поэтому повторный импорт того же файла после сбоя
+# ничего не задвоит и восстановит агрегаты.
+
+# Сколько пробежек записывается одной транзакцией
+BATCH_SIZE = 5000
+
+# Пробежки короче (после округления до 10 м) считаются пустыми и пропускаются
+MIN_DISTANCE_KM = 0.01
+
+FORMATS = ("csv", "gpx", "fit")
+
+class Activity(NamedTuple):
+    day: date
+    distance: float  # км
+
+class ImportResult(NamedTuple):
+    parsed: int      # записей о тренировках в файле
+    imported: int    # записано новых пробежек
+    duplicates: int  # уже были в базе или повторялись в файле
+    skipped: int     # не пробежки, без даты или дистанции, с датой в будущем
+    distance: float  # км в записанных пробежках
+    first_day: Optional[date]
+    last_day: Optional[date]
+
+def detect_format(filename: str) -> str:
+    """
+    Формат выгрузки по расширению файла
+    """
+    extension = os.path.splitext(filename or "")[1].lower().lstrip(".")
+    if extension not in FORMATS:
+        raise ValueError(f"Неподдерживаемый формат файла: {filename!r} (ожидается CSV, GPX или FIT)")
+    return extension
+
+def _is_running(sport: Optional[str]) -> bool:
+    # Вид активности не указан — считаем пробежкой
+    if not sport:
+        return True
+    sport = sport.lower()
+    return "run" in sport or "бег" in sport
+
+def _local_day(moment: datetime.datetime) -> date:
+    # Время в выгрузках обычно в UTC; день пробежки считается по местному времени, как у /run
+    return moment.astimezone().date() if moment.tzinfo is not None else moment.date()
+
+# CSV
+
+_CSV_DATE_COLUMNS = ("date", "activity date", "start time", "start_time", "start date", "дата", "время начала")
+_CSV_DISTANCE_COLUMNS = ("distance", "distance_km", "дистанция", "расстояние")
+_CSV_SPORT_COLUMNS = ("activity type", "type", "sport", "вид", "тип")
+# Единицы дистанции в заголовке столбца, например "Distance (m)"; по умолчанию километры
+_CSV_UNITS = {"km": 1.0, "км": 1.0, "m": 0.001, "м": 0.001, "meters": 0.001, "mi": 1.609344, "miles": 1.609344}
+_CSV_DATE_FORMATS = (
+    "%d.%m.%Y %H:%M:%S", "%d.%m.%Y %H:%M", "%d.%m.%Y",
+    "%b %d, %Y, %I:%M:%S %p",  # Strava
+    "%Y/%m/%d %H:%M:%S", "%Y/%m/%d",
+)
+
+def _split_column(header: str) -> Tuple[str, float]:
+    """Имя столбца без единиц и множитель для перевода в километры"""
+    name = header.strip().lower()
+    scale = 1.0
+    if name.endswith(")") and "(" in name:
+        name, unit = name[:-1].rsplit("(", 1)
+        scale = _CSV_UNITS.get(unit.strip(), 1.0)
+    return name.strip(), scale
+
+def _parse_csv_date(value: str) -> datetime.datetime:
+    value = value.strip()
+    try:
+        return datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        pass
+    for fmt in _CSV_DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise ValueError(f"Неизвестный формат даты: {value!r}")
+
+def _parse_number(value: str) -> float:
+    value = value.strip().replace(" ", "").replace("\u00a0", "")
+    if "," in value:
+        # "1,234.5" — разделитель тысяч, "5,2" — десятичная запятая
+        value = value.replace(",", "") if "." in value else value.replace(",", ".")
+    return float(value)
+
+def parse_csv(stream: BinaryIO) -> Iterator[Optional[Activity]]:
+    """
+    Тренировки из CSV с заголовком (Garmin Connect, Strava и похожие выгрузки).
+    Дата, дистанция и вид активности ищутся по названиям столбцов; разделитель — запятая,
+    точка с запятой или табуляция. Для строк, которые не удалось разобрать, и не пробежек
+    возвращается None.
+    """
+    text = io.TextIOWrapper(stream, encoding="utf-8-sig", errors="replace", newline="")
+    first_line = text.readline()
+    delimiter = max((",", ";", "\t"), key=first_line.count)
+    header = next(csv.reader([first_line], delimiter=delimiter), [])
+
+    date_column = distance_column = sport_column = None
+    scale = 1.0
+    for index, column in enumerate(header):
+        name, unit_scale = _split_column(column)
+        if date_column is None and name in _CSV_DATE_COLUMNS:
+            date_column = index
+        elif distance_column is None and name in _CSV_DISTANCE_COLUMNS:
+            distance_column, scale = index, unit_scale
+        elif sport_column is None and name in _CSV_SPORT_COLUMNS:
+            sport_column = index
+    if date_column is None or distance_column is None:
+        raise ValueError("В CSV не найдены столбцы с датой и дистанцией")
+
+    try:
+        for row in csv.reader(text, delimiter=delimiter):
+            if not row:
+                continue
+            try:
+                if sport_column is not None and sport_column < len(row) and not _is_running(row[sport_column]):
+                    yield None
+                    continue
+                day = _local_day(_parse_csv_date(row[date_column]))
+                distance = _parse_number(row[distance_column]) * scale
+            except (ValueError, IndexError):
+                yield None
+                continue
+            yield Activity(day, distance)
+    except csv.Error as e:
+        raise ValueError(f"CSV-файл поврежден: {e}") from e
+
+# GPX
+
+_EARTH_RADIUS_KM = 6371.0088
+
+def _haversine(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * _EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+def _local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+def parse_gpx(stream: BinaryIO) -> Iterator[Optional[Activity]]:
+    """
+    Тренировки из GPX: каждый трек (trk) — одна тренировка, дистанция — сумма расстояний
+    между соседними точками внутри сегментов, дата — по времени первой точки.
+    Разобранные точки сразу удаляются из дерева.
+    """
+    try:
+        yield from _iter_gpx(stream)
+    except ET.ParseError as e:
+        raise ValueError(f"GPX-файл поврежден: {e}") from e
+
+def _iter_gpx(stream: BinaryIO) -> Iterator[Optional[Activity]]:
+    segment: Optional[ET.Element] = None
+    in_track = False
+    sport: Optional[str] = None
+    started: Optional[datetime.datetime] = None
+    distance = 0.0
+    previous: Optional[Tuple[float, float]] = None
+
+    for event, element in ET.iterparse(stream, events=("start", "end")):
+        tag = _local_name(element.tag)
+        if event == "start":
+            if tag == "trk":
+                in_track, sport, started, distance = True, None, None, 0.0
+            elif tag == "trkseg":
+                segment, previous = element, None
+            continue
+
+        if tag == "trkpt" and segment is not None:
+            try:
+                point = (float(element.attrib["lat"]), float(element.attrib["lon"]))
+            except (KeyError, ValueError):
+                point = None
+            if point is not None:
+                if previous is not None:
+                    distance += _haversine(*previous, *point)
+                previous = point
+            if started is None:
+                for child in element:
+                    if _local_name(child.tag) == "time" and child.text:
+                        try:
+                            started = datetime.datetime.fromisoformat(child.text.strip().replace("Z", "+00:00"))
+                        except ValueError:
+                            pass
+                        break
+            segment.remove(element)
+        elif tag == "type" and in_track and segment is None:
+            sport = element.text
+        elif tag == "trkseg":
+            segment = None
+            element.clear()
+        elif tag == "trk":
+            in_track = False
+            element.clear()
+            if started is None or not _is_running(sport):
+                yield None
+            else:
+                yield Activity(_local_day(started), distance)
+
+# FIT (https://developer.garmin.com/fit/protocol/)
+
+# Начало отсчета времени FIT (1989-12-31 00:00:00 UTC) в секундах Unix
+_FIT_EPOCH = 631065600
+_FIT_SESSION = 18
+_FIT_RECORD = 20
+# Поля session: start_time, sport, total_distance (сантиметры); record: distance; общее timestamp
+_FIT_START_TIME, _FIT_SPORT, _FIT_TOTAL_DISTANCE = 2, 5, 9
+_FIT_DISTANCE = 5
+_FIT_TIMESTAMP = 253
+_FIT_SPORT_RUNNING = 1
+_FIT_INVALID_UINT32 = 0xFFFFFFFF
+
+class _FitDefinition(NamedTuple):
+    global_number: int
+    size: int
+    # Номер поля -> (смещение, размер, формат struct с порядком байтов)
+    fields: Dict[int, Tuple[int, int, str]]
+
+def _read_exact(stream: BinaryIO, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) != size:
+        raise ValueError("FIT-файл обрезан")
+    return data
+
+def _fit_value(data: bytes, definition: _FitDefinition, field: int) -> Optional[int]:
+    spec = definition.fields.get(field)
+    if spec is None:
+        return None
+    offset, size, fmt = spec
+    value = struct.unpack_from(fmt, data, offset)[0]
+    invalid = (1 << (8 * size)) - 1
+    return None if value == invalid else value
+
+def _fit_time(value: int) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(value + _FIT_EPOCH, datetime.timezone.utc)
+
+def parse_fit(stream: BinaryIO) -> Iterator[Optional[Activity]]:
+    """
+    Тренировки из FIT (Garmin, Coros, Suunto и др.): каждое сообщение session — одна
+    тренировка. Если в файле нет session, тренировкой считается весь файл: дистанция —
+    наибольшая накопленная distance в record, дата — по первой метке времени.
+    Поддерживаются цепочки из нескольких FIT-файлов подряд.
+    """
+    while True:
+        header = stream.read(1)
+        if not header:
+            return
+        header_size = header[0]
+        rest = stream.read(header_size - 1)
+        if header_size not in (12, 14) or rest[7:11] != b".FIT":
+            raise ValueError("Файл не похож на FIT")
+        remaining = struct.unpack_from("<I", rest, 3)[0]
+
+        definitions: Dict[int, _FitDefinition] = {}
+        last_timestamp = 0
+        sessions = 0
+        first_timestamp: Optional[int] = None
+        record_distance: Optional[int] = None
+        while remaining > 0:
+            record_header = _read_exact(stream, 1)[0]
+            remaining -= 1
+            if record_header & 0x80:
+                # Сжатый заголовок: сообщение данных с 5 младшими битами времени
+                local = (record_header >> 5) & 0x03
+                offset = record_header & 0x1F
+                last_timestamp = (last_timestamp & ~0x1F) + offset + (0x20 if offset < (last_timestamp & 0x1F) else 0)
+                compressed = True
+            elif record_header & 0x40:
+                local = record_header & 0x0F
+                content = _read_exact(stream, 5)
+                endian = ">" if content[1] else "<"
+                global_number = struct.unpack_from(endian + "H", content, 2)[0]
+                raw_fields = _read_exact(stream, content[4] * 3)
+                remaining -= 5 + len(raw_fields)
+                fields: Dict[int, Tuple[int, int, str]] = {}
+                size = 0
+                for i in range(0, len(raw_fields), 3):
+                    number, field_size = raw_fields[i], raw_fields[i + 1]
+                    if field_size in (1, 2, 4):
+                        fields.setdefault(number, (size, field_size, endian + {1: "B", 2: "H", 4: "I"}[field_size]))
+                    size += field_size
+                if record_header & 0x20:
+                    # Поля разработчика: только пропускаются
+                    count = _read_exact(stream, 1)[0]
+                    developer_fields = _read_exact(stream, count * 3)
+                    remaining -= 1 + len(developer_fields)
+                    size += sum(developer_fields[i + 1] for i in range(0, len(developer_fields), 3))
+                definitions[local] = _FitDefinition(global_number, size, fields)
+                continue
+            else:
+                local = record_header & 0x0F
+                compressed = False
+
+            definition = definitions.get(local)
+            if definition is None:
+                raise ValueError("FIT-файл поврежден: сообщение без определения")
+            data = _read_exact(stream, definition.size)
+            remaining -= definition.size
+            if not compressed:
+                timestamp = _fit_value(data, definition, _FIT_TIMESTAMP)
+                if timestamp is not None:
+                    last_timestamp = timestamp
+            if definition.global_number == _FIT_SESSION:
+                sessions += 1
+                start_time = _fit_value(data, definition, _FIT_START_TIME)
+                total_distance = _fit_value(data, definition, _FIT_TOTAL_DISTANCE)
+                sport = _fit_value(data, definition, _FIT_SPORT)
+                if start_time is None or total_distance is None or sport not in (None, _FIT_SPORT_RUNNING):
+                    yield None
+                else:
+                    yield Activity(_local_day(_fit_time(start_time)), total_distance / 100_000)
+            elif definition.global_number == _FIT_RECORD:
+                if first_timestamp is None and last_timestamp:
+                    first_timestamp = last_timestamp
+                distance = _fit_value(data, definition, _FIT_DISTANCE)
+                if distance is not None:
+                    record_distance = max(record_distance or 0, distance)
+
+        # Контрольная сумма файла
+        _read_exact(stream, 2)
+        if not sessions and record_distance is not None and first_timestamp is not None:
+            yield Activity(_local_day(_fit_time(first_timestamp)), record_distance / 100_000)
+
+PARSERS: Dict[str, Callable[[BinaryIO], Iterator[Optional[Activity]]]] = {
+    "csv": parse_csv,
+    "gpx": parse_gpx,
+    "fit": parse_fit,
+}
+
+# Запись в базу
+
+# Сколько пробежек проверяется на повтор одним запросом
+_LOOKUP_CHUNK = 500
+
+def _distance_key(distance: float) -> int:
+    # Дистанция в десятках метров: по ней сравниваются пробежки одного дня
+    return int(round(distance * 100))
+
+def _find_existing(cursor: sqlite3.Cursor, user_id: int, keys: List[Tuple[int, int]]) -> Set[Tuple[int, int]]:
+    """
+    Ключи (номер дня, дистанция), уже записанные у пользователя. Каждый ключ ищется по индексу
+    пробежек по дню, пользователю и дистанции, поэтому время не зависит от длины истории.
+    """
+    found: Set[Tuple[int, int]] = set()
+    for i in range(0, len(keys), _LOOKUP_CHUNK):
+        chunk = keys[i:i + _LOOKUP_CHUNK]
+        params: List[Any] = []
+        for day, distance in chunk:
+            params += (day, distance)
+        params.append(user_id)
+        # Дистанция сравнивается после округления до десятков метров, как в ключе: пробежки,
+        # записанные не импортом, могут хранить больше двух знаков после запятой
+        cursor.execute(f"""
+            SELECT v.column1, v.column2
+            FROM (VALUES {", ".join(["(?, ?)"] * len(chunk))}) AS v
+            WHERE EXISTS (
+                SELECT 1 FROM runs r
+                WHERE r.user_id = ? AND r.run_day = v.column1
+                    AND r.distance BETWEEN (v.column2 - 0.5) / 100.0 AND (v.column2 + 0.5) / 100.0
+            )
+        """, params)
+        found.update(cursor)
+    return found
+
+def _write_batch(user_id: int, batch: List[Activity]) -> Tuple[int, float]:
+    """
+    Записывает пачку пробежек одной транзакцией, пропуская уже записанные и повторы в пачке.
+    Возвращает число записанных пробежек и их суммарную дистанцию.
+    """
+    unique: Dict[Tuple[int, int], date] = {}
+    for activity in batch:
+        unique.setdefault((rollups.day_key(activity.day), _distance_key(activity.distance)), activity.day)
+    with transaction() as cursor:
+        existing = _find_existing(cursor, user_id, list(unique))
+        rows = [
+            (user_id, day.isoformat(), key[0], key[1] / 100)
+            for key, day in unique.items() if key not in existing
+        ]
+        cursor.executemany(
+            "INSERT INTO runs (user_id, run_date, run_day, distance) VALUES (?, ?, ?, ?)", rows
+        )
+    return len(rows), sum(row[3] for row in rows)
+
+def _finish(user_id: int, first: date, last: date, today: date) -> None:
+    """
+    Пересчитывает агрегаты пользователя за импортированные дни и его общий километраж;
+    если затронуты текущая неделя или месяц, сбрасывает таблицу лидеров, иначе только
+    отмечает импортированные пробежки учтенными
+    """
+    current = last >= min(today - datetime.timedelta(days=today.weekday()), today.replace(day=1))
+    with leaderboard.updating():
+        with transaction() as cursor:
+            rollups.rebuild_user(cursor, user_id, first, last)
+            cursor.execute(
+                "UPDATE users SET total_distance = (SELECT COALESCE(SUM(distance), 0) FROM runs WHERE user_id = ?) "
+                "WHERE user_id = ?",
+                (user_id, user_id)
+            )
+            if current:
+                # Другие процессы (бот, воркеры) перечитают таблицу лидеров
+                table_versions.bump(cursor, table_versions.LEADERBOARD)
+        if current:
+            leaderboard.invalidate()
+        else:
+            # Пробежки вне окна топов пропускаются одним запросом, а не при следующей записи
+            leaderboard.catch_up()
+
+def import_activities(user_id: int, activities: Iterator[Optional[Activity]],
+                      batch_size: int = BATCH_SIZE, today: Optional[date] = None) -> ImportResult:
+    """
+    Записывает пробежки пользователя пачками по batch_size и в конце один раз обновляет
+    агрегаты, общий километраж и таблицу лидеров
+    """
+    today = today or date.today()
+    with transaction() as cursor:
+        cursor.execute(
+            "INSERT OR IGNORE INTO users (user_id, username, current_week, total_distance, joined_date) "
+            "VALUES (?, NULL, ?, 0, ?)",
+            (user_id, today.isocalendar()[1], today.isoformat())
+        )
+
+    parsed = imported = skipped = 0
+    total = 0.0
+    first: Optional[date] = None
+    last: Optional[date] = None
+    batch: List[Activity] = []
+    for activity in activities:
+        parsed += 1
+        if activity is None or activity.day > today or round(activity.distance, 2) < MIN_DISTANCE_KM:
+            skipped += 1
+            continue
+        batch.append(activity)
+        first = activity.day if first is None else min(first, activity.day)
+        last = activity.day if last is None else max(last, activity.day)
+        if len(batch) >= batch_size:
+            count, distance = _write_batch(user_id, batch)
+            imported, total = imported + count, total + distance
+            batch = []
+    if batch:
+        count, distance = _write_batch(user_id, batch)
+        imported, total = imported + count, total + distance
+
+    # Агрегаты пересчитываются и при повторном импорте: он восстанавливает их после сбоя
+    if first is not None:
+        _finish(user_id, first, last, today)
+    return ImportResult(parsed, imported, parsed - skipped - imported, skipped, total, first, last)
+
+def import_file(user_id: int, path: str, fmt: Optional[str] = None,
+                batch_size: int = BATCH_SIZE) -> ImportResult:
+    """
+    Импортирует пробежки пользователя из файла выгрузки (формат по расширению, если не указан)
+    """
+    parser = PARSERS[fmt or detect_format(path)]
+    with open(path, "rb") as stream:
+        return import_activities(user_id, parser(stream), batch_size)
@@ -0,0 +1,280 @@
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import os
+import secrets
+import signal
+import sys
+import time
+import zlib
+from typing import Any, Dict, List, Optional
+
+from aiohttp import ClientError, ClientSession, ClientTimeout, web
+
+import bootstrap
+import config
+import webhook
+from config import (
+    BOT_TOKEN, BOT_API_URL, BOT_MODE, BOT_WORKERS, WORKER_BASE_PORT, WEBHOOK_URL, WEBHOOK_PATH,
+    WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_SECRET, UPDATE_CONCURRENCY, METRICS_PORT
+)
+
+# Несколько процессов бота на одной базе. Супервизор принимает вебхук Telegram, по user_id
+# выбирает воркера и передает ему обновление на внутренний порт, поэтому состояния диалогов
+# и запись пробежек пользователя всегда обрабатывает один и тот же процесс. Воркер — обычный
+# bot.py в режиме BOT_MODE=worker; упавший воркер перезапускается. Запись в базу из разных
+# процессов упорядочивает SQLite (WAL, BEGIN IMMEDIATE и busy_timeout), а кэши воркеров
+# узнают об изменениях других процессов через PRAGMA data_version и table_versions.
+
+BOT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")
+
+# Сколько секунд ждать готовности воркера после запуска и его остановки после SIGTERM
+START_TIMEOUT = 60.0
+STOP_TIMEOUT = webhook.DRAIN_TIMEOUT + 5.0
+# Пауза перед перезапуском упавшего воркера
+RESTART_DELAY = 1.0
+# Сколько секунд ждать ответа воркера на переданное обновление
+FORWARD_TIMEOUT = 10.0
+
+def shard_for(user_id: int, workers: int) -> int:
+    """Номер воркера для пользователя; не меняется, пока не меняется число воркеров"""
+    return zlib.crc32(user_id.to_bytes(8, "little", signed=True)) % workers
+
+def update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    """
+    Пользователь, к которому относится обновление (автор сообщения, нажатия кнопки и т. п.),
+    а для обновлений без автора — чат
+    """
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        for field in ("from", "user", "chat"):
+            owner = value.get(field)
+            if isinstance(owner, dict) and isinstance(owner.get("id"), int):
+                return owner["id"]
+    return None
+
+class Worker:
+    def __init__(self, index: int, count: int, port: int, secret: str, env: Dict[str, str]) -> None:
+        self.index = index
+        self.url = f"http://127.0.0.1:{port}"
+        self.env = dict(
+            env,
+            BOT_MODE="worker",
+            WORKER_INDEX=str(index),
+            WORKER_COUNT=str(count),
+            WEBHOOK_HOST="127.0.0.1",
+            WEBHOOK_PORT=str(port),
+            WEBHOOK_SECRET=secret,
+            METRICS_PORT=str(METRICS_PORT + index),
+        )
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.restarts = 0
+        self.forwarded = 0
+
+    async def start(self) -> None:
+        self.process = await asyncio.create_subprocess_exec(sys.executable, BOT_SCRIPT, env=self.env)
+        logging.info(f"Воркер {self.index} запущен (pid {self.process.pid}, {self.url})")
+
+    async def wait_ready(self, session: ClientSession, timeout: float = START_TIMEOUT) -> None:
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.process.returncode is not None:
+                raise RuntimeError(f"Воркер {self.index} завершился при запуске с кодом {self.process.returncode}")
+            try:
+                async with session.get(self.url + "/health") as response:
+                    if response.status == 200:
+                        return
+            except ClientError:
+                pass
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"Воркер {self.index} не ответил на /health за {timeout:.0f} с")
+            await asyncio.sleep(0.2)
+
+    async def stop(self) -> None:
+        if self.process is None or self.process.returncode is not None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            await asyncio.wait_for(self.process.wait(), STOP_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.warning(f"Воркер {self.index} не остановился за {STOP_TIMEOUT:.0f} с, завершаем принудительно")
+            self.process.kill()
+            await self.process.wait()
+
+class Supervisor:
+    """
+    Запускает workers воркеров и распределяет между ними обновления по user_id
+    """
+
+    def __init__(self, workers: int, path: str = webhook.DEFAULT_PATH, secret: str = "",
+                 base_port: int = WORKER_BASE_PORT) -> None:
+        self.path = path
+        self.secret = secret
+        # Внутренний токен защищает порты воркеров от запросов в обход супервизора
+        self._internal_secret = secrets.token_urlsafe(32)
+        env = dict(os.environ)
+        self.workers = [
+            Worker(index, workers, base_port + index, self._internal_secret, env) for index in range(workers)
+        ]
+        self._session: Optional[ClientSession] = None
+        self._monitors: List[asyncio.Task] = []
+        self._stopping = False
+        self.rejected = 0
+
+    async def start(self) -> None:
+        # Таблицы и миграции создаются один раз до запуска воркеров; заполнение run_day выполнит воркер 0
+        bootstrap.init_db()
+        self._session = ClientSession(timeout=ClientTimeout(total=FORWARD_TIMEOUT))
+        for worker in self.workers:
+            await worker.start()
+        await asyncio.gather(*(worker.wait_ready(self._session) for worker in self.workers))
+        self._monitors = [asyncio.create_task(self._monitor(worker)) for worker in self.workers]
+
+    async def _monitor(self, worker: Worker) -> None:
+        while True:
+            code = await worker.process.wait()
+            if self._stopping:
+                return
+            worker.restarts += 1
+            logging.error(f"Воркер {worker.index} завершился с кодом {code}, перезапуск")
+            await asyncio.sleep(RESTART_DELAY)
+            await worker.start()
+
+    def worker_for(self, update: Dict[str, Any]) -> Worker:
+        user_id = update_user_id(update)
+        if user_id is None:
+            # Обновления без пользователя не привязаны к состоянию, подойдет любой воркер
+            user_id = update.get("update_id", 0)
+        return self.workers[shard_for(user_id, len(self.workers))]
+
+    async def forward(self, body: bytes) -> int:
+        """
+        Передает обновление воркеру и возвращает его HTTP-статус (503, если воркер недоступен)
+        """
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(update, dict):
+            return 400
+        worker = self.worker_for(update)
+        try:
+            async with self._session.post(
+                worker.url + self.path, data=body,
+                headers={webhook.SECRET_HEADER: self._internal_secret, "Content-Type": "application/json"}
+            ) as response:
+                status = response.status
+        except (ClientError, asyncio.TimeoutError):
+            status = 503
+        if status == 200:
+            worker.forwarded += 1
+        else:
+            self.rejected += 1
+        return status
+
+    async def stats(self) -> Dict[str, Any]:
+        async def worker_stats(worker: Worker) -> Dict[str, Any]:
+            result: Dict[str, Any] = {"index": worker.index, "forwarded": worker.forwarded,
+                                      "restarts": worker.restarts}
+            try:
+                async with self._session.get(worker.url + "/health") as response:
+                    result.update(await response.json())
+            except (ClientError, asyncio.TimeoutError, ValueError):
+                result["status"] = "down"
+            return result
+
+        workers = await asyncio.gather(*(worker_stats(worker) for worker in self.workers))
+        return {
+            "status": "ok" if all(worker.get("status") == "ok" for worker in workers) else "degraded",
+            "rejected": self.rejected,
+            "workers": workers,
+        }
+
+    def create_app(self) -> web.Application:
+        async def handle_update(request: web.Request) -> web.Response:
+            if self.secret and not hmac.compare_digest(request.headers.get(webhook.SECRET_HEADER, ""), self.secret):
+                return web.Response(status=401)
+            return web.Response(status=await self.forward(await request.read()))
+
+        async def health(request: web.Request) -> web.Response:
+            body = await self.stats()
+            return web.json_response(body, status=200 if body["status"] == "ok" else 503)
+
+        app = web.Application()
+        app.router.add_post(self.path, handle_update)
+        app.router.add_get("/health", health)
+        return app
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for task in self._monitors:
+            task.cancel()
+        await asyncio.gather(*self._monitors, return_exceptions=True)
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+        if self._session is not None:
+            await self._session.close()
+
+def _create_bot() -> Any:
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+
+    return Bot(
+        token=BOT_TOKEN,
+        session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None
+    )
+
+async def run(workers: int, base_url: str, host: str, port: int, path: str, secret: str) -> None:
+    """
+    Запускает воркеров, регистрирует вебхук base_url + path и распределяет обновления
+    до сигнала SIGINT/SIGTERM
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    supervisor = Supervisor(workers, path, secret)
+    runner = web.AppRunner(supervisor.create_app())
+    await runner.setup()
+    # aiogram нужен супервизору только для регистрации вебхука: его импорт (несколько секунд)
+    # идет в отдельном потоке, пока запускаются воркеры, и не задерживает цикл событий
+    creating_bot = asyncio.ensure_future(asyncio.to_thread(_create_bot))
+    bot = None
+    try:
+        await supervisor.start()
+        await web.TCPSite(runner, host, port).start()
+        bot = await creating_bot
+        # Список типов обновлений не передается: Telegram сохранит заданный ранее
+        await bot.set_webhook(
+            base_url.rstrip("/") + path, secret_token=secret or None,
+            max_connections=min(UPDATE_CONCURRENCY * workers, 100)
+        )
+        logging.info(f"Супервизор слушает {host}:{port}{path}, воркеров: {workers}")
+        await stop.wait()
+    finally:
+        # Сначала перестаем принимать обновления, затем даем воркерам доработать принятые
+        await runner.cleanup()
+        await supervisor.stop()
+        if bot is not None:
+            await bot.session.close()
+        logging.info(f"Супервизор остановлен, отклонено обновлений: {supervisor.rejected}")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Запуск бота в нескольких процессах')
+    parser.add_argument('--workers', type=int, default=BOT_WORKERS, help='Число процессов бота')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - supervisor - %(message)s')
+    config.validate()
+    if BOT_MODE != "webhook":
+        # getUpdates может опрашивать только один процесс
+        print("Для нескольких процессов нужен режим BOT_MODE=webhook и WEBHOOK_URL.")
+        sys.exit(1)
+    asyncio.run(run(args.workers, WEBHOOK_URL, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET))
+
+if __name__ == "__main__":
+    main()
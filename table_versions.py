@@ -0,0 +1,81 @@
+import sqlite3
+import threading
+from typing import Sequence
+
+from db_connection import get_connection
+
+# Счетчики изменений справочных таблиц (ранги, задания, сообщения).
+# Триггеры увеличивают счетчик при любом изменении таблицы, поэтому кэш в памяти
+# может проверить актуальность одним чтением по первичному ключу, не перечитывая таблицу.
+
+# Счетчик без таблицы: агрегаты таблицы лидеров изменены вне процесса бота
+# (удаление пользователей и пробежек, пересчет агрегатов в db_admin.py)
+LEADERBOARD = "leaderboard"
+
+CREATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS table_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+'''
+
+def track(cursor: sqlite3.Cursor, tables: Sequence[str]) -> None:
+    """
+    Создает счетчики и триггеры, увеличивающие их при INSERT, UPDATE и DELETE.
+    Вызывается из миграций.
+    """
+    cursor.execute(CREATE_TABLE_SQL)
+    for table in tables:
+        cursor.execute("INSERT OR IGNORE INTO table_versions (name, version) VALUES (?, 0)", (table,))
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {table}_version_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    UPDATE table_versions SET version = version + 1 WHERE name = '{table}';
+                END
+            """)
+
+def bump(cursor: sqlite3.Cursor, table: str) -> None:
+    """
+    Принудительно помечает таблицу измененной, чтобы кэши перечитали ее.
+    Счетчик создается при первом вызове, поэтому так можно помечать и изменения без триггеров.
+    """
+    cursor.execute(CREATE_TABLE_SQL)
+    cursor.execute("""
+        INSERT INTO table_versions (name, version) VALUES (?, 1)
+        ON CONFLICT (name) DO UPDATE SET version = version + 1
+    """, (table,))
+
+class TableVersion:
+    """
+    Текущая версия одной или нескольких таблиц (сумма их счетчиков, которая растет
+    при любом изменении любой из них). Пока PRAGMA data_version соединения не изменилась,
+    другие соединения ничего не фиксировали, и версия возвращается без запроса к таблице счетчиков.
+    Изменения, зафиксированные через соединение этого же потока, data_version не отражает,
+    поэтому после них нужно вызывать invalidate().
+    """
+
+    def __init__(self, *tables: str) -> None:
+        self.tables = tables
+        self._sql = (
+            "SELECT COALESCE(SUM(version), 0) FROM table_versions WHERE name IN ("
+            + ", ".join("?" * len(tables)) + ")"
+        )
+        self._local = threading.local()
+        self._generation = 0
+
+    def current(self) -> int:
+        conn = get_connection()
+        data_version = conn.execute("PRAGMA data_version").fetchone()[0]
+        local = self._local
+        if (getattr(local, 'conn', None) is conn and local.data_version == data_version
+                and local.generation == self._generation):
+            return local.version
+
+        version = conn.execute(self._sql, self.tables).fetchone()[0]
+        local.conn, local.data_version, local.generation = conn, data_version, self._generation
+        local.version = version
+        return version
+
+    def invalidate(self) -> None:
+        self._generation += 1
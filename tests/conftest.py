@@ -0,0 +1,29 @@
+import pytest
+
+import bootstrap
+import catalogs
+import database
+import db_connection
+import leaderboard
+import ranks
+
+@pytest.fixture
+def db(tmp_path):
+    """
+    Пустая инициализированная база во временном каталоге с таблицей рангов.
+    Кэши модулей сбрасываются, чтобы не переносить данные между тестами.
+    """
+    saved_path = db_connection.DB_PATH
+    db_connection.configure(str(tmp_path / "running_bot.db"))
+    bootstrap.init_db()
+    conn = db_connection.get_connection()
+    conn.execute("INSERT INTO ranks (name, min_km, max_km) VALUES ('Падаван', 0, ?)", (float('inf'),))
+    conn.commit()
+    leaderboard.invalidate()
+    ranks.invalidate()
+    catalogs.invalidate()
+    database.known_users.clear()
+    try:
+        yield conn
+    finally:
+        db_connection.configure(saved_path)
@@ -0,0 +1,23 @@
+import database
+from db_connection import count_queries, transaction
+
+def test_get_dashboard_query_budget(db):
+    for distance in (5.0, 7.5, 10.0):
+        database.add_run(1, distance)
+    database.get_dashboard(1)  # прогрев: кэш рангов и известных пользователей
+
+    with count_queries() as statements:
+        dashboard = database.get_dashboard(1)
+
+    # Не больше 6 запросов, включая BEGIN и COMMIT
+    assert len(statements) <= 6, statements
+    assert dashboard["weekly_distance"] == 22.5
+
+def test_get_dashboard_keeps_outer_transaction(db):
+    database.add_run(1, 5.0)
+    with transaction() as cursor:
+        cursor.execute("UPDATE users SET username = 'runner' WHERE user_id = 1")
+        # Чтения идут в открытой транзакции и не фиксируют ее раньше времени
+        assert database.get_dashboard(1)["weekly_distance"] == 5.0
+        assert db.in_transaction
+    assert db.execute("SELECT username FROM users WHERE user_id = 1").fetchone() == ("runner",)
@@ -0,0 +1,35 @@
+import pytest
+
+import migrate_db
+
+@pytest.fixture
+def plans(db):
+    return migrate_db.collect_query_plans()
+
+def test_hot_queries_use_indexes(plans):
+    scans = [(name, sql, migrate_db.full_scans(plan)) for name, sql, plan in plans if migrate_db.full_scans(plan)]
+    assert scans == []
+
+def test_plans_cover_runs_and_rollups(plans):
+    read = " ".join(sql for _, sql, _ in plans)
+    for table in migrate_db.PLAN_TABLES:
+        assert f"FROM {table}" in read
+
+@pytest.mark.parametrize("fragment, index", [
+    # Выборки по номеру дня (run_day)
+    ("FROM runs WHERE user_id = 1 AND run_day BETWEEN", "idx_runs_user_day (user_id=? AND run_day>? AND run_day<?)"),
+    ("r.run_day BETWEEN", "idx_runs_user_day"),
+    # Пересчет агрегатов пользователя после импорта
+    ("INSERT INTO weekly_totals", "idx_runs_user_day (user_id=? AND run_day>? AND run_day<?)"),
+    ("INSERT INTO monthly_totals", "idx_runs_user_day (user_id=? AND run_day>? AND run_day<?)"),
+    # Агрегаты пользователя за неделю
+    ("FROM weekly_totals WHERE user_id = 1 AND week_key =", "PRIMARY KEY"),
+    # Загрузка таблицы лидеров из агрегатов
+    ("FROM weekly_totals WHERE week_key =", "idx_weekly_totals_week"),
+    ("FROM monthly_totals WHERE month_key =", "idx_monthly_totals_month"),
+])
+def test_query_uses_index(plans, fragment, index):
+    matching = [(sql, plan) for _, sql, plan in plans if fragment in sql]
+    assert matching, f"нет запроса с {fragment!r}"
+    for sql, plan in matching:
+        assert any(index in line for line in plan), (sql, plan)
@@ -0,0 +1,45 @@
+import database
+import leaderboard
+from write_queue import RunWriteQueue
+
+def _runs_count(db) -> int:
+    return db.execute("SELECT COUNT(*) FROM runs").fetchone()[0]
+
+def test_index_error_after_commit_does_not_duplicate_runs(db, monkeypatch):
+    leaderboard.warm()
+
+    def broken_record_run(*args, **kwargs):
+        raise RuntimeError("сбой после фиксации")
+
+    monkeypatch.setattr(leaderboard, "record_run", broken_record_run)
+    writer = RunWriteQueue(flush_interval=0.05)
+    writer.start()
+    try:
+        futures = [writer.submit(user_id, 5.0) for user_id in (1, 2, 3)]
+        assert [future.result(timeout=5) for future in futures] == [5.0, 5.0, 5.0]
+    finally:
+        writer.stop()
+
+    assert _runs_count(db) == 3
+    monkeypatch.undo()
+    # Индексы сброшены и перечитываются из агрегатов без потерянных пробежек
+    assert [row[0] for row in leaderboard.top_weekly(10)] == [1, 2, 3]
+
+def test_failed_batch_is_retried_one_by_one(db, monkeypatch):
+    writer = RunWriteQueue(flush_interval=0.05)
+
+    def broken_batch(runs):
+        if len(runs) > 1:
+            raise RuntimeError("сбой транзакции")
+        return original(runs)
+
+    original = database.add_runs_batch
+    monkeypatch.setattr(database, "add_runs_batch", broken_batch)
+    writer.start()
+    try:
+        futures = [writer.submit(user_id, 5.0) for user_id in (1, 2)]
+        assert [future.result(timeout=5) for future in futures] == [5.0, 5.0]
+    finally:
+        writer.stop()
+
+    assert _runs_count(db) == 2
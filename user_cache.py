@@ -0,0 +1,77 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# Имя пользователя, которое еще не читали из базы
+UNKNOWN = object()
+
+class KnownUserCache:
+    """
+    LRU-кэш зарегистрированных пользователей и последних сохраненных имен.
+    Позволяет init_user не обращаться к базе для уже известных пользователей.
+    """
+
+    def __init__(self, capacity: int = 100000) -> None:
+        self.capacity = capacity
+        self._users: "OrderedDict[int, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.db_writes = 0
+        self.writes_avoided = 0
+
+    def lookup(self, user_id: int) -> Tuple[bool, Any]:
+        """
+        Возвращает (известен ли пользователь, сохраненное имя или UNKNOWN)
+        """
+        with self._lock:
+            if user_id in self._users:
+                self._users.move_to_end(user_id)
+                return True, self._users[user_id]
+            return False, UNKNOWN
+
+    def remember(self, user_id: int, username: Any = UNKNOWN) -> None:
+        with self._lock:
+            if username is UNKNOWN and self._users.get(user_id, UNKNOWN) is not UNKNOWN:
+                # Не затираем уже известное имя
+                username = self._users[user_id]
+            self._users[user_id] = username
+            self._users.move_to_end(user_id)
+            while len(self._users) > self.capacity:
+                self._users.popitem(last=False)
+
+    def forget(self, user_id: int) -> None:
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._users.clear()
+
+    def record(self, hit: bool, wrote: Optional[bool] = None) -> None:
+        """
+        Учитывает обращение к кэшу и то, пришлось ли писать в базу
+        (wrote=None — запись не требовалась и не рассматривалась)
+        """
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if wrote is True:
+                self.db_writes += 1
+            elif wrote is False:
+                self.writes_avoided += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._users),
+                "capacity": self.capacity,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "db_writes": self.db_writes,
+                "writes_avoided": self.writes_avoided,
+            }
@@ -0,0 +1,167 @@
+import asyncio
+import hmac
+import logging
+import signal
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+from aiohttp import web
+
+import async_db
+from db_connection import get_connection
+
+if TYPE_CHECKING:
+    from aiogram import Bot, Dispatcher
+    from aiogram.types import Update
+
+# Прием обновлений через вебхук: встроенный сервер aiohttp принимает POST от Telegram,
+# проверяет секретный токен, ставит обновление в ограниченную очередь и сразу отвечает 200.
+# Обновления обрабатывает фиксированный пул воркеров, поэтому всплеск не порождает
+# неограниченное число задач. Если очередь заполнена, сервер отвечает 503 и Telegram
+# повторит доставку позже. aiogram импортируется при создании приложения: супервизору
+# (supervisor.py) нужны только константы модуля.
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+DEFAULT_PATH = "/webhook"
+DEFAULT_CONCURRENCY = 64
+DEFAULT_QUEUE_SIZE = 1000
+
+# Сколько секунд при остановке дожидаться обработки принятых обновлений
+DRAIN_TIMEOUT = 10.0
+
+class UpdatePool:
+    """
+    Очередь принятых обновлений и concurrency воркеров, передающих их в диспетчер
+    """
+
+    def __init__(self, dp: "Dispatcher", bot: "Bot", concurrency: int = DEFAULT_CONCURRENCY,
+                 queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+        self.dp = dp
+        self.bot = bot
+        self.concurrency = concurrency
+        self._queue: "asyncio.Queue[Update]" = asyncio.Queue(maxsize=queue_size)
+        self._workers: List[asyncio.Task] = []
+        self.in_flight = 0
+        self.processed = 0
+        self.errors = 0
+        self.rejected = 0
+
+    def start(self) -> None:
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+
+    def submit(self, update: "Update") -> bool:
+        """Ставит обновление в очередь; False, если очередь заполнена"""
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        return True
+
+    async def _work(self) -> None:
+        while True:
+            update = await self._queue.get()
+            self.in_flight += 1
+            try:
+                await self.dp.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception:
+                self.errors += 1
+                logging.exception(f"Ошибка при обработке обновления {update.update_id}")
+            finally:
+                self.in_flight -= 1
+                self._queue.task_done()
+
+    async def stop(self, timeout: float = DRAIN_TIMEOUT) -> None:
+        """Дожидается обработки принятых обновлений (не дольше timeout) и останавливает воркеров"""
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Вебхук остановлен, необработанных обновлений: {self._queue.qsize()}")
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queued": self._queue.qsize(),
+            "in_flight": self.in_flight,
+            "processed": self.processed,
+            "errors": self.errors,
+            "rejected": self.rejected,
+        }
+
+def _ping_database() -> None:
+    get_connection().execute("SELECT 1").fetchone()
+
+def create_app(pool: UpdatePool, secret: str = "", path: str = DEFAULT_PATH) -> web.Application:
+    """
+    Приложение aiohttp с обработчиком вебхука на path и проверкой состояния на /health
+    """
+    from aiogram.types import Update
+
+    async def handle_update(request: web.Request) -> web.Response:
+        if secret and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), secret):
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": pool.bot})
+        except Exception:
+            return web.Response(status=400)
+        if not pool.submit(update):
+            return web.Response(status=503)
+        return web.Response()
+
+    async def health(request: web.Request) -> web.Response:
+        try:
+            await async_db.run_db(_ping_database)
+            database_ok = True
+        except Exception:
+            database_ok = False
+        body = {"status": "ok" if database_ok else "degraded", "database": database_ok, **pool.stats()}
+        return web.json_response(body, status=200 if database_ok else 503)
+
+    app = web.Application()
+    app.router.add_post(path, handle_update)
+    app.router.add_get("/health", health)
+    return app
+
+async def run(dp: "Dispatcher", bot: "Bot", base_url: str, host: str = "0.0.0.0", port: int = 8080,
+              path: str = DEFAULT_PATH, secret: str = "", concurrency: int = DEFAULT_CONCURRENCY,
+              queue_size: int = DEFAULT_QUEUE_SIZE, stop: Optional[asyncio.Event] = None) -> None:
+    """
+    Регистрирует вебхук base_url + path в Telegram и обслуживает обновления до отмены,
+    события stop или сигнала SIGINT/SIGTERM. Без base_url вебхук не регистрируется
+    (воркер supervisor.py получает обновления от супервизора).
+    """
+    if stop is None:
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except NotImplementedError:
+                pass
+    pool = UpdatePool(dp, bot, concurrency, queue_size)
+    runner = web.AppRunner(create_app(pool, secret, path))
+    await runner.setup()
+    await dp.emit_startup(bot=bot)
+    pool.start()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        if base_url:
+            await bot.set_webhook(
+                base_url.rstrip("/") + path,
+                secret_token=secret or None,
+                allowed_updates=dp.resolve_used_update_types(),
+                max_connections=min(concurrency, 100),
+            )
+        logging.info(f"Вебхук слушает {host}:{port}{path}")
+        await stop.wait()
+    finally:
+        # Сначала перестаем принимать запросы, затем дорабатываем принятые обновления
+        await runner.cleanup()
+        await pool.stop()
+        await dp.emit_shutdown(bot=bot)
+        await bot.session.close()
+        logging.info(f"Вебхук остановлен: {pool.stats()}")
@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Optional, Tuple
+
+import database
+
+# Значения по умолчанию: сколько ждать попутных записей и сколько пробежек фиксировать за раз
+DEFAULT_FLUSH_INTERVAL = 0.005
+DEFAULT_BATCH_SIZE = 100
+
+_STOP = object()
+
+class RunWriteQueue:
+    """
+    Единственный писатель пробежек: собирает записи в течение flush_interval секунд
+    (или до batch_size штук), фиксирует их одной транзакцией и возвращает каждому
+    вызывающему его недельную дистанцию через Future.
+    """
+
+    def __init__(self, flush_interval: float = DEFAULT_FLUSH_INTERVAL,
+                 batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._queue: "queue.Queue" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._accepting = False
+        # Защищает прием записей от гонки с остановкой очереди
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._accepting = True
+        self._thread = threading.Thread(target=self._run, name='run-writer', daemon=True)
+        self._thread.start()
+
+    def submit(self, user_id: int, distance: float) -> Future:
+        """
+        Ставит пробежку в очередь. Future завершается после фиксации транзакции.
+        """
+        future: Future = Future()
+        with self._lock:
+            if not self._accepting:
+                raise RuntimeError("Очередь записи пробежек остановлена")
+            self._queue.put((user_id, distance, future))
+        return future
+
+    def stop(self) -> None:
+        """
+        Перестает принимать записи и дожидается фиксации всех уже поставленных
+        """
+        if self._thread is None:
+            return
+        with self._lock:
+            self._accepting = False
+            self._queue.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+
+            # Собираем попутные записи, пока не истек интервал или не набралась пачка
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    # Дописываем накопленное и все, что успели поставить до остановки
+                    stopping = True
+                    break
+                batch.append(item)
+
+            self._flush(batch)
+
+        # После остановки в очереди могут остаться записи, поставленные до сигнала
+        remaining = []
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                remaining.append(item)
+        for start in range(0, len(remaining), self.batch_size):
+            self._flush(remaining[start:start + self.batch_size])
+
+    def _flush(self, batch: List[Tuple[int, float, Future]]) -> None:
+        try:
+            results = database.add_runs_batch([(user_id, distance) for user_id, distance, _ in batch])
+        except Exception:
+            # add_runs_batch выбрасывает исключение, только если транзакция откатилась, поэтому
+            # ни одна пробежка пачки не записана и повтор по одной не создаст дубликатов
+            logging.exception(f"Не удалось записать пачку из {len(batch)} пробежек, записываю по одной")
+            for user_id, distance, future in batch:
+                try:
+                    future.set_result(database.add_run(user_id, distance))
+                except Exception as e:
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), weekly_distance in zip(batch, results):
+            future.set_result(weekly_distance)
+
+_writer: Optional[RunWriteQueue] = None
+
+def start(flush_interval: float = DEFAULT_FLUSH_INTERVAL, batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+    """
+    Запускает общий для процесса писатель пробежек
+    """
+    global _writer
+    if _writer is None:
+        _writer = RunWriteQueue(flush_interval, batch_size)
+        _writer.start()
+
+def stop() -> None:
+    """
+    Останавливает писатель, предварительно зафиксировав все принятые пробежки
+    """
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+def get_writer() -> Optional[RunWriteQueue]:
+    return _writer